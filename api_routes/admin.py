@@ -2,15 +2,19 @@ import pyotp
 
 from flask import jsonify, make_response, request
 from flask_jwt_extended import jwt_required, create_access_token, create_refresh_token, get_jwt_identity
-from os import environ as env
+from os import environ as env, getpid
 from datetime import datetime
+from itertools import islice
 
 from utils.orm.admin import AdminAccount
 from utils.orm.user import UserAccount, TokenClaim, UserPurchase
 from utils.orm.filter import Filter, OperatorType
-from utils.api import http_error_400, http_error_401, http_error_403, json_data_required, admin_required
+from utils.orm.abstract import transaction
+from utils.orm.instrumentation import query_stats, reset_query_stats
+from utils.security import password_hash_stats
+from utils.api import http_error_400, http_error_401, http_error_403, json_data_required, admin_required, \
+    json_stream_response, get_pagination, add_date_filter
 from utils.email import Sendgrid
-from utils.security import generate_hash
 from utils.provider import Provider
 from utils.orm.blockchain import TokenOperation
 
@@ -398,61 +402,55 @@ def add_routes(app):
         admin_uuid = get_jwt_identity().get('admin_uuid')
         unique_emails = list(set(emails_list))
 
-        not_created = []
-        existed = []
         user_account = UserAccount()
         sendgrid = Sendgrid()
         email_subject = "Créez votre compte LiFiSe"
         invitation_link = "{0}/signup?user_uuid=".format(env['APP_FRONT_URL'])
         decline_link = "{0}/decline?user_uuid=".format(env['APP_FRONT_URL'])
 
-        for email_address in unique_emails:
-            status, http_code, message, already_exist = user_account.register(email_address=email_address)
-            if status is False and already_exist is False:
-                not_created.append(email_address)
-                continue
-            if status is False and already_exist is True:
-                existed.append(email_address)
-                email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
-                user_account.load({'email_hash': email_address_hash})
-            else:
-                if claimable_tokens > 0:
-                    content = "Vous êtes invité à rejoindre LiFiSe et à collecter votre cadeau " \
-                              "de {nb_token} EUR LFS en cliquant sur le lien suivant :<br>" \
-                              "{invitation_link}{user_uuid}<br>" \
-                              "<br>LiFiSe est la première Néo-banque Française web3 grand public. " \
-                              "C’est une Fintech Mass Market issue de l’univers crypto.<br>" \
-                              "LiFiSe c’est : un exchange, un euro stable coin et " \
-                              "un utility Token de Gouvernance.<br>" \
-                              "Notre Slogan : « Liberty – Safety – Trust »<br><br>" \
-                              "Pour nous rejoindre, vous devez disposer d’une simple adresse email " \
-                              "et suivre votre lien d'enregistrement ci-dessus puis vous laisser guider !<br><br>" \
-                              "Si vous ne souhaitez pas créer votre compte LiFiSe, " \
-                              "cliquez sur le lien suivant pour refuser et ne plus recevoir nos messages :<br>" \
-                              "{decline_link}{user_uuid}".format(nb_token=claimable_tokens,
-                                                                 invitation_link=invitation_link,
-                                                                 user_uuid=user_account.get('user_uuid'),
-                                                                 decline_link=decline_link)
-                else:
-                    content = "Vous êtes invité à rejoindre LiFiSe en cliquant sur le lien suivant :<br>" \
-                              "{invitation_link}{user_uuid}<br>" \
-                              "<br>LiFiSe est la première Néo-banque Française web3 grand public. " \
-                              "C’est une Fintech Mass Market issue de l’univers crypto.<br>" \
-                              "LiFiSe c’est : un exchange, un euro stable coin et " \
-                              "un utility Token de Gouvernance.<br>" \
-                              "Notre Slogan : « Liberty – Safety – Trust »<br><br>" \
-                              "Pour nous rejoindre, vous devez disposer d’une simple adresse email " \
-                              "et suivre votre lien d'enregistrement ci-dessus puis vous laisser guider !<br><br>" \
-                              "Si vous ne souhaitez pas créer votre compte LiFiSe, " \
-                              "cliquez sur le lien suivant pour refuser et ne plus recevoir nos messages :<br>" \
-                              "{decline_link}{user_uuid}".format(invitation_link=invitation_link,
-                                                                 user_uuid=user_account.get('user_uuid'),
-                                                                 decline_link=decline_link)
-                sendgrid.send_email(to_emails=[user_account.get('email')], subject=email_subject, txt_content=content)
+        with transaction():
+            created, existing_users, not_created = user_account.register_many(email_addresses=unique_emails)
             if claimable_tokens > 0:
                 token_claim = TokenClaim()
-                token_claim.create(creator_uuid=admin_uuid, user_uuid=user_account.get('user_uuid'),
-                                   nb_token=claimable_tokens)
+                token_claim.create_many(creator_uuid=admin_uuid,
+                                        user_uuids=list(created.values()) + list(existing_users.values()),
+                                        nb_token=claimable_tokens)
+        existed = list(existing_users.keys())
+
+        for email_address, new_user_uuid in created.items():
+            if claimable_tokens > 0:
+                content = "Vous êtes invité à rejoindre LiFiSe et à collecter votre cadeau " \
+                          "de {nb_token} EUR LFS en cliquant sur le lien suivant :<br>" \
+                          "{invitation_link}{user_uuid}<br>" \
+                          "<br>LiFiSe est la première Néo-banque Française web3 grand public. " \
+                          "C’est une Fintech Mass Market issue de l’univers crypto.<br>" \
+                          "LiFiSe c’est : un exchange, un euro stable coin et " \
+                          "un utility Token de Gouvernance.<br>" \
+                          "Notre Slogan : « Liberty – Safety – Trust »<br><br>" \
+                          "Pour nous rejoindre, vous devez disposer d’une simple adresse email " \
+                          "et suivre votre lien d'enregistrement ci-dessus puis vous laisser guider !<br><br>" \
+                          "Si vous ne souhaitez pas créer votre compte LiFiSe, " \
+                          "cliquez sur le lien suivant pour refuser et ne plus recevoir nos messages :<br>" \
+                          "{decline_link}{user_uuid}".format(nb_token=claimable_tokens,
+                                                             invitation_link=invitation_link,
+                                                             user_uuid=new_user_uuid,
+                                                             decline_link=decline_link)
+            else:
+                content = "Vous êtes invité à rejoindre LiFiSe en cliquant sur le lien suivant :<br>" \
+                          "{invitation_link}{user_uuid}<br>" \
+                          "<br>LiFiSe est la première Néo-banque Française web3 grand public. " \
+                          "C’est une Fintech Mass Market issue de l’univers crypto.<br>" \
+                          "LiFiSe c’est : un exchange, un euro stable coin et " \
+                          "un utility Token de Gouvernance.<br>" \
+                          "Notre Slogan : « Liberty – Safety – Trust »<br><br>" \
+                          "Pour nous rejoindre, vous devez disposer d’une simple adresse email " \
+                          "et suivre votre lien d'enregistrement ci-dessus puis vous laisser guider !<br><br>" \
+                          "Si vous ne souhaitez pas créer votre compte LiFiSe, " \
+                          "cliquez sur le lien suivant pour refuser et ne plus recevoir nos messages :<br>" \
+                          "{decline_link}{user_uuid}".format(invitation_link=invitation_link,
+                                                             user_uuid=new_user_uuid,
+                                                             decline_link=decline_link)
+            sendgrid.send_email(to_emails=[email_address], subject=email_subject, txt_content=content)
 
         if len(existed) > 0 and claimable_tokens > 0:
             subject = "LiFiSe vous offre des euros"
@@ -494,10 +492,50 @@ def add_routes(app):
                     filter_user.add('public_address', operator=OperatorType.IN)
                 else:
                     filter_user.add('public_address', operator=OperatorType.INN)
-            user_accounts = user_account.list(filter_object=filter_user, order='lastname', asc='ASC')
-
-            users_list = []
-            for current_user in user_accounts:
+            if request.args.get('kyc_status') is not None:
+                # comma separated statuses, 'none' for the users who have not started the KYC
+                kyc_statuses = request.args.get('kyc_status').split(',')
+                filter_kyc = Filter(operator=OperatorType.OR)
+                if 'none' in kyc_statuses:
+                    filter_kyc.add('kyc_status', operator=OperatorType.IN)
+                filter_kyc.add('kyc_status', [status for status in kyc_statuses if status != 'none'],
+                               operator=OperatorType.IIN)
+                filter_user.add_group(filter_kyc)
+            try:
+                add_date_filter(filter_user, 'created_date')
+            except ValueError:
+                return http_error_400(message="error_invalid_date")
+
+            # every encrypted field but otp_token is returned, they are decrypted in bulk
+            fields = ['user_uuid', 'email', 'firstname', 'lastname', 'birthdate', 'email_validated', 'last_login',
+                      'created_date', 'updated_date', 'deactivated', 'deactivated_date', 'public_address', 'kyc_status',
+                      'kyc_status_date']
+            next_cursor = None
+            try:
+                page_size, cursor = get_pagination()
+                if page_size is None:
+                    users = user_account.iter_list(fields=fields, filter_object=filter_user, order='created_date',
+                                                   asc='ASC', decrypt_all=True)
+                else:
+                    users, next_cursor = user_account.list_page(fields=fields, filter_object=filter_user,
+                                                                order='created_date', page_size=page_size,
+                                                                after=cursor, decrypt_all=True)
+            except ValueError:
+                return http_error_400(message="error_invalid_pagination")
+
+            def users_list():
+                users_iterator = iter(users)
+                while True:
+                    # claims are prefetched for a batch of users instead of one query per user
+                    users_batch = list(islice(users_iterator, 200))
+                    if len(users_batch) == 0:
+                        break
+                    users_claims = token_claim.get_token_claims_for_users(
+                        user_uuids=[current_user.get('user_uuid') for current_user in users_batch], claimed=False)
+                    for current_user in users_batch:
+                        yield users_details(current_user, users_claims)
+
+            def users_details(current_user, users_claims):
                 email_validated = False
                 if current_user.get('email_validated') == 1:
                     email_validated = True
@@ -505,9 +543,8 @@ def add_routes(app):
                 if current_user.get('deactivated') == 0:
                     account_deactivated = False
 
-                to_claim, total_to_claim = token_claim.get_token_claims(user_uuid=current_user.get('user_uuid'),
-                                                                        claimed=False)
-                users_list.append({
+                to_claim, total_to_claim = users_claims.get(current_user.get('user_uuid'))
+                return {
                     'email_address': current_user.get('email'),
                     'user_uuid': current_user.get('user_uuid'),
                     'firstname': current_user.get('firstname'),
@@ -526,13 +563,14 @@ def add_routes(app):
                     },
                     'kyc_status': current_user.get('kyc_status'),
                     'kyc_status_date': current_user.get('kyc_status_date')
-                })
+                }
 
             json_data = {
                 'status': True,
                 'message': "success_user_accounts",
-                'user_accounts': users_list
+                'next_cursor': next_cursor
             }
+            return json_stream_response(json_data=json_data, list_key='user_accounts', items=users_list())
         else:
             user_account.load({'user_uuid': user_uuid})
             email_validated = False
@@ -546,6 +584,8 @@ def add_routes(app):
                                                                           claimed=True)
             to_claim, total_to_claim = token_claim.get_token_claims(user_uuid=user_account.get('user_uuid'),
                                                                     claimed=False)
+            purchases = UserPurchase().get_purchases_totals(user_uuids=[user_uuid]).get(user_uuid)
+            operations = TokenOperation().count_operations(user_uuids=[user_uuid]).get(user_uuid)
             provider = Provider()
             balances = {}
             if user_account.get('public_address') is not None:
@@ -571,6 +611,8 @@ def add_routes(app):
                     'already_claimed': already_claimed,
                     'total_claimed': total_claimed
                 },
+                'purchases': purchases,
+                'operations': operations,
                 'wallet': balances,
                 'kyc_status': user_account.get('kyc_status'),
                 'kyc_status_date': user_account.get('kyc_status_date')
@@ -697,40 +739,60 @@ def add_routes(app):
                 filter_purchase.add('amount_received', operator=OperatorType.IN)
             else:
                 filter_purchase.add('amount_received', operator=OperatorType.INN)
+        try:
+            add_date_filter(filter_purchase, 'created_date')
+        except ValueError:
+            return http_error_400(message="error_invalid_date")
+
+        fields = ['user_purchase_uuid', 'user_uuid', 'nb_token', 'total_price_eur', 'reference', 'amount_received',
+                  'payment_date', 'tx_hash', 'created_date']
+        next_cursor = None
+        try:
+            page_size, cursor = get_pagination()
+            if page_size is None:
+                purchases = user_purchase.iter_list(fields=fields, filter_object=filter_purchase, order='created_date',
+                                                    asc='DESC')
+            else:
+                purchases, next_cursor = user_purchase.list_page(fields=fields, filter_object=filter_purchase,
+                                                                 order='created_date', asc='DESC',
+                                                                 page_size=page_size, after=cursor)
+        except ValueError:
+            return http_error_400(message="error_invalid_pagination")
 
-        purchase_list = user_purchase.list(fields=['user_purchase_uuid', 'user_uuid', 'nb_token', 'total_price_eur',
-                                                   'reference', 'amount_received', 'payment_date', 'tx_hash',
-                                                   'created_date'],
-                                           filter_object=filter_purchase, order='created_date', asc='DESC')
         user_list = []
-        user_details = {}
-        if len(purchase_list) > 0:
-            for current_purchase in purchase_list:
+
+        def purchase_list():
+            for current_purchase in purchases:
                 if current_purchase.get('user_uuid') not in user_list:
                     user_list.append(current_purchase.get('user_uuid'))
-
-            filter_users = Filter()
-            filter_users.add('user_uuid', user_list, operator=OperatorType.IIN)
-            user_account = UserAccount()
-            users_info = user_account.list(fields=['user_uuid', 'firstname', 'lastname', 'email', 'public_address',
-                                                   'kyc_status'],
-                                           filter_object=filter_users)
-            for current_user in users_info:
-                user_details[current_user.get('user_uuid')] = {
-                    'firstname': current_user.get('firstname'),
-                    'lastname': current_user.get('lastname'),
-                    'email': current_user.get('email'),
-                    'public_address': current_user.get('public_address'),
-                    'kyc_status': current_user.get('kyc_status')
-                }
+                yield current_purchase
+
+        def users_info():
+            user_details = {}
+            if len(user_list) > 0:
+                filter_users = Filter()
+                filter_users.add('user_uuid', user_list, operator=OperatorType.IIN)
+                user_account = UserAccount()
+                users = user_account.list(fields=['user_uuid', 'firstname', 'lastname', 'email', 'public_address',
+                                                  'kyc_status'],
+                                          filter_object=filter_users, decrypt_all=True)
+                for current_user in users:
+                    user_details[current_user.get('user_uuid')] = {
+                        'firstname': current_user.get('firstname'),
+                        'lastname': current_user.get('lastname'),
+                        'email': current_user.get('email'),
+                        'public_address': current_user.get('public_address'),
+                        'kyc_status': current_user.get('kyc_status')
+                    }
+            return {'user_info': user_details}
 
         json_data = {
             'status': True,
             'message': "success_purchase",
-            'orders': purchase_list,
-            'user_info': user_details
+            'next_cursor': next_cursor
         }
-        return make_response(jsonify(json_data), 200)
+        return json_stream_response(json_data=json_data, list_key='orders', items=purchase_list(),
+                                    trailer=users_info)
 
     @app.route('/api/v1/admin/user/purchase/order/confirm', methods=['POST'])
     @json_data_required
@@ -757,21 +819,38 @@ def add_routes(app):
             return http_error_400(message="error_public_address")
 
         user_purchase = UserPurchase()
-        user_purchase.load({'user_uuid': user_uuid, 'user_purchase_uuid': user_purchase_uuid})
-        if user_purchase.get('amount_received') is not None:
-            return http_error_400(message="error_already_confirmed")
+        # the payment is confirmed and committed before the tokens are sent, a second confirmation can't send them again
+        # the purchase is read from the primary and locked: a replica lagging behind could still see it unconfirmed
+        with transaction():
+            user_purchase.load({'user_uuid': user_uuid, 'user_purchase_uuid': user_purchase_uuid}, for_update=True)
+            if user_purchase.get('amount_received') is not None:
+                return http_error_400(message="error_already_confirmed")
+            status, http_code, message = user_purchase.confirm_payment(amount_received=amount_received)
+        if status is False:
+            return http_error_400(message=message)
 
-        transaction = {
+        batch = {
             user_purchase_uuid: {
                 'receiver': user_account.get('public_address'),
                 'nb_token': amount_received
             }
         }
         provider = Provider()
-        status_tx, http_code_tx, message_tx, tx_hash = provider.send_batch_tx(transactions=transaction)
-        if status_tx is True:
-            status, message, http_code = user_purchase.confirm_payment(amount_received=amount_received,
-                                                                       tx_hash=tx_hash.get(user_purchase_uuid))
+        try:
+            status_tx, http_code_tx, message_tx, tx_hash = provider.send_batch_tx(transactions=batch)
+        except Exception as e:
+            # e.g. the RPC node is unreachable: handled as a failed send so that the payment is reopened
+            app.logger.error("Payment confirmation of {0} failed, tokens not sent, error = {1}".format(
+                user_purchase_uuid, e))
+            status_tx, http_code_tx, message_tx, tx_hash = False, 503, "error_wait_retry", None
+        if status_tx is True and tx_hash.get(user_purchase_uuid) is None:
+            status_tx, http_code_tx, message_tx = False, 500, "error_internal_error"
+        if status_tx is False:
+            # no token was sent, the payment can be confirmed again
+            user_purchase.cancel_payment()
+        else:
+            # the tokens are sent: each write below commits on its own and can't reopen the payment
+            status, http_code, message = user_purchase.set_tx_hash(tx_hash=tx_hash.get(user_purchase_uuid))
             if status is False:
                 app.logger.error("Error during payment confirmation, tx hash = {0}".format(
                     tx_hash.get(user_purchase_uuid)))
@@ -822,3 +901,45 @@ def add_routes(app):
             'address': env['ADMIN_WALLET_PUBLIC_KEY']
         }
         return make_response(jsonify(json_data), 200)
+
+    @app.route('/api/v1/admin/debug/queries', methods=['GET'])
+    @jwt_required()
+    @admin_required
+    def get_query_stats():
+        """
+        Get the SQL statements run by the worker process serving the request, aggregated by query shape
+        :return:
+        """
+        try:
+            limit = int(request.args.get('limit', 50))
+        except ValueError:
+            return http_error_400()
+
+        queries = query_stats(limit=limit)
+        if request.args.get('reset') == 'true':
+            reset_query_stats()
+
+        json_data = {
+            'status': True,
+            'message': "success_query_stats",
+            'pid': queries['pid'],
+            'nb_shapes': queries['nb_shapes'],
+            'queries': queries['queries']
+        }
+        return make_response(jsonify(json_data), 200)
+
+    @app.route('/api/v1/admin/debug/passwords', methods=['GET'])
+    @jwt_required()
+    @admin_required
+    def get_password_hash_stats():
+        """
+        Get the password hashing metrics of the worker process serving the request
+        :return:
+        """
+        json_data = {
+            'status': True,
+            'message': "success_password_hash_stats",
+            'pid': getpid(),
+            'password_hash': password_hash_stats()
+        }
+        return make_response(jsonify(json_data), 200)
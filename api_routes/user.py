@@ -4,11 +4,10 @@ from os import environ as env
 from datetime import datetime, timedelta
 
 from utils.orm.user import UserAccount, Beneficiary, TokenClaim, UserPurchase
-from utils.api import http_error_400, http_error_401, http_error_403, json_data_required, user_required
+from utils.api import http_error_400, http_error_401, http_error_403, json_data_required, user_required, get_pagination
 from utils.email import Sendgrid
 from utils.redis_db import Redis
 from utils.magic_link import MagicLink
-from utils.security import generate_hash
 from utils.provider import Provider
 from utils.orm.blockchain import TokenOperation
 from utils.orm.filter import Filter
@@ -74,9 +73,7 @@ def add_routes(app):
                 email_address=email_address, magiclink_issuer=user_data.get('issuer'),
                 public_address=user_data.get('public_address'), firstname=firstname, lastname=lastname)
         else:
-            email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
-            user_account.load({'user_uuid': user_uuid, 'email_hash': email_address_hash, 'deactivated': 0})
-            if user_account.get('user_uuid') is None:
+            if user_account.load_by_email(email_address, {'user_uuid': user_uuid, 'deactivated': 0}) is False:
                 return http_error_401()
             status, http_code, message = user_account.update_account(public_address=user_data.get('public_address'),
                                                                      magiclink_issuer=user_data.get('issuer'),
@@ -549,12 +546,19 @@ def add_routes(app):
         """
         user_uuid = get_jwt_identity().get('user_uuid')
 
+        try:
+            page_size, cursor = get_pagination()
+        except ValueError:
+            return http_error_400(message="error_invalid_pagination")
+
         beneficiary = Beneficiary()
-        status, http_code, message, beneficiaries = beneficiary.get_beneficiaries(user_uuid=user_uuid)
+        status, http_code, message, beneficiaries, next_cursor = beneficiary.get_beneficiaries(
+            user_uuid=user_uuid, page_size=page_size, cursor=cursor)
         json_data = {
             'status': status,
             'message': message,
-            'beneficiaries': beneficiaries
+            'beneficiaries': beneficiaries,
+            'next_cursor': next_cursor
         }
         return make_response(jsonify(json_data), http_code)
 
@@ -757,13 +761,25 @@ def add_routes(app):
         user_purchase = UserPurchase()
         filter_purchase = Filter()
         filter_purchase.add('user_uuid', user_uuid)
-        purchase_list = user_purchase.list(fields=['user_purchase_uuid', 'nb_token', 'total_price_eur', 'reference',
-                                                   'amount_received', 'payment_date', 'tx_hash', 'created_date'],
-                                           filter_object=filter_purchase, order='created_date', asc='DESC')
+        fields = ['user_purchase_uuid', 'nb_token', 'total_price_eur', 'reference', 'amount_received', 'payment_date',
+                  'tx_hash', 'created_date']
+        next_cursor = None
+        try:
+            page_size, cursor = get_pagination()
+            if page_size is None:
+                purchase_list = user_purchase.list(fields=fields, filter_object=filter_purchase, order='created_date',
+                                                   asc='DESC')
+            else:
+                purchase_list, next_cursor = user_purchase.list_page(fields=fields, filter_object=filter_purchase,
+                                                                     order='created_date', asc='DESC',
+                                                                     page_size=page_size, after=cursor)
+        except ValueError:
+            return http_error_400(message="error_invalid_pagination")
         json_data = {
             'status': True,
             'message': "success_purchase",
-            'orders': purchase_list
+            'orders': purchase_list,
+            'next_cursor': next_cursor
         }
         return make_response(jsonify(json_data), 200)
 
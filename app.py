@@ -7,8 +7,13 @@ from logging.handlers import TimedRotatingFileHandler
 from dotenv import load_dotenv
 from os import environ as env
 
+from utils import settings
+from utils.api import http_error_503
 from utils.log import Logger
+from utils.orm.abstract import reset_read_routing
+from utils.orm.instrumentation import start_request, request_stats
 from utils.redis_db import Redis
+from utils.security import PasswordHashOverloaded
 from api_routes import admin, user
 from flask import Flask
 # from flask_cors import CORS
@@ -105,6 +110,42 @@ def my_invalid_token_callback(invalid_token):
     return make_response(jsonify({'status': False, 'message': "error_invalid"}), 401)
 
 
+@app.before_request
+def read_routing():
+    """
+    Send the reads of the request to the replicas until it writes
+    :return:
+    """
+    reset_read_routing()
+
+
+@app.before_request
+def query_counters():
+    """
+    Count the SQL statements of the request from zero, the slow query log names its route
+    :return:
+    """
+    start_request(request.endpoint)
+
+
+@app.after_request
+def query_timing(response):
+    """
+    Summarize the SQL statements of the request in a Server-Timing header when APP_QUERY_TIMING_HEADER is set
+    :return:
+    """
+    if settings.get('APP_QUERY_TIMING_HEADER') == '1':
+        stats = request_stats()
+        response.headers['Server-Timing'] = 'db;desc="{0} queries";dur={1}'.format(stats['count'], stats['duration'])
+    return response
+
+
+# Shed the requests needing a password hash when too many requests wait for a worker
+@app.errorhandler(PasswordHashOverloaded)
+def password_hash_overloaded_callback(error):
+    return http_error_503()
+
+
 @app.before_request
 def clear_trailing():
     """
@@ -0,0 +1,62 @@
+"""
+Serial versus process pool decryption of result sets, to choose APP_BULK_DECRYPT_THRESHOLD and
+APP_BULK_DECRYPT_WORKERS on the production hardware.
+
+Usage: python -m benchmarks.bulk_decrypt [--workers 4] [--fields 5] [--rows 100 1000 5000]
+"""
+import argparse
+
+from cryptography.fernet import Fernet
+from time import perf_counter
+
+from utils.orm.encryption import bulk_decrypt
+
+
+def timed(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        function()
+        duration = perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help="number of worker processes")
+    parser.add_argument('--fields', type=int, default=5, help="encrypted fields per row (5 for user accounts)")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 250, 500, 1000, 2500, 5000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    fernet = Fernet(key)
+    # start the workers and warm up both paths before measuring, as done once per uwsgi process
+    warm_up = [fernet.encrypt(b'warm-up').decode()] * args.workers * 100
+    bulk_decrypt(warm_up, key, fernet, workers=1)
+    bulk_decrypt(warm_up, key, fernet, workers=args.workers, threshold=1)
+
+    print("{0:>8} {1:>8} {2:>12} {3:>12} {4:>8}".format('rows', 'tokens', 'serial ms', 'pool ms', 'speedup'))
+    crossover = None
+    for nb_rows in args.rows:
+        tokens = [fernet.encrypt('john.doe.{0}@example.com'.format(i).encode()).decode()
+                  for i in range(nb_rows * args.fields)]
+        serial = timed(lambda: bulk_decrypt(tokens, key, fernet, workers=1), args.repeat)
+        pool = timed(lambda: bulk_decrypt(tokens, key, fernet, workers=args.workers, threshold=1), args.repeat)
+        # the crossover is the smallest size from which the pool stays faster
+        if pool < serial:
+            crossover = crossover or len(tokens)
+        else:
+            crossover = None
+        print("{0:>8} {1:>8} {2:>12.1f} {3:>12.1f} {4:>7.2f}x".format(nb_rows, len(tokens), serial * 1000,
+                                                                      pool * 1000, serial / pool))
+    if crossover is None:
+        print("The process pool is not faster on this host, disable it with APP_BULK_DECRYPT_WORKERS=1")
+    else:
+        print("Crossover at about {0} tokens, set APP_BULK_DECRYPT_THRESHOLD accordingly".format(crossover))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Attribute access and row materialization of the models with the column descriptors (Field) compared to the former
+Abstract.__getattribute__ override, reproduced below.
+
+Usage: python -m benchmarks.field_access [--number 200000]
+"""
+import argparse
+
+from timeit import timeit
+
+from utils.orm.abstract import Abstract, utc_now
+
+COLUMNS = ['user_uuid', 'firstname', 'lastname', 'birthdate', 'email', 'email_hash', 'email_validated', 'selfie',
+           'otp_token', 'otp_expiration', 'public_address', 'magiclink_issuer', 'kyc_session_id', 'kyc_status',
+           'kyc_status_date', 'last_login', 'creator_id', 'created_date', 'updated_date', 'deactivated',
+           'deactivated_date']
+DEFAULTS = {'created_date': utc_now, 'email_validated': 0, 'deactivated': 0}
+
+
+class Entry(Abstract):
+    __slots__ = ()
+
+    _table = 'user_account'
+    _columns = COLUMNS
+    _primary_key = ['user_uuid']
+    _defaults = DEFAULTS
+
+
+class LegacyEntry(Abstract):
+    """
+    Same model without the descriptors, attribute lookups go through the former __getattribute__ override
+    """
+    __slots__ = ()
+
+    _table = 'user_account'
+    _primary_key = ['user_uuid']
+    _defaults = DEFAULTS
+
+    def __getattribute__(self, key):
+        try:
+            return object.__getattribute__(self, key)
+        except AttributeError:
+            pass
+
+        if key in self._data:
+            return self._data[key]
+        elif key in self._defaults:
+            return self._default(key)
+
+        raise AttributeError("'{0}' object has no attribute '{1}'".format(self.__class__.__name__, key))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=200000, help="iterations of each measure")
+    args = parser.parse_args()
+
+    row = {column: '{0}-value'.format(column) for column in COLUMNS}
+    rows = [dict(row, user_uuid=str(index)) for index in range(100)]
+    measures = [
+        ("column attribute (entry.email)", lambda entry: entry.email),
+        ("default attribute (entry.deactivated)", lambda entry: entry.deactivated),
+        ("get('email')", lambda entry: entry.get('email')),
+        ("set('kyc_status', ...)", lambda entry: entry.set('kyc_status', 'APPROVED')),
+        ("method lookup (entry.get)", lambda entry: entry.get),
+    ]
+
+    print("{0:<40} {1:>12} {2:>12} {3:>8}".format('', 'before ns', 'after ns', 'speedup'))
+    for name, function in measures:
+        results = []
+        for model in [LegacyEntry, Entry]:
+            entry = model(row)
+            results.append(timeit(lambda: function(entry), number=args.number) / args.number * 1e9)
+        print("{0:<40} {1:>12.0f} {2:>12.0f} {3:>7.2f}x".format(name, results[0], results[1], results[0] / results[1]))
+
+    # build 100 entries from rows and read 3 columns of each, as done by the routes
+    number = max(1, args.number // 100)
+    results = []
+    for model in [LegacyEntry, Entry]:
+        def materialize():
+            for current_row in rows:
+                entry = model(current_row)
+                entry.user_uuid, entry.email, entry.kyc_status
+        results.append(timeit(materialize, number=number) / number * 1e6)
+    print("{0:<40} {1:>12.0f} {2:>12.0f} {3:>7.2f}x".format("materialize 100 rows (us)", results[0], results[1],
+                                                            results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Cost of the main ORM operations on user accounts, run on the SQLite backend so that it needs no MySQL server.
+The absolute numbers are not the ones of production (no network round trip), compare runs before and after a change.
+
+Usage: python -m benchmarks.orm_queries [--users 5000] [--number 2000] [--database :memory:]
+"""
+import argparse
+import os
+
+from time import perf_counter
+
+from utils.orm.backend import set_backend
+from utils.orm.filter import Filter
+from utils.orm.sqlite import SQLiteBackend
+
+
+def timed(function, number):
+    start = perf_counter()
+    for i in range(number):
+        function(i)
+    return (perf_counter() - start) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000, help="number of user accounts in the table")
+    parser.add_argument('--number', type=int, default=2000, help="iterations of each measure")
+    parser.add_argument('--database', default=':memory:', help="SQLite database file")
+    args = parser.parse_args()
+
+    # the models only need the keys, not the settings of conf/lifise-api.env
+    os.environ.setdefault('APP_DB_KEY', 'benchmark-key-benchmark-key-1234')
+    os.environ.setdefault('APP_BLIND_INDEX_KEY', 'benchmark-blind-index-key')
+    from utils.orm.abstract import transaction
+    from utils.orm.user import UserAccount
+
+    backend = SQLiteBackend(args.database)
+    backend.create_tables()
+    set_backend(backend)
+
+    with transaction():
+        UserAccount().insert_many([{
+            'user_uuid': 'user-{0}'.format(index),
+            'firstname': 'John',
+            'lastname': 'Doe {0}'.format(index),
+            'email': 'john.doe.{0}@example.com'.format(index),
+            'kyc_status': 'APPROVED' if index % 3 == 0 else None,
+            'created_date': '2023-01-01T00:00:{0:02d}.000000Z'.format(index % 60)
+        } for index in range(args.users)])
+
+    def load(i):
+        UserAccount().load({'user_uuid': 'user-{0}'.format(i % args.users)})
+
+    def load_by_email(i):
+        UserAccount().load({'email': 'john.doe.{0}@example.com'.format(i % args.users)})
+
+    def update(i):
+        user_account = UserAccount()
+        user_account.load({'user_uuid': 'user-{0}'.format(i % args.users)})
+        user_account.set('kyc_status', 'PENDING_VERIFICATION')
+        user_account.update()
+
+    def count(i):
+        filter_user = Filter()
+        filter_user.add('kyc_status', 'APPROVED')
+        UserAccount().count(filter_object=filter_user)
+
+    def list_page(i):
+        filter_user = Filter()
+        filter_user.add('deactivated', 0)
+        UserAccount().list_page(fields=['user_uuid', 'email', 'kyc_status'], filter_object=filter_user,
+                                order='created_date', page_size=50)
+
+    measures = [
+        ("load by primary key", load),
+        ("load by email (blind index)", load_by_email),
+        ("load and update one column", update),
+        ("count with filter", count),
+        ("page of 50 users", list_page),
+    ]
+    print("{0} users in {1}".format(args.users, args.database))
+    print("{0:<40} {1:>12}".format('', 'us / call'))
+    for name, function in measures:
+        print("{0:<40} {1:>12.1f}".format(name, timed(function, args.number)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+The tests run the models on the SQLite backend (utils/orm/sqlite.py): they need neither a MySQL server nor
+conf/lifise-api.env. Run them with: python3 -m pipenv run pytest
+"""
+import os
+
+import pytest
+
+from flask import Flask
+
+os.environ.setdefault('APP_DB_KEY', 'test-database-key-test-database-')
+os.environ.setdefault('APP_DB_HASH_SALT', 'test-salt')
+os.environ.setdefault('APP_BLIND_INDEX_KEY', 'test-blind-index-key')
+os.environ.setdefault('ADMIN_WALLET_PUBLIC_KEY', '0x0000000000000000000000000000000000000001')
+
+from utils.orm.abstract import reset_read_routing  # noqa: E402
+from utils.orm.backend import set_backend  # noqa: E402
+from utils.orm.instrumentation import start_request  # noqa: E402
+from utils.orm.sqlite import SQLiteBackend  # noqa: E402
+from utils.orm.user import UserAccount  # noqa: E402
+
+_app = Flask(__name__)
+
+
+@pytest.fixture(autouse=True)
+def backend():
+    """
+    Empty database with all the tables and indexes, used by all the models during the test
+    """
+    backend = SQLiteBackend(':memory:')
+    backend.create_tables()
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+
+
+@pytest.fixture(autouse=True)
+def request_context():
+    """
+    Each test runs as a request: its own identity map (on g), statement counters and read routing
+    """
+    reset_read_routing()
+    with _app.app_context():
+        start_request('test')
+        yield
+
+
+@pytest.fixture
+def add_users():
+    """
+    Insert the users user-0 to user-<number - 1>, created in this order
+    """
+    def add(number):
+        rows = [{
+            'user_uuid': 'user-{0}'.format(index),
+            'email': 'user.{0}@example.com'.format(index),
+            'lastname': 'Doe',
+            'created_date': '2024-01-01T00:00:{0:02d}.000000Z'.format(index)
+        } for index in range(number)]
+        UserAccount().insert_many(rows)
+        return rows
+    return add
@@ -0,0 +1,35 @@
+import pytest
+
+from utils.orm.blockchain import TokenOperation
+from utils.orm.user import UserAccount, UserPurchase
+
+
+def test_aggregate_totals(add_users):
+    add_users(2)
+    for nb_token in [10, 20]:
+        UserPurchase().add_order(user_uuid='user-0', nb_token=nb_token)
+
+    totals = UserPurchase().get_purchases_totals(['user-0', 'user-1'])
+    assert totals['user-0']['nb_orders'] == 2 and totals['user-0']['nb_token'] == 30.0
+    assert totals['user-1']['nb_orders'] == 0
+
+
+def test_count_operations_per_sender_and_receiver():
+    operation = {'sender_address': '0x1', 'receiver_address': '0x2', 'token': TokenOperation.EUROLFS, 'nb_token': 1}
+    TokenOperation().add_operations([dict(operation, sender_uuid='user-0', receiver_uuid='user-1'),
+                                     dict(operation, sender_uuid='user-0', receiver_uuid='user-1'),
+                                     dict(operation, receiver_uuid='user-0')])
+
+    assert TokenOperation().count_operations(['user-0', 'user-1', 'user-2']) == {
+        'user-0': {'nb_sent': 2, 'nb_received': 1},
+        'user-1': {'nb_sent': 0, 'nb_received': 2},
+        'user-2': {'nb_sent': 0, 'nb_received': 0}
+    }
+
+
+def test_aggregate_refuses_the_encrypted_columns():
+    with pytest.raises(ValueError):
+        UserAccount().aggregate(fields={'last': ('MAX', 'lastname')})
+    with pytest.raises(ValueError):
+        UserAccount().aggregate(fields={'nb': ('COUNT', '*')}, group_by=['email'])
+    assert UserAccount().aggregate(fields={'nb': ('COUNT', '*')}) == [{'nb': 0}]
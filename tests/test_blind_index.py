@@ -0,0 +1,46 @@
+from utils.orm.filter import Filter, OperatorType
+from utils.orm.user import UserAccount
+from utils.security import generate_blind_index
+
+
+def test_encrypted_columns_are_found_by_their_blind_index(backend, add_users):
+    add_users(2)
+    with backend.connection() as connection:
+        stored = connection.execute("SELECT `email`, `email_index` FROM `user_account` "
+                                    "WHERE `user_uuid` = 'user-1'").fetchone()
+    assert stored['email'] != 'user.1@example.com'
+    assert stored['email_index'] == generate_blind_index('user.1@example.com')
+
+    user_account = UserAccount()
+    assert user_account.load({'email': 'user.1@example.com'}) is True
+    assert user_account.get('user_uuid') == 'user-1'
+    assert user_account.get('lastname') == 'Doe'
+
+
+def test_filters_on_an_encrypted_column_use_its_blind_index(add_users):
+    add_users(3)
+    UserAccount().update_where(Filter(data={'user_uuid': 'user-1'}), {'public_address': '0xabc'})
+    user_account = UserAccount()
+    user_account.load({'user_uuid': 'user-1'})
+    user_account.set('public_address', '0xdef')
+    user_account.update()
+
+    filter_user = Filter()
+    filter_user.add('email', ['user.0@example.com', 'user.2@example.com'], operator=OperatorType.IIN)
+    users = UserAccount().list(fields=['user_uuid'], filter_object=filter_user, order='user_uuid')
+    assert [user['user_uuid'] for user in users] == ['user-0', 'user-2']
+    assert UserAccount().search_user(public_address='0xabc') == (False, 200, "success_no_user")
+    assert UserAccount().search_user(public_address='0xdef') == (True, 200, "success_user_found")
+
+
+def test_backfill_writes_the_missing_blind_indexes(add_users):
+    add_users(3)
+    # entries created before the index column
+    filter_user = Filter()
+    filter_user.add('user_uuid', ['user-0', 'user-1'], operator=OperatorType.IIN)
+    UserAccount().update_where(filter_user, {'email_index': None})
+    assert UserAccount().load({'email': 'user.0@example.com'}) is False
+
+    assert UserAccount().backfill_blind_index('email', batch_size=1) == 2
+    assert UserAccount().load({'email': 'user.0@example.com'}) is True
+    assert UserAccount().backfill_blind_index('email') == 0
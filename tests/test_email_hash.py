@@ -0,0 +1,75 @@
+import pytest
+
+from utils import security
+from utils.security import generate_email_hash, generate_hash
+
+
+class FakeRedis(object):
+    """
+    Redis db shared by the processes, failing when down is set
+    """
+    def __init__(self):
+        self.values = {}
+        self.down = False
+
+    def get(self, key):
+        if self.down:
+            raise ConnectionError("redis unreachable")
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        if self.down:
+            raise ConnectionError("redis unreachable")
+        self.values[key] = value
+
+
+@pytest.fixture
+def hashes(monkeypatch):
+    """
+    Addresses hashed by PBKDF2 during the test, with empty caches
+    """
+    hashed = []
+
+    def counting_hash(data_to_hash, salt=None):
+        hashed.append(data_to_hash)
+        return generate_hash(data_to_hash, salt)
+
+    monkeypatch.setattr(security, 'generate_hash', counting_hash)
+    monkeypatch.setattr(security, '_email_hashes', security.OrderedDict())
+    return hashed
+
+
+def test_email_hash_is_computed_once_per_process(monkeypatch, hashes):
+    monkeypatch.setenv('APP_EMAIL_HASH_CACHE_SIZE', '2')
+    email_hash = generate_email_hash('user.0@example.com')
+    assert email_hash == generate_hash('user.0@example.com', security.env['APP_DB_HASH_SALT'])[0]
+    assert generate_email_hash('user.0@example.com') == email_hash
+    assert hashes == ['user.0@example.com']
+    # the cache never holds the address in clear
+    assert 'user.0@example.com' not in security._email_hashes
+
+    generate_email_hash('user.1@example.com')
+    generate_email_hash('user.0@example.com')
+    # user.1 is the least recently used entry
+    generate_email_hash('user.2@example.com')
+    generate_email_hash('user.0@example.com')
+    generate_email_hash('user.1@example.com')
+    assert hashes == ['user.0@example.com', 'user.1@example.com', 'user.2@example.com', 'user.1@example.com']
+
+
+def test_email_hash_is_shared_through_redis(monkeypatch, hashes):
+    redis_db = FakeRedis()
+    monkeypatch.setattr(security, '_email_hash_redis', lambda: redis_db)
+    email_hash = generate_email_hash('user.0@example.com')
+    assert list(redis_db.values.values()) == [email_hash]
+
+    # another process finds the hash in Redis
+    monkeypatch.setattr(security, '_email_hashes', security.OrderedDict())
+    assert generate_email_hash('user.0@example.com') == email_hash
+    assert hashes == ['user.0@example.com']
+
+    # Redis down: the hash is computed
+    redis_db.down = True
+    assert generate_email_hash('user.1@example.com') == generate_hash('user.1@example.com',
+                                                                      security.env['APP_DB_HASH_SALT'])[0]
+    assert hashes == ['user.0@example.com', 'user.1@example.com']
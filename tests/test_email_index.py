@@ -0,0 +1,26 @@
+from utils.orm.filter import Filter
+from utils.orm.user import UserAccount
+from utils.security import generate_email_hash
+
+
+def test_accounts_are_found_by_their_email_hash_until_backfilled(monkeypatch):
+    monkeypatch.setenv('APP_TOKEN_DELAY', '600')
+    # account created before the email_index column
+    UserAccount().insert_many([{'user_uuid': 'user-0', 'email': 'user.0@example.com',
+                                'email_hash': generate_email_hash('user.0@example.com')}])
+    filter_user = Filter()
+    filter_user.add('user_uuid', 'user-0')
+    UserAccount().update_where(filter_user, {'email_index': None})
+    assert UserAccount().exists_by_email('user.0@example.com') is True
+
+    assert UserAccount().load_by_email('user.0@example.com') is True
+    # the lookup by email_hash wrote the missing email_index
+    assert UserAccount().list(fields=['email_index'])[0]['email_index'] is not None
+
+    monkeypatch.setenv('APP_EMAIL_INDEX_MODE', 'index')
+    assert UserAccount().register('user.1@example.com')[:3] == (True, 200, "success_user_register")
+    hashes = [user['email_hash'] for user in UserAccount().list(fields=['email_hash'])]
+    assert hashes.count(None) == 1
+    found = UserAccount().list_by_emails(['user.0@example.com', 'user.1@example.com', 'user.2@example.com'],
+                                         fields=['user_uuid'])
+    assert sorted(found.keys()) == ['user.0@example.com', 'user.1@example.com']
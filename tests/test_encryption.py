@@ -0,0 +1,106 @@
+import json
+
+from os import getpid
+
+import pytest
+
+from utils.orm import encryption
+from utils.orm.encryption import LazyRow, bulk_decrypt, decrypt_rows, get_cipher
+from utils.orm.user import UserAccount
+
+
+class CountingFernet(object):
+    """
+    Fernet counting its decryptions
+    """
+    def __init__(self):
+        self.fernet = get_cipher()[1]
+        self.decrypted = 0
+
+    def encrypt(self, data):
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, token):
+        self.decrypted += 1
+        return self.fernet.decrypt(token)
+
+
+def lazy_row(fernet):
+    stored = {'user_uuid': 'user-0', 'email': fernet.encrypt(b'user.0@example.com').decode(),
+              'lastname': fernet.encrypt(b'Doe').decode(), 'firstname': None}
+    return LazyRow(stored, fernet, ('email', 'lastname', 'firstname'))
+
+
+def test_lazy_row_decrypts_a_column_when_it_is_read():
+    fernet = CountingFernet()
+    row = lazy_row(fernet)
+    assert list(row) == ['user_uuid', 'email', 'lastname', 'firstname'] and 'email' in row
+    assert row['user_uuid'] == 'user-0' and row.get('firstname') is None and row.get('unknown', 1) == 1
+    assert fernet.decrypted == 0
+
+    assert row['email'] == 'user.0@example.com' and row.get('email') == 'user.0@example.com'
+    assert fernet.decrypted == 1
+
+    copy = row.copy()
+    row['lastname'] = 'Smith'
+    assert fernet.decrypted == 1
+    assert json.loads(json.dumps(copy)) == {'user_uuid': 'user-0', 'email': 'user.0@example.com', 'lastname': 'Doe',
+                                            'firstname': None}
+    assert fernet.decrypted == 2
+
+
+def test_lazy_row_decrypts_everything_when_iterated():
+    fernet = CountingFernet()
+    assert dict(lazy_row(fernet).items()) == {'user_uuid': 'user-0', 'email': 'user.0@example.com',
+                                              'lastname': 'Doe', 'firstname': None}
+    assert lazy_row(fernet) == lazy_row(fernet) and dict(lazy_row(fernet))['lastname'] == 'Doe'
+    assert {**lazy_row(fernet)}['email'] == 'user.0@example.com'
+
+
+def test_lists_decrypt_the_selected_columns_only(add_users):
+    add_users(2)
+    users = UserAccount().list(fields=['user_uuid', 'email'], order='user_uuid')
+    assert all(isinstance(user, LazyRow) for user in users)
+    assert [user.get('email') for user in users] == ['user.0@example.com', 'user.1@example.com']
+    assert 'lastname' not in users[0]
+
+    users = UserAccount().list(fields=['user_uuid', 'lastname'], order='user_uuid', decrypt_all=True)
+    assert users == [{'user_uuid': 'user-0', 'lastname': 'Doe'}, {'user_uuid': 'user-1', 'lastname': 'Doe'}]
+
+
+@pytest.fixture
+def decrypt_pool():
+    """
+    Decryption pool of the test, shut down at the end
+    """
+    yield
+    pool = encryption._decrypt_pool
+    encryption._decrypt_pool = None
+    if pool is not None and pool[1] is not None:
+        pool[1].shutdown()
+
+
+def test_bulk_decrypt_spreads_the_tokens_over_the_pool(decrypt_pool):
+    key, fernet = get_cipher()
+    plaintexts = ['value-{0}'.format(index) for index in range(40)]
+    tokens = [fernet.encrypt(plaintext.encode()).decode() for plaintext in plaintexts]
+
+    assert bulk_decrypt(tokens, key, fernet, workers=2, threshold=10) == plaintexts
+    assert encryption._decrypt_pool[1] is not None
+    # below the threshold the tokens are decrypted by the process
+    assert bulk_decrypt(tokens[:5], key, fernet, workers=2, threshold=10) == plaintexts[:5]
+
+
+def test_bulk_decrypt_is_serial_once_the_pool_failed(monkeypatch, decrypt_pool):
+    monkeypatch.setenv('APP_BULK_DECRYPT_PYTHON', '/nonexistent/python3')
+    key, fernet = get_cipher()
+    rows = [{'user_uuid': 'user-{0}'.format(index), 'email': fernet.encrypt(b'user@example.com').decode(),
+             'lastname': None} for index in range(20)]
+    monkeypatch.setenv('APP_BULK_DECRYPT_WORKERS', '2')
+    monkeypatch.setenv('APP_BULK_DECRYPT_THRESHOLD', '10')
+
+    rows = decrypt_rows(rows, ('email', 'lastname'), key, fernet)
+    assert rows[19] == {'user_uuid': 'user-19', 'email': 'user@example.com', 'lastname': None}
+    assert encryption._decrypt_pool == (getpid(), None)
+    tokens = [fernet.encrypt(b'value').decode()] * 10
+    assert bulk_decrypt(tokens, key, fernet) == ['value'] * 10
@@ -0,0 +1,74 @@
+import pytest
+
+from utils.orm.filter import Filter, OperatorType, compile_shape
+from utils.orm.user import UserPurchase
+
+
+def test_nested_groups_compile_to_parameterized_sql():
+    kyc = Filter(OperatorType.OR)
+    kyc.add('kyc_status', operator=OperatorType.IN)
+    kyc.add('kyc_status', ['REJECTED', 'PENDING'], operator=OperatorType.IIN)
+    filter_user = Filter()
+    filter_user.add('deactivated', '0')
+    filter_user.add('created_date', ['2024-01-01', '2024-12-31'], operator=OperatorType.BETWEEN)
+    filter_user.add_group(kyc)
+    filter_user.add('email', operator=OperatorType.INN)
+
+    assert filter_user.get() == (
+        "`deactivated` = %s AND `created_date` BETWEEN %s AND %s AND (`kyc_status` IS NULL OR `kyc_status` IN (%s, %s))"
+        " AND `email` IS NOT NULL",
+        ['0', '2024-01-01', '2024-12-31', 'REJECTED', 'PENDING'])
+    assert filter_user.get(nested_data=True)[0] == \
+        "`deactivated` = '0' AND `created_date` BETWEEN '2024-01-01' AND '2024-12-31' AND (`kyc_status` IS NULL OR " \
+        "`kyc_status` IN ('REJECTED', 'PENDING')) AND `email` IS NOT NULL"
+
+
+def test_filters_are_compiled_once_per_shape():
+    filter_user = Filter()
+    filter_user.add('user_uuid', ['user-0', 'user-1'], operator=OperatorType.IIN)
+    filter_user.get()
+    hits = compile_shape.cache_info().hits
+
+    # same columns, operators and number of values
+    filter_other = Filter()
+    filter_other.add('user_uuid', ['user-2', 'user-3'], operator=OperatorType.IIN)
+    assert filter_other.get() == ('`user_uuid` IN (%s, %s)', ['user-2', 'user-3'])
+    assert compile_shape.cache_info().hits == hits + 1
+
+
+def test_empty_lists():
+    filter_in = Filter()
+    filter_in.add('user_uuid', [], operator=OperatorType.IIN)
+    filter_not_in = Filter()
+    filter_not_in.add('user_uuid', [], operator=OperatorType.NIN)
+    assert filter_in.get() == ('1 = 0', []) and filter_not_in.get() == ('1 = 1', [])
+
+
+@pytest.mark.parametrize('key, value, operator', [
+    ('user_uuid; DROP TABLE user_account', 'user-0', OperatorType.EQ),
+    ('user_uuid', None, OperatorType.EQ),
+    ('user_uuid', '', OperatorType.EQ),
+    ('user_uuid', 'user-0', OperatorType.IIN),
+    ('created_date', ['2024-01-01'], OperatorType.BETWEEN),
+    ('created_date', ['2024-01-01', None], OperatorType.BETWEEN),
+    ('user_uuid', 'user-0', 'UNKNOWN')
+])
+def test_invalid_conditions(key, value, operator):
+    with pytest.raises(ValueError):
+        Filter().add(key, value, operator=operator)
+
+
+def test_filters_select_the_entries(add_users):
+    add_users(2)
+    for nb_token in [5, 10, 20]:
+        UserPurchase().add_order(user_uuid='user-0', nb_token=nb_token)
+    UserPurchase().add_order(user_uuid='user-1', nb_token=50)
+
+    amounts = Filter(OperatorType.OR)
+    amounts.add('nb_token', [8, 12], operator=OperatorType.BETWEEN)
+    amounts.add('nb_token', 40, operator=OperatorType.GT)
+    filter_purchase = Filter()
+    filter_purchase.add('user_uuid', ['user-0', 'user-1'], operator=OperatorType.IIN)
+    filter_purchase.add_group(amounts)
+    purchases = UserPurchase().list(fields=['nb_token'], filter_object=filter_purchase, order='nb_token')
+    assert [purchase['nb_token'] for purchase in purchases] == [10, 50]
@@ -0,0 +1,29 @@
+from utils.orm.filter import Filter
+from utils.orm.instrumentation import request_stats
+from utils.orm.user import UserAccount
+
+
+def test_identity_map_reads_an_entry_once_per_request(add_users):
+    add_users(1)
+    UserAccount().load({'user_uuid': 'user-0'})
+    count = request_stats()['count']
+
+    user_account = UserAccount()
+    assert user_account.load({'user_uuid': 'user-0'}) is True
+    assert request_stats()['count'] == count
+
+    user_account.set('kyc_status', 'APPROVED')
+    user_account.update()
+    user_account = UserAccount()
+    user_account.load({'user_uuid': 'user-0'})
+    assert user_account.get('kyc_status') == 'APPROVED'
+
+    # a set-based write drops the entries of the table
+    filter_user = Filter()
+    filter_user.add('user_uuid', 'user-0')
+    UserAccount().update_where(filter_user, {'kyc_status': 'REJECTED'})
+    count = request_stats()['count']
+    user_account = UserAccount()
+    user_account.load({'user_uuid': 'user-0'})
+    assert request_stats()['count'] == count + 1
+    assert user_account.get('kyc_status') == 'REJECTED'
@@ -0,0 +1,34 @@
+from utils.orm.blockchain import TokenOperation
+from utils.orm.instrumentation import request_stats
+from utils.orm.user import TokenClaim
+
+
+def test_insert_many_returns_the_keys_in_the_order_of_the_rows():
+    rows = [{'token_operation_uuid': 'operation-{0}'.format(index), 'receiver_uuid': 'user-0',
+             'sender_address': '0x1', 'receiver_address': '0x2', 'token': TokenOperation.EUROLFS, 'nb_token': index}
+            for index in range(5)]
+    assert TokenOperation().insert_many(rows[:3]) == [{'token_operation_id': 1}, {'token_operation_id': 2},
+                                                      {'token_operation_id': 3}]
+    assert TokenOperation().insert_many(rows[3:], chunk_size=1) == [{'token_operation_id': 4},
+                                                                    {'token_operation_id': 5}]
+
+    operations = TokenOperation().list(fields=['token_operation_id', 'nb_token'], order='token_operation_id')
+    assert [(operation['token_operation_id'], operation['nb_token']) for operation in operations] == \
+        [(index + 1, index) for index in range(5)]
+
+
+def test_insert_many_groups_the_rows_by_columns(add_users):
+    add_users(1)
+    count = request_stats()['count']
+    rows = [{'token_claim_uuid': 'claim-0', 'user_uuid': 'user-0', 'nb_token': 1},
+            {'token_claim_uuid': 'claim-1', 'user_uuid': 'user-0', 'nb_token': 2, 'creator_id': 'admin-0'},
+            {'token_claim_uuid': 'claim-2', 'user_uuid': 'user-0', 'nb_token': 3}]
+    assert TokenClaim().insert_many(rows) == [{'token_claim_uuid': 'claim-{0}'.format(index)} for index in range(3)]
+    # one statement per set of columns
+    assert request_stats()['count'] == count + 2
+
+    claims = TokenClaim().list(fields=['token_claim_uuid', 'creator_id', 'claimed', 'created_date'],
+                               order='token_claim_uuid')
+    assert [claim['creator_id'] for claim in claims] == [None, 'admin-0', None]
+    # the rows are completed with the defaults of the model
+    assert all(claim['claimed'] == 0 and claim['created_date'] is not None for claim in claims)
@@ -0,0 +1,83 @@
+import logging
+
+import pytest
+
+from utils.orm import instrumentation
+from utils.orm.instrumentation import (query_shape, query_stats, record_query, request_stats, reset_query_stats,
+                                       start_request)
+from utils.orm.user import UserAccount
+
+
+@pytest.fixture
+def stats():
+    reset_query_stats()
+    yield
+    reset_query_stats()
+
+
+@pytest.mark.parametrize('query, shape', [
+    ("SELECT * FROM `user_account` WHERE `user_uuid` = %s LIMIT 10",
+     "SELECT * FROM `user_account` WHERE `user_uuid` = ? LIMIT ?"),
+    ("SELECT * FROM `user_account` WHERE `email_hash` = 'a\\'b' AND `deactivated` = -1",
+     "SELECT * FROM `user_account` WHERE `email_hash` = ? AND `deactivated` = ?"),
+    ("SELECT  `nb_token`\n FROM `token_claim` WHERE `user_uuid` IN (%s, %s,%s)",
+     "SELECT `nb_token` FROM `token_claim` WHERE `user_uuid` IN (?)"),
+    ("SELECT `token1` FROM `table2` WHERE `amount` > 1.5", "SELECT `token1` FROM `table2` WHERE `amount` > ?")
+])
+def test_query_shape(query, shape):
+    assert query_shape(query) == shape
+
+
+def test_statements_are_counted_per_request(add_users):
+    start_request('test')
+    add_users(2)
+    UserAccount().list(fields=['user_uuid'])
+    assert request_stats()['count'] == 2
+
+    start_request('next')
+    assert request_stats() == {'count': 0, 'duration': 0.0}
+
+
+def test_statements_are_aggregated_per_shape(stats):
+    record_query("SELECT * FROM `user_account` WHERE `user_uuid` IN (%s, %s)", 2, 4.0)
+    record_query("SELECT * FROM `user_account` WHERE `user_uuid` IN (%s)", 1, 2.0)
+    record_query("SELECT * FROM `token_claim` WHERE `user_uuid` = %s", 1, 10.0)
+
+    queries = query_stats()['queries']
+    assert [(query['shape'], query['count'], query['total_ms'], query['max_ms'], query['avg_ms'])
+            for query in queries] == [
+        ("SELECT * FROM `token_claim` WHERE `user_uuid` = ?", 1, 10.0, 10.0, 10.0),
+        ("SELECT * FROM `user_account` WHERE `user_uuid` IN (?)", 2, 6.0, 4.0, 3.0)
+    ]
+    # the first statement of the shape is kept for its query plan
+    assert queries[1]['statement'] == "SELECT * FROM `user_account` WHERE `user_uuid` IN (%s, %s)"
+    assert len(query_stats(limit=1)['queries']) == 1
+
+    reset_query_stats()
+    assert query_stats()['nb_shapes'] == 0
+
+
+def test_shapes_are_bounded(stats, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'MAX_SHAPES', 2)
+    for table in ['table_a', 'table_b', 'table_c', 'table_d']:
+        record_query("SELECT * FROM `{0}`".format(table), 0, 1.0)
+    shapes = {query['shape']: query['count'] for query in query_stats()['queries']}
+    assert shapes == {'SELECT * FROM `table_a`': 1, 'SELECT * FROM `table_b`': 1, '(other)': 2}
+
+
+def test_slow_queries_are_logged_without_their_values(stats, monkeypatch, caplog):
+    monkeypatch.setenv('APP_SLOW_QUERY_MS', '100')
+    start_request('get_user')
+    with caplog.at_level(logging.WARNING):
+        record_query("SELECT * FROM `user_account` WHERE `email_hash` = 'secret'", 0, 99.0)
+        record_query("SELECT * FROM `user_account` WHERE `email_hash` = 'secret'", 0, 150.0)
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert 'Slow query 150.0 ms on get_user' in message and 'secret' not in message
+
+    # 0 disables the log
+    monkeypatch.setenv('APP_SLOW_QUERY_MS', '0')
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        record_query("SELECT 1", 0, 10000.0)
+    assert caplog.records == []
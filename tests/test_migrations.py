@@ -0,0 +1,25 @@
+from utils.orm.migrations import column_changes, table_columns, table_statements
+
+
+class SchemaCursor(object):
+    """
+    Cursor returning the columns of db_structure.sql from information_schema.COLUMNS, as created before the
+    email_index migration: without public_address_index and with email_hash NOT NULL
+    """
+    def execute(self, query, data=None):
+        self.query = query
+
+    def fetchall(self):
+        return [{'name': table, 'col': column,
+                 'nullable': 'NO' if column == 'email_hash' or ' NOT NULL' in definition else 'YES'}
+                for table, statement in table_statements() for column, definition in table_columns(statement)
+                if column != 'public_address_index']
+
+
+def test_column_changes_add_the_missing_columns_and_align_their_nullability():
+    assert column_changes(SchemaCursor()) == [
+        'ALTER TABLE `admin` MODIFY `email_hash` CHAR(128) DEFAULT NULL',
+        'ALTER TABLE `user_account` MODIFY `email_hash` CHAR(128) DEFAULT NULL',
+        'ALTER TABLE `user_account` ADD COLUMN `public_address_index` CHAR(67) DEFAULT NULL AFTER `public_address`'
+    ]
+    assert column_changes(SchemaCursor(), skipped_tables=['admin', 'user_account']) == []
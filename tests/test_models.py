@@ -0,0 +1,42 @@
+import pytest
+
+from utils.orm.abstract import Field
+from utils.orm.encryption import get_cipher
+from utils.orm.admin import AdminAccount
+from utils.orm.user import UserAccount, TokenClaim
+
+
+def test_model_metadata_is_built_once_per_class():
+    assert UserAccount()._meta is UserAccount._meta
+    assert TokenClaim._meta.table == 'token_claim' and TokenClaim._meta.primary_key == ('token_claim_uuid',)
+    assert UserAccount._meta.encrypt_fields == ('firstname', 'lastname', 'birthdate', 'email', 'otp_token',
+                                                'public_address')
+    assert UserAccount._meta.blind_indexes == {'email': 'email_index', 'public_address': 'public_address_index'}
+
+
+def test_instances_only_hold_their_row():
+    user_account = UserAccount({'user_uuid': 'user-0'})
+    assert not hasattr(user_account, '__dict__')
+    with pytest.raises(AttributeError):
+        user_account.extra = 1
+    # one cipher per key, shared by all the models
+    assert user_account.fernet is AdminAccount().fernet is get_cipher()[1]
+
+
+def test_columns_are_read_and_written_as_attributes():
+    assert isinstance(UserAccount.email, Field)
+    user_account = UserAccount({'user_uuid': 'user-0', 'email': 'user.0@example.com'})
+    assert user_account.email == 'user.0@example.com' and user_account.get('email') == 'user.0@example.com'
+    # a column without value returns its default value
+    assert user_account.deactivated == 0
+    with pytest.raises(AttributeError):
+        user_account.lastname
+
+    user_account.mark_clean()
+    user_account.lastname = 'Doe'
+    assert user_account.get('lastname') == 'Doe' and user_account.dirty == {'lastname'}
+
+    # the methods of the model have priority over the columns of the same name
+    assert callable(user_account.kyc_status)
+    # the values of the entry that are not columns (e.g. aliases of a query) are read as attributes too
+    assert UserAccount({'total': 3}).total == 3
@@ -0,0 +1,55 @@
+import pytest
+
+from flask import Flask
+
+from utils.api import get_pagination
+from utils.orm.filter import Filter
+from utils.orm.user import UserAccount
+
+_app = Flask(__name__)
+
+
+def walk(order, asc, page_size):
+    filter_user = Filter()
+    filter_user.add('deactivated', '0')
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = UserAccount().list_page(fields=['user_uuid'], filter_object=filter_user, order=order,
+                                               asc=asc, page_size=page_size, after=cursor)
+        pages.append([user['user_uuid'] for user in page])
+        if cursor is None:
+            return pages
+
+
+def test_list_page_walks_the_whole_list_once(add_users):
+    add_users(7)
+    assert walk('created_date', 'ASC', 3) == [['user-0', 'user-1', 'user-2'], ['user-3', 'user-4', 'user-5'],
+                                              ['user-6']]
+    assert walk('created_date', 'DESC', 4) == [['user-6', 'user-5', 'user-4', 'user-3'],
+                                               ['user-2', 'user-1', 'user-0']]
+    # the primary key orders the entries sharing the same sort value
+    assert walk('deactivated', 'ASC', 5) == [['user-0', 'user-1', 'user-2', 'user-3', 'user-4'], ['user-5', 'user-6']]
+
+    with pytest.raises(ValueError):
+        UserAccount().list_page(order='created_date', after='not-a-cursor')
+    with pytest.raises(ValueError):
+        UserAccount().list_page(order='lastname')
+
+
+@pytest.mark.parametrize('query_string, pagination', [
+    ('', (None, None)),
+    ('page_size=20', (20, None)),
+    ('cursor=abc', (50, 'abc')),
+    ('page_size=10&cursor=abc', (10, 'abc'))
+])
+def test_pagination_arguments(query_string, pagination):
+    with _app.test_request_context('/api/v1/admin/users?{0}'.format(query_string)):
+        assert get_pagination() == pagination
+
+
+@pytest.mark.parametrize('page_size', ['0', '501', 'ten'])
+def test_invalid_page_size(page_size):
+    with _app.test_request_context('/api/v1/admin/users?page_size={0}'.format(page_size)):
+        with pytest.raises(ValueError):
+            get_pagination()
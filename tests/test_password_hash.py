@@ -0,0 +1,48 @@
+import sys
+import types
+
+import pytest
+
+from utils import security
+from utils.security import PasswordHashOverloaded, generate_hash, generate_password_hash, password_hash_stats
+
+
+@pytest.fixture
+def listen_queue(monkeypatch):
+    """
+    uwsgi module whose listen queue holds listen_queue.depth requests
+    """
+    uwsgi = types.ModuleType('uwsgi')
+    uwsgi.depth = 0
+    uwsgi.listen_queue = lambda: uwsgi.depth
+    monkeypatch.setitem(sys.modules, 'uwsgi', uwsgi)
+    monkeypatch.setenv('APP_PASSWORD_HASH_QUEUE', '3')
+    return uwsgi
+
+
+def test_password_hash_is_shed_when_the_listen_queue_is_full(listen_queue):
+    before = password_hash_stats()
+    password_hash, salt = generate_password_hash('password')
+    assert generate_hash('password', salt) == (password_hash, salt)
+
+    listen_queue.depth = 4
+    with pytest.raises(PasswordHashOverloaded):
+        generate_password_hash('password')
+    listen_queue.depth = 3
+    generate_password_hash('password')
+
+    stats = password_hash_stats()
+    assert stats['hashed'] == before['hashed'] + 2 and stats['rejected'] == before['rejected'] + 1
+    assert stats['queue_last'] == 3 and stats['queue_max'] >= 4
+    assert 0 < stats['duration_avg'] <= stats['duration_max']
+
+
+def test_listen_queue_is_empty_outside_uwsgi_only(monkeypatch, listen_queue):
+    def broken():
+        raise RuntimeError("not a uwsgi socket")
+    listen_queue.listen_queue = broken
+    with pytest.raises(RuntimeError):
+        security._listen_queue()
+
+    monkeypatch.setitem(sys.modules, 'uwsgi', None)
+    assert security._listen_queue() == 0
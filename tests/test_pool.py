@@ -0,0 +1,90 @@
+import pymysql
+import pytest
+
+from utils.orm.mysql import ConnectionPool, PoolTimeoutError
+
+
+class FakeConnection(object):
+    """
+    pymysql connection whose ping fails once the server closed it
+    """
+    def __init__(self):
+        self.closed = False
+        self.rolled_back = False
+        self.alive = True
+
+    def ping(self, reconnect=False):
+        if not self.alive:
+            raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(ConnectionPool, '_connect', lambda self: FakeConnection())
+    return ConnectionPool(max_size=2, timeout=0.05, idle_timeout=300, ping_interval=30, host='db', port=3306)
+
+
+def test_pool_reuses_the_released_connections(pool):
+    with pool.connection() as connection:
+        pass
+    with pool.connection() as reused:
+        assert reused is connection
+
+    stats = pool.stats()
+    assert (stats['created'], stats['reused'], stats['size'], stats['idle']) == (1, 1, 1, 1)
+
+
+def test_pool_is_bounded(pool):
+    first = pool.acquire()
+    second = pool.acquire()
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+
+    pool.release(first)
+    assert pool.acquire() is first
+    pool.release(first)
+    pool.release(second)
+    assert pool.stats()['in_use'] == 0
+
+
+def test_pool_discards_the_broken_connections(pool):
+    with pytest.raises(pymysql.err.OperationalError):
+        with pool.connection() as broken:
+            raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+    assert broken.closed is True and pool.stats()['size'] == 0
+
+    with pytest.raises(ValueError):
+        with pool.connection() as connection:
+            raise ValueError()
+    # an error of the application rolls back the connection, which is kept
+    assert connection.rolled_back is True and connection.closed is False and pool.stats()['idle'] == 1
+
+
+def test_pool_pings_the_connections_idle_for_long(pool):
+    pool.ping_interval = 0
+    with pool.connection() as connection:
+        pass
+    with pool.connection() as pinged:
+        assert pinged is connection
+    connection.alive = False
+    with pool.connection() as replaced:
+        assert replaced is not connection
+    assert connection.closed is True
+
+    stats = pool.stats()
+    assert (stats['pinged'], stats['discarded'], stats['created'], stats['size']) == (1, 1, 2, 1)
+
+
+def test_pool_connections_are_not_shared_after_a_fork(pool):
+    connection = pool.acquire()
+    # the connection is given back by the child process of a fork
+    pool.pid = -1
+    pool.release(connection)
+    assert connection.closed is True and pool.stats()['idle'] == 0
@@ -0,0 +1,51 @@
+from utils.orm.admin import AdminAccount
+from utils.orm.blockchain import TokenOperation
+from utils.orm.filter import Filter, OperatorType
+from utils.orm.instrumentation import query_stats, reset_query_stats
+from utils.orm.migrations import check_query_plans
+from utils.orm.user import UserAccount, Beneficiary, TokenClaim, UserPurchase
+
+
+def run_lookups_of_the_routes():
+    """
+    Run the lookups of the routes on a few entries
+    """
+    UserAccount().insert_many([{'user_uuid': 'user-{0}'.format(index), 'email': 'user.{0}@example.com'.format(index),
+                                'public_address': '0x{0}'.format(index), 'magiclink_issuer': 'issuer-{0}'.format(index)}
+                               for index in range(3)])
+    UserAccount().load({'email': 'user.0@example.com'})
+    UserAccount().load({'magiclink_issuer': 'issuer-1'})
+    UserAccount().search_user(public_address='0x2')
+    AdminAccount().is_existing(email_address='admin@example.com')
+
+    TokenClaim().create_many(creator_uuid=None, user_uuids=['user-0', 'user-1'], nb_token=5)
+    TokenClaim().get_token_claims(user_uuid='user-0')
+    TokenClaim().get_token_claims_for_users(user_uuids=['user-0', 'user-1'])
+    TokenClaim().deactivate(user_uuid='user-1')
+
+    UserPurchase().add_order(user_uuid='user-0', nb_token=10)
+    UserPurchase().get_purchases_totals(user_uuids=['user-0', 'user-1'])
+    filter_purchase = Filter()
+    filter_purchase.add('user_uuid', 'user-0')
+    filter_purchase.add('amount_received', operator=OperatorType.IN)
+    UserPurchase().list_page(filter_object=filter_purchase, order='created_date', asc='DESC', page_size=10)
+
+    Beneficiary().add_new(user_uuid='user-0', beneficiary_user_uuid='user-1')
+    Beneficiary().get_beneficiaries(user_uuid='user-0', page_size=10)
+    TokenOperation().count_operations(user_uuids=['user-0', 'user-1'])
+
+    filter_user = Filter()
+    filter_user.add('deactivated', '0')
+    UserAccount().list_page(fields=['user_uuid'], filter_object=filter_user, order='created_date', page_size=10)
+    UserAccount().backfill_blind_index('public_address')
+
+
+def test_statements_use_an_index():
+    """
+    EXPLAIN every statement shape run by the lookups of the routes
+    """
+    reset_query_stats()
+    run_lookups_of_the_routes()
+    statements = [query['statement'] for query in query_stats(limit=None)['queries']]
+    assert len(statements) > 0
+    assert check_query_plans(statements) == []
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+
+import pytest
+
+from utils.orm import mysql
+from utils.orm.abstract import primary_reads, reset_read_routing
+from utils.orm.backend import set_backend
+from utils.orm.mysql import Replica, get_pool, get_read_pool, get_replicas
+from utils.orm.sqlite import SQLiteBackend
+from utils.orm.user import UserAccount
+
+
+class RecordingBackend(SQLiteBackend):
+    """
+    SQLite backend recording the connections borrowed by the models: True for a read, False for the primary
+    """
+
+    def __init__(self, path=':memory:'):
+        super().__init__(path)
+        self.reads = []
+
+    @contextmanager
+    def connection(self, read=False):
+        self.reads.append(read)
+        with super().connection(read=read) as connection:
+            yield connection
+
+
+@pytest.fixture
+def routing(add_users):
+    backend = RecordingBackend()
+    backend.create_tables()
+    set_backend(backend)
+    add_users(1)
+    reset_read_routing()
+    backend.reads.clear()
+    return backend
+
+
+@pytest.fixture
+def mysql_env(monkeypatch):
+    monkeypatch.setenv('SQL_HOST', 'primary')
+    monkeypatch.setenv('SQL_PORT', '3306')
+    monkeypatch.setattr(mysql, '_pool', None)
+    monkeypatch.setattr(mysql, '_replicas', None)
+    monkeypatch.setattr(mysql, '_next_replica', 0)
+
+
+def test_reads_go_to_the_replicas_until_the_request_writes(routing):
+    user_account = UserAccount()
+    user_account.load({'email': 'user.0@example.com'})
+    assert routing.reads == [True]
+
+    user_account.set('kyc_status', 'APPROVED')
+    user_account.update()
+    UserAccount().load({'email': 'user.0@example.com'})
+    assert routing.reads == [True, False, False]
+
+    # next request
+    reset_read_routing()
+    UserAccount().load({'email': 'user.0@example.com'})
+    assert routing.reads[-1] is True
+
+
+def test_primary_reads(routing):
+    with primary_reads():
+        UserAccount().load({'email': 'user.0@example.com'})
+    UserAccount().load({'email': 'user.0@example.com'})
+    UserAccount().load({'user_uuid': 'user-0'}, for_update=True)
+    assert routing.reads == [False, True, False]
+
+
+def test_replica_serves_reads_while_its_lag_is_below_max_lag(mysql_env, monkeypatch):
+    replica = Replica(host='replica', max_lag=2, check_interval=60)
+    monkeypatch.setattr(replica, '_read_lag', lambda: 1)
+    assert replica.is_healthy() is True and replica.lag == 1
+
+    # the lag is only checked again after check_interval seconds
+    monkeypatch.setattr(replica, '_read_lag', lambda: 10)
+    assert replica.is_healthy() is True
+    replica.checked_at -= 60
+    assert replica.is_healthy() is False and replica.lag == 10
+
+    # stopped replication
+    replica.checked_at = None
+    monkeypatch.setattr(replica, '_read_lag', lambda: None)
+    assert replica.is_healthy() is False
+
+
+def test_replica_is_skipped_when_its_lag_can_not_be_read(mysql_env, monkeypatch):
+    def server_down():
+        raise ConnectionError('replica is down')
+
+    replica = Replica(host='replica', max_lag=2, check_interval=60)
+    monkeypatch.setattr(replica, '_read_lag', server_down)
+    assert replica.is_healthy() is False and replica.lag is None
+
+
+def test_read_pool_skips_the_replicas_out_of_sync(mysql_env, monkeypatch):
+    monkeypatch.setenv('SQL_REPLICA_HOSTS', 'replica-1, replica-2:3307')
+    replicas = get_replicas()
+    addresses = [(replica.pool.host, replica.pool.port) for replica in replicas]
+    assert addresses == [('replica-1', 3306), ('replica-2', 3307)]
+
+    healthy = {replicas[0]: False, replicas[1]: True}
+    monkeypatch.setattr(Replica, 'is_healthy', lambda replica: healthy[replica])
+    assert get_read_pool() is replicas[1].pool
+    assert get_read_pool() is replicas[1].pool
+
+    # the replicas take turns
+    healthy[replicas[0]] = True
+    assert {get_read_pool(), get_read_pool()} == {replicas[0].pool, replicas[1].pool}
+
+    # none in sync: the reads go to the primary
+    healthy[replicas[0]] = healthy[replicas[1]] = False
+    assert get_read_pool() is get_pool()
+
+
+def test_read_pool_without_replica_is_the_primary(mysql_env, monkeypatch):
+    monkeypatch.delenv('SQL_REPLICA_HOSTS', raising=False)
+    assert get_replicas() == []
+    assert get_read_pool() is get_pool()
@@ -0,0 +1,32 @@
+from utils.orm.instrumentation import request_stats
+from utils.orm.user import TokenClaim
+
+
+def test_claims_of_a_batch_of_users_are_read_by_one_query(add_users):
+    add_users(4)
+    TokenClaim().insert_many([{'token_claim_uuid': 'claim-{0}'.format(index), 'user_uuid': 'user-{0}'.format(index % 2),
+                               'nb_token': index + 0.5, 'claimed': 1 if index == 2 else 0} for index in range(5)])
+
+    count = request_stats()['count']
+    claims = TokenClaim().get_token_claims_for_users(['user-0', 'user-1', 'user-2'])
+    assert request_stats()['count'] == count + 1
+
+    uuids = {user_uuid: [claim['token_claim_uuid'] for claim in user_claims]
+             for user_uuid, (user_claims, total) in claims.items()}
+    assert uuids == {'user-0': ['claim-0', 'claim-4'], 'user-1': ['claim-1', 'claim-3'], 'user-2': []}
+    totals = {user_uuid: total for user_uuid, (user_claims, total) in claims.items()}
+    assert totals == {'user-0': 5.0, 'user-1': 5.0, 'user-2': 0.0}
+    claimed, total_claimed = TokenClaim().get_token_claims('user-0', claimed=True)
+    assert [claim['token_claim_uuid'] for claim in claimed] == ['claim-2'] and total_claimed == 2.5
+
+
+def test_list_by_splits_the_values_in_chunks(add_users):
+    add_users(5)
+    TokenClaim().create_many(creator_uuid=None, user_uuids=['user-{0}'.format(index) for index in range(5)],
+                             nb_token=1)
+
+    count = request_stats()['count']
+    claims = TokenClaim().list_by('user_uuid', ['user-{0}'.format(index) for index in range(5)], fields=['nb_token'],
+                                  chunk_size=2)
+    assert request_stats()['count'] == count + 3
+    assert all(user_claims == [{'nb_token': 1}] for user_claims in claims.values()) and len(claims) == 5
@@ -0,0 +1,26 @@
+from utils.orm.statements import load_statement, list_statement, update_statement
+from utils.orm.user import UserAccount
+
+
+def test_statements_are_compiled_once_per_shape(add_users):
+    add_users(2)
+    UserAccount().load({'user_uuid': 'user-0'})
+    hits = load_statement.cache_info().hits
+    # same columns and conditions, other values: the statement is taken from the cache
+    UserAccount().load({'user_uuid': 'user-1'})
+    assert load_statement.cache_info().hits == hits + 1
+
+    misses = load_statement.cache_info().misses
+    UserAccount().load({'magiclink_issuer': None})
+    assert load_statement.cache_info().misses == misses + 1
+
+
+def test_compiled_statements():
+    assert load_statement('user_account', ('user_uuid', 'email'), (('user_uuid', False), ('kyc_status', True)),
+                          for_update=True) == \
+        'SELECT `user_uuid`, `email` FROM user_account WHERE `user_uuid` = %s AND `kyc_status` IS NULL FOR UPDATE'
+    assert update_statement('token_claim', ('claimed', 'claimed_date'), ('token_claim_uuid',)) == \
+        'UPDATE `token_claim` SET `claimed` = %s, `claimed_date` = %s WHERE `token_claim_uuid` = %s'
+    assert list_statement('token_claim', ('nb_token',), '`user_uuid` = %s', order='created_date', asc='DESC',
+                          limit=10, offset=20) == \
+        'SELECT `nb_token` FROM token_claim WHERE `user_uuid` = %s ORDER BY created_date DESC LIMIT 10 OFFSET 20'
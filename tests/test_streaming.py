@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from flask import Flask
+
+from utils.api import json_stream_response
+from utils.orm.filter import Filter
+from utils.orm.user import UserAccount
+
+_app = Flask(__name__)
+
+
+def test_iter_list_streams_the_entries_by_chunk(add_users):
+    add_users(5)
+    filter_user = Filter()
+    filter_user.add('deactivated', '0')
+    users = UserAccount().iter_list(fields=['user_uuid', 'email'], filter_object=filter_user, order='created_date',
+                                    chunk_size=2)
+    assert next(users) == {'user_uuid': 'user-0', 'email': 'user.0@example.com'}
+    assert [user['user_uuid'] for user in users] == ['user-1', 'user-2', 'user-3', 'user-4']
+
+
+def failing_items(nb_items):
+    for index in range(nb_items):
+        yield {'index': index}
+    raise RuntimeError("decryption failed")
+
+
+def test_json_stream_response_sends_the_same_document_as_jsonify():
+    with _app.test_request_context('/api/v1/admin/users'):
+        response = json_stream_response(json_data={'status': True, 'message': "success"}, list_key='users',
+                                        items=({'index': index} for index in range(3)),
+                                        trailer=lambda: {'count': 3})
+        body = ''.join(response.response)
+    assert response.status_code == 200 and response.mimetype == 'application/json'
+    users = [{'index': 0}, {'index': 1}, {'index': 2}]
+    assert json.loads(body) == {'status': True, 'message': "success", 'users': users, 'count': 3}
+
+
+def test_json_stream_response_fails_before_sending_the_status():
+    with _app.test_request_context('/api/v1/admin/users'):
+        # the first item fails: the route raises and the client gets a 500
+        with pytest.raises(RuntimeError):
+            json_stream_response(json_data={}, list_key='users', items=failing_items(0))
+
+        # a later item fails: the status is already sent, the document is truncated
+        response = json_stream_response(json_data={}, list_key='users', items=failing_items(2))
+        chunks = []
+        with pytest.raises(RuntimeError):
+            for chunk in response.response:
+                chunks.append(chunk)
+    assert ''.join(chunks) == '{"users": [{"index": 0}, {"index": 1}'
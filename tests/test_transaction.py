@@ -0,0 +1,82 @@
+import pytest
+
+from utils.orm.abstract import transaction
+from utils.orm.blockchain import TokenOperation
+from utils.orm.user import TokenClaim
+
+
+class FakeProvider(object):
+    """
+    Provider whose transactions of the claims in failed are not sent, and which can't reach the node when down is set
+    """
+    failed = set()
+    down = False
+    sent = []
+
+    def send_batch_tx(self, transactions):
+        if self.down:
+            raise ConnectionError("node unreachable")
+        FakeProvider.sent.extend(transactions.keys())
+        return True, 200, "success_operation", {uuid: None if uuid in self.failed else '0x{0}'.format(uuid)
+                                                for uuid in transactions}
+
+
+@pytest.fixture
+def provider(monkeypatch, add_users):
+    monkeypatch.setattr('utils.orm.user.Provider', FakeProvider)
+    FakeProvider.failed = set()
+    FakeProvider.down = False
+    FakeProvider.sent = []
+    add_users(1)
+    TokenClaim().insert_many([{'token_claim_uuid': 'claim-{0}'.format(index), 'user_uuid': 'user-0', 'nb_token': 5}
+                              for index in range(2)])
+    return FakeProvider
+
+
+def claimed():
+    return {claim['token_claim_uuid']: claim['claimed']
+            for claim in TokenClaim().list(fields=['token_claim_uuid', 'claimed'])}
+
+
+def test_transaction_rolls_back_the_nested_block_only(add_users):
+    add_users(1)
+    with pytest.raises(RuntimeError):
+        with transaction():
+            TokenClaim().create(creator_uuid=None, user_uuid='user-0', nb_token=1)
+            raise RuntimeError()
+    assert TokenClaim().count() == 0
+
+    with transaction():
+        TokenClaim().create(creator_uuid=None, user_uuid='user-0', nb_token=1)
+        with pytest.raises(RuntimeError):
+            with transaction():
+                TokenClaim().create(creator_uuid=None, user_uuid='user-0', nb_token=2)
+                raise RuntimeError()
+    assert [claim['nb_token'] for claim in TokenClaim().list(fields=['nb_token'])] == [1]
+
+
+def test_claim_sends_the_tokens_once(provider):
+    provider.failed = {'claim-1'}
+    status, http_code, message, transactions = TokenClaim().claim('user-0', '0x2', ['claim-0', 'claim-1'])
+    assert status is True
+    assert transactions['claim-0']['tx_hash'] == '0xclaim-0'
+    # the claim whose transaction failed can be claimed again, and no operation is recorded for it
+    assert claimed() == {'claim-0': 1, 'claim-1': 0}
+    assert TokenOperation().count() == 1
+
+    provider.failed = set()
+    TokenClaim().claim('user-0', '0x2', ['claim-0', 'claim-1'])
+    assert provider.sent == ['claim-0', 'claim-1', 'claim-1']
+    assert TokenOperation().count() == 2
+
+
+def test_claim_reopens_the_claims_when_the_node_is_unreachable(provider):
+    provider.down = True
+    assert TokenClaim().claim('user-0', '0x2', ['claim-0', 'claim-1']) == (False, 503, "error_wait_retry", None)
+    assert claimed() == {'claim-0': 0, 'claim-1': 0}
+    assert TokenClaim().count() == 2 and TokenOperation().count() == 0
+    assert all(claim['claimed_date'] is None for claim in TokenClaim().list(fields=['claimed_date']))
+
+    provider.down = False
+    status, http_code, message, transactions = TokenClaim().claim('user-0', '0x2', ['claim-0', 'claim-1'])
+    assert status is True and claimed() == {'claim-0': 1, 'claim-1': 1}
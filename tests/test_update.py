@@ -0,0 +1,49 @@
+import pytest
+
+from utils.orm.filter import Filter, OperatorType
+from utils.orm.instrumentation import query_stats, reset_query_stats
+from utils.orm.user import UserAccount
+
+
+def test_update_where_updates_the_matching_entries(add_users):
+    add_users(3)
+    filter_user = Filter()
+    filter_user.add('user_uuid', ['user-0', 'user-2'], operator=OperatorType.IIN)
+    assert UserAccount().update_where(filter_user, {'kyc_status': 'APPROVED', 'public_address': '0x1'}) == 2
+
+    users = UserAccount().list(fields=['user_uuid', 'kyc_status'], order='user_uuid')
+    assert [user['kyc_status'] for user in users] == ['APPROVED', None, 'APPROVED']
+    # the encrypted columns are encrypted and found by their blind index
+    user_account = UserAccount()
+    assert user_account.load({'public_address': '0x1'}) is True and user_account.get('public_address') == '0x1'
+
+    with pytest.raises(ValueError):
+        UserAccount().update_where(Filter(), {'kyc_status': 'REJECTED'})
+    with pytest.raises(ValueError):
+        UserAccount().update_where(filter_user, {'unknown': 1})
+
+
+def statement_shapes():
+    return [query['shape'] for query in query_stats(limit=None)['queries']]
+
+
+def test_update_writes_the_modified_columns_only(add_users):
+    add_users(1)
+    user_account = UserAccount()
+    user_account.load({'user_uuid': 'user-0'})
+    reset_query_stats()
+
+    user_account.set('lastname', 'Doe')
+    user_account.update()
+    assert statement_shapes() == []
+
+    user_account.set('kyc_status', 'APPROVED')
+    user_account.update()
+    assert statement_shapes() == ['UPDATE `user_account` SET `kyc_status` = ? WHERE `user_uuid` = ?']
+    assert user_account.dirty == set()
+
+    user_account.set('lastname', 'Smith')
+    assert user_account.dirty == {'lastname'}
+    user_account.update()
+    stored = UserAccount().list(fields=['lastname', 'kyc_status'])
+    assert [(user['lastname'], user['kyc_status']) for user in stored] == [('Smith', 'APPROVED')]
@@ -0,0 +1,48 @@
+import pytest
+
+from utils.orm.blockchain import TokenOperation
+from utils.orm.user import UserAccount, TokenClaim
+
+
+def test_upsert_inserts_then_updates(add_users):
+    add_users(1)
+    token_claim = TokenClaim({'token_claim_uuid': 'claim-0', 'user_uuid': 'user-0', 'nb_token': 5})
+    token_claim.upsert(conflict_keys=['token_claim_uuid'])
+
+    token_claim = TokenClaim({'token_claim_uuid': 'claim-0', 'user_uuid': 'user-0', 'nb_token': 8})
+    token_claim.upsert(conflict_keys=['token_claim_uuid'], update_columns=['nb_token'])
+    token_claim = TokenClaim({'token_claim_uuid': 'claim-0', 'user_uuid': 'user-0', 'nb_token': 13})
+    token_claim.upsert(conflict_keys=['token_claim_uuid'], update_columns=[])
+
+    claims = TokenClaim().list(fields=['token_claim_uuid', 'nb_token'])
+    assert [(claim['token_claim_uuid'], claim['nb_token']) for claim in claims] == [('claim-0', 8)]
+
+
+def test_upsert_many_keeps_the_blind_indexes_up_to_date(add_users):
+    add_users(2)
+    UserAccount().upsert_many([{'user_uuid': 'user-1', 'email': 'new.1@example.com'},
+                               {'user_uuid': 'user-2', 'email': 'user.2@example.com'}],
+                              conflict_keys=['user_uuid'], update_columns=['email'])
+
+    assert UserAccount().count() == 3
+    user_account = UserAccount()
+    assert user_account.load({'email': 'new.1@example.com'}) is True
+    assert user_account.get('user_uuid') == 'user-1'
+    assert UserAccount().load({'email': 'user.1@example.com'}) is False
+
+
+def test_upsert_conflicts_on_a_unique_key_of_the_model_only():
+    operation = {'token_operation_uuid': 'operation-0', 'receiver_uuid': 'user-0', 'sender_address': '0x1',
+                 'receiver_address': '0x2', 'token': TokenOperation.EUROLFS, 'nb_token': 1}
+    TokenOperation().upsert_many([operation], conflict_keys=['token_operation_uuid'], update_columns=['nb_token'])
+    TokenOperation().upsert_many([dict(operation, nb_token=2)], conflict_keys=['token_operation_uuid'],
+                                 update_columns=['nb_token'])
+    operations = TokenOperation().list(fields=['token_operation_id', 'nb_token'])
+    assert operations == [{'token_operation_id': 1, 'nb_token': 2}]
+
+    # a column that is not a unique key, or a part of one, can't be the conflict target
+    for conflict_keys in [['receiver_uuid'], ['token_operation_uuid', 'receiver_uuid'], [], ['unknown']]:
+        with pytest.raises(ValueError):
+            TokenOperation().upsert_many([operation], conflict_keys=conflict_keys, update_columns=['nb_token'])
+        with pytest.raises(ValueError):
+            TokenOperation(operation).upsert(conflict_keys=conflict_keys)
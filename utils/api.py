@@ -1,10 +1,16 @@
-from flask import jsonify, make_response, request
+from datetime import datetime, timedelta
+from flask import Response, json, jsonify, make_response, request, stream_with_context
 from flask_jwt_extended import get_jwt_identity
 from functools import wraps
+from itertools import chain, islice
 
 from utils.orm.admin import AdminAccount
+from utils.orm.filter import OperatorType
 from utils.orm.user import UserAccount
 from utils.kyc import Synaps
+from utils.log import Logger
+
+log = Logger()
 
 
 def http_error_400(message="error_bad_request"):
@@ -35,6 +41,97 @@ def http_error_500(message="error_internal_error"):
     return make_response(jsonify({'status': False, 'message': message}), 500)
 
 
+def http_error_503(message="error_overloaded", retry_after=1):
+    """
+    Standard response when the service sheds the request, the client can retry after retry_after seconds
+    """
+    response = make_response(jsonify({'status': False, 'message': message}), 503)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def json_stream_response(json_data, list_key, items, trailer=None, http_code=200):
+    """
+    Standard response whose list_key member is streamed item by item instead of being built in memory.
+    The body is the same JSON document as make_response(jsonify(...)) would return.
+    The first item is computed before the status is sent, so that an error of the first query (or decryption) is
+    answered by a 500 instead of a truncated document. An error in a later batch can only end the body, it is logged.
+    :param json_data: dict of the members sent before the list
+    :param list_key: name of the streamed list member
+    :param items: iterable of the list items (e.g. Abstract.iter_list generator)
+    :param trailer: optional callable returning a dict of members sent after the list (called once streamed)
+    :param http_code:
+    """
+    items = iter(items)
+    first_items = list(islice(items, 1))
+
+    def generate():
+        head = json.dumps(json_data)[:-1]
+        if len(json_data) > 0:
+            head = '{0}, '.format(head)
+        yield '{0}{1}: ['.format(head, json.dumps(list_key))
+        separator = ''
+        try:
+            for item in chain(first_items, items):
+                yield separator + json.dumps(item)
+                separator = ', '
+            tail = ''
+            if trailer is not None:
+                for key, value in trailer().items():
+                    tail = '{0}, {1}: {2}'.format(tail, json.dumps(key), json.dumps(value))
+        except Exception as e:
+            log.error("Streamed response {0} truncated: {1!r}".format(request.path, e))
+            raise
+        yield ']{0}}}'.format(tail)
+
+    return Response(stream_with_context(generate()), status=http_code, mimetype='application/json')
+
+
+def get_pagination(max_page_size=500, default_page_size=50):
+    """
+    Read the keyset pagination arguments of the request: page_size and cursor (next_cursor of the previous page).
+    Without any of them the whole list is requested.
+    :param max_page_size:
+    :param default_page_size: page size used when only the cursor is given
+    :return: page size (None if not paginated), cursor
+    """
+    page_size = request.args.get('page_size')
+    cursor = request.args.get('cursor')
+    if page_size is None:
+        if cursor is None:
+            return None, None
+        return default_page_size, cursor
+    page_size = int(page_size)
+    if page_size < 1 or page_size > max_page_size:
+        raise ValueError('Invalid page size: {0}'.format(page_size))
+    return page_size, cursor
+
+
+def add_date_filter(filter_object, column, from_key='from', to_key='to'):
+    """
+    Restrict a filter to the date range given by the request arguments (YYYY-MM-DD, both days included)
+    :param filter_object: Filter
+    :param column: date column (stored as ISO string)
+    :param from_key: argument of the first day
+    :param to_key: argument of the last day
+    :return: filter_object
+    """
+    bounds = []
+    for key, delta in [(from_key, timedelta(0)), (to_key, timedelta(days=1, microseconds=-1))]:
+        value = request.args.get(key)
+        if value is not None:
+            value = (datetime.strptime(value, "%Y-%m-%d") + delta).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        bounds.append(value)
+
+    if bounds[0] is not None and bounds[1] is not None:
+        filter_object.add(column, bounds, operator=OperatorType.BETWEEN)
+    elif bounds[0] is not None:
+        filter_object.add(column, bounds[0], operator=OperatorType.GET)
+    elif bounds[1] is not None:
+        filter_object.add(column, bounds[1], operator=OperatorType.LET)
+    return filter_object
+
+
 def json_data_required(func):
     """
     Decorator around endpoints that require user to provide POST data.
@@ -1,42 +1,226 @@
-from base64 import urlsafe_b64encode
-from cryptography.fernet import Fernet
-from os import environ as env
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from contextlib import contextmanager
+from datetime import datetime
+from json import dumps, loads
+from threading import local
 
-from utils.orm.filter import Filter
+from utils.orm.encryption import LazyRow, decrypt_rows, get_cipher
+from utils.orm.filter import Filter, OperatorType
+from utils.orm.identity_map import get_row, store_row, discard_row, discard_table
+from utils.orm.instrumentation import timed_query
 from utils.log import Logger
-from utils.orm.mysql import get_connection
+from utils.orm.backend import get_backend
+from utils.security import generate_blind_index
+from utils.orm.statements import ModelMetadata, load_statement, insert_statement, update_statement, list_statement, \
+    keyset_condition, keyset_data, aggregate_statement, quote, AGGREGATE_FUNCTIONS
+
+_unit_of_work = local()
+_read_routing = local()
+
+
+def utc_now():
+    """
+    Current UTC date in the format stored in database, used as default value of the date columns
+    :return: string
+    """
+    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def in_transaction():
+    """
+    Return True if a transaction is open on the current thread
+    :return: boolean
+    """
+    return getattr(_unit_of_work, 'connection', None) is not None
+
+
+def reset_read_routing():
+    """
+    Called at the start of each request: the reads go to the replicas again until the request writes
+    """
+    _read_routing.primary = False
+
+
+def reads_on_primary():
+    """
+    Return True if the reads of the current thread go to the primary: inside a primary_reads() block, or once the
+    current request has written so that it reads its own writes
+    :return: boolean
+    """
+    return getattr(_read_routing, 'primary', False) or getattr(_read_routing, 'forced', 0) > 0
+
+
+@contextmanager
+def primary_reads():
+    """
+    Send the reads of the with block to the primary, for the reads a write depends on (e.g. a claim not claimed yet)
+    """
+    _read_routing.forced = getattr(_read_routing, 'forced', 0) + 1
+    try:
+        yield
+    finally:
+        _read_routing.forced -= 1
+
+
+def encode_cursor(values):
+    """
+    Opaque pagination cursor from the sort key of the last row of a page
+    :param values: list of the sort column values
+    :return: string
+    """
+    return urlsafe_b64encode(dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Sort key from a pagination cursor returned by encode_cursor()
+    :param cursor:
+    :return: list of the sort column values
+    """
+    try:
+        values = loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+    except Exception:
+        raise ValueError('Invalid cursor: {0}'.format(cursor))
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor: {0}'.format(cursor))
+    return values
+
+
+@contextmanager
+def transaction():
+    """
+    Group all the ORM writes of the with block in a single transaction committed once at the end.
+    Nested calls open a savepoint: an exception only rolls back the writes of the nested block.
+    Reads made inside the block use the same connection and see the pending writes.
+    """
+    backend = get_backend()
+    connection = getattr(_unit_of_work, 'connection', None)
+    if connection is None:
+        with backend.connection() as connection:
+            backend.begin(connection)
+            _unit_of_work.connection = connection
+            _unit_of_work.depth = 0
+            try:
+                yield connection
+            except BaseException:
+                connection.rollback()
+                # the identity map may hold rows written by the transaction
+                discard_table()
+                raise
+            else:
+                with timed_query('COMMIT'):
+                    connection.commit()
+            finally:
+                _unit_of_work.connection = None
+        return
+
+    _unit_of_work.depth += 1
+    savepoint = 'sp_{0}'.format(_unit_of_work.depth)
+    cursor = backend.cursor(connection)
+    cursor.execute('SAVEPOINT {0}'.format(savepoint))
+    try:
+        yield connection
+    except BaseException:
+        cursor.execute('ROLLBACK TO SAVEPOINT {0}'.format(savepoint))
+        discard_table()
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT {0}'.format(savepoint))
+    finally:
+        _unit_of_work.depth -= 1
+
+
+@contextmanager
+def _transaction_connection():
+    yield _unit_of_work.connection
+
+
+class Field(object):
+    """
+    Attribute access to a column of an entry (e.g. UserAccount().email), generated for each column of the models.
+    Reading returns the value or the default value of the column, writing is the same as set().
+    """
+    __slots__ = ('column',)
+
+    def __init__(self, column):
+        self.column = column
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        data = instance._data
+        if self.column in data:
+            return data[self.column]
+        elif self.column in instance._defaults:
+            return instance._default(self.column)
+        raise AttributeError("'{0}' object has no attribute '{1}'".format(type(instance).__name__, self.column))
+
+    def __set__(self, instance, value):
+        instance.set(self.column, value)
 
 
 class Abstract(object):
     """
     This class contains all DB operations functions.
+
+    The table description (_table, _columns, _encrypt_fields, _primary_key, _defaults) is declared once per model
+    class; a callable default is called when the value is needed (e.g. utc_now). Instances only hold their row.
+
+    An encrypted column can't be compared in SQL (Fernet uses a random IV). The columns listed in
+    _blind_index_fields get a <column>_index column holding generate_blind_index() of their value, written with the
+    column, and the equality conditions on them given to load() or in a Filter are made on that index.
+
+    _indexes lists the secondary indexes (tuples of columns) the queries of the model rely on, they are created by
+    utils/orm/migrations.py. _unique_keys lists the unique keys of the table besides the primary key (tuples of
+    columns), the conflict targets upsert() accepts.
+
+    Within a Flask request the entries read by load() are kept in an identity map (see identity_map), so that the
+    same entry is read from the database once per request.
     """
+    __slots__ = ('_data', '_dirty', '_adapter')
+
+    _table = ''
+    _columns = []
+    _primary_key = ['rowid']
+    _encrypt_fields = []
+    _blind_index_fields = []
+    _indexes = []
+    _unique_keys = []
+    _defaults = {}
+    _meta = ModelMetadata(table='', columns=[], encrypt_fields=[], primary_key=['rowid'])
+    log = Logger()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._meta = ModelMetadata(table=cls._table, columns=cls._columns, encrypt_fields=cls._encrypt_fields,
+                                  primary_key=cls._primary_key, blind_index_fields=cls._blind_index_fields,
+                                  indexes=cls._indexes, unique_keys=cls._unique_keys)
+        for column in cls._columns:
+            # methods and attributes of the model have priority over the columns
+            if not hasattr(cls, column):
+                setattr(cls, column, Field(column))
 
     def __init__(self, data=None, adapter=None):
         self._data = {}
-        if data:
-            self._data.update(data)
+        self._dirty = set()
         self._adapter = adapter
-        self._table = ''
-        self._columns = []
-        self._primary_key = ['rowid']
-        self._encrypt_fields = []
-        self._defaults = {}
-        self.log = Logger()
-
-        # load encryption module
-        self.fernet = Fernet(key=urlsafe_b64encode(env['APP_DB_KEY'].encode()))
-
-    def __getattribute__(self, key):
-        try:
-            return object.__getattribute__(self, key)
-        except AttributeError:
-            pass
+        if data:
+            self.add_data(data)
 
-        if key in self._data:
-            return self._data[key]
-        elif key in self._defaults:
-            return self._defaults[key]
+    @property
+    def fernet(self):
+        """
+        Fernet instance of APP_DB_KEY shared by all the models of the process
+        """
+        return get_cipher()[1]
+
+    def __getattr__(self, key):
+        # only called when the normal lookup fails: values of the entry that are not columns of the model
+        if not key.startswith('_'):
+            if key in self._data:
+                return self._data[key]
+            elif key in self._defaults:
+                return self._default(key)
 
         raise AttributeError("'{0}' object has no attribute '{1}'".format(self.__class__.__name__, key))
 
@@ -44,99 +228,406 @@ class Abstract(object):
     def data(self):
         return self._data
 
+    @property
+    def dirty(self):
+        """
+        Columns modified since the entry was loaded or last saved
+        """
+        return set(self._dirty)
+
     def set_data(self, data):
         self._data = data
+        self._dirty = set(data.keys())
         return self
 
     def add_data(self, data):
-        self._data.update(data)
+        for key, value in data.items():
+            self.set(key, value)
         return self
 
     def set(self, key, value):
+        if key not in self._data or self._data[key] != value:
+            self._dirty.add(key)
         self._data[key] = value
         return self
 
+    def mark_clean(self, columns=None):
+        """
+        Flag the given columns (all if None) as saved in database
+        :param columns: list of column names or None
+        """
+        if columns is None:
+            self._dirty.clear()
+        else:
+            self._dirty.difference_update(columns)
+        return self
+
+    def _set_blind_indexes(self, columns):
+        """
+        Set the blind index of the given encrypted columns from their current value
+        :param columns: columns having a blind index
+        """
+        blind_indexes = self._metadata().blind_indexes
+        for column in columns:
+            value = self.get(column)
+            self.set(blind_indexes[column], generate_blind_index(value) if value is not None else None)
+
+    def _indexed_filter(self, filter_object):
+        """
+        Filter whose equality conditions on the encrypted columns having a blind index are made on the index
+        :param filter_object: Filter Object (instance of class filter.Filter)
+        :return: Filter
+        """
+        blind_indexes = self._metadata().blind_indexes
+        if not blind_indexes:
+            return filter_object
+        return filter_object.rewrite({column: (index_column, generate_blind_index)
+                                      for column, index_column in blind_indexes.items()})
+
     def get(self, key):
         if key in self._data:
             return self._data[key]
         elif key in self._defaults:
-            return self._defaults[key]
+            return self._default(key)
 
         return None
 
+    def _default(self, key):
+        value = self._defaults.get(key)
+        if callable(value):
+            return value()
+        return value
+
     def set_adapter(self, adapter):
         self._adapter = adapter
 
-    def get_adapter(self):
-        self._adapter = get_connection()
-        return self._adapter
+    def _metadata(self):
+        """
+        Return the table description of the model, built once when the model class is declared
+        :return: ModelMetadata
+        """
+        return self._meta
 
-    def load(self, conditions):
-        columns = []
-        for column in self._columns:
-            columns.append('`%s`' % column)
+    def get_adapter(self, read=False):
+        """
+        Borrow a connection from the backend (the process pool with MySQL), it is given back when the with block
+        exits. Inside a transaction() block the connection of the transaction is used.
+        :param read: the connection only reads, it is borrowed from a replica unless reads_on_primary()
+        :return: context manager yielding a DB-API connection
+        """
+        if in_transaction():
+            return _transaction_connection()
+        return get_backend().connection(read=read and not reads_on_primary())
 
-        where = []
+    def load(self, conditions, for_update=False):
+        """
+        Load the entry matching the given equality conditions.
+        When the conditions include the primary key, the entry is only read once per request (see identity_map).
+        :param conditions: dict (column: value), None matches NULL
+        :param for_update: read from the primary and lock the entry until the end of the transaction()
+        :return: True if an entry was found
+        """
+        metadata = self._metadata()
+        key = self._identity_key(conditions)
+        if key is not None and not for_update:
+            row = get_row(metadata.table, key)
+            if row is not None and self._row_matches(row, conditions):
+                row = row.copy()
+                for column in self._data:
+                    if column not in row:
+                        row[column] = self._data[column]
+                self._data = row
+                self.mark_clean()
+                return True
+
+        shape = []
         data = []
-        for column in conditions:
-            if conditions[column] is None or conditions[column] == 'NULL':
-                where.append("`{0}` IS NULL".format(column))
+        for column, value in conditions.items():
+            if column in metadata.blind_indexes and value is not None and value != 'NULL':
+                column = metadata.blind_indexes[column]
+                value = generate_blind_index(value)
+            if value is None or value == 'NULL':
+                shape.append((column, True))
             else:
-                where.append("`{0}` = %s".format(column))
-                data.append(conditions[column])
+                shape.append((column, False))
+                data.append(value)
 
-        query = 'SELECT %s FROM %s WHERE %s' % (', '.join(columns), self._table, ' AND '.join(where))
-        result = self._execute(query, data)
+        query = load_statement(metadata.table, metadata.columns, tuple(shape), for_update)
+        result = self._execute(query, data, read=not for_update)
 
         if result:
-            for column in self._columns:
-                if column in self._encrypt_fields:
-                    if result[column] is not None:
-                        self.set(column, self.fernet.decrypt(result[column].encode()).decode())
-                    else:
-                        self.set(column, None)
-                else:
-                    self.set(column, result[column])
+            # encrypted columns are decrypted when they are read
+            if not isinstance(self._data, LazyRow):
+                self._data = LazyRow(self._data, self.fernet)
+            self._data.load(result, metadata.encrypt_fields)
+            self.mark_clean()
+            key = self._identity_key(result)
+            if key is not None:
+                store_row(metadata.table, key, LazyRow(result, self.fernet, metadata.encrypt_fields))
+            return True
+        return False
+
+    def _identity_key(self, values):
+        """
+        Key of an entry in the identity map
+        :param values: dict of column values
+        :return: tuple of the primary key values as strings, None if one of them is missing
+        """
+        key = []
+        for column in self._metadata().primary_key:
+            value = values.get(column)
+            if value is None or value == 'NULL':
+                return None
+            key.append(str(value))
+        return tuple(key)
+
+    def _row_matches(self, row, conditions):
+        """
+        Verify that a row of the identity map matches the conditions given to load() besides its primary key
+        :param row: LazyRow
+        :param conditions: dict (column: value), None matches NULL
+        :return: boolean, False if the database must be queried
+        """
+        primary_key = self._metadata().primary_key
+        for column, value in conditions.items():
+            if column in primary_key or column not in row:
+                continue
+            if value is None or value == 'NULL':
+                if row[column] is not None:
+                    return False
+            elif row[column] != value:
+                return False
+        return True
 
     def insert(self):
         """
         Insert data in database
         :return:
         """
+        metadata = self._metadata()
+        columns, data = self._insert_values()
+        self._run(insert_statement(metadata.table, columns), data)
+        key = self._identity_key(self._data)
+        if key is not None:
+            discard_row(metadata.table, key)
+        self.mark_clean()
+        return self
+
+    def _insert_values(self):
+        """
+        Columns and values of the entry sent by an INSERT: the defaults are set on the entry, the blind indexes are
+        computed and the encrypted columns encrypted
+        :return: tuple of columns, list of values
+        """
+        metadata = self._metadata()
+        self._set_blind_indexes([column for column in metadata.blind_indexes if column in self._data])
         columns = []
-        values = []
         data = []
-        for column in self._columns:
-            if self.get(column) or self.get(column) == 0:
-                columns.append('`%s`' % column)
-                values.append("%s")
-                if column in self._encrypt_fields and self.get(column) is not None:
-                    data.append(self.fernet.encrypt(self.get(column).encode()))
+        for column in metadata.columns:
+            if column not in self._data and column in self._defaults:
+                # keep the default value sent to the database (e.g. creation date)
+                self._data[column] = self._default(column)
+            value = self.get(column)
+            if value or value == 0:
+                columns.append(column)
+                if column in metadata.encrypt_fields:
+                    data.append(self.fernet.encrypt(value.encode()))
                 else:
-                    data.append(self.get(column))
+                    data.append(value)
+        return tuple(columns), data
 
-        query = 'INSERT INTO `%s`(%s) VALUES(%s)' % (self._table, ', '.join(columns), ', '.join(values))
-        self._run(query, data)
-        return self
+    def upsert(self, conflict_keys, update_columns=None):
+        """
+        Insert the entry or, if it conflicts with an existing entry on a unique key, update the given columns of the
+        existing entry, with a single INSERT ... ON DUPLICATE KEY UPDATE statement instead of a read then a write.
+        MySQL updates the entry conflicting on any unique key of the table whatever the conflict keys, SQLite only the
+        one conflicting on the conflict keys: the other unique keys of the model must not conflict.
+        :param conflict_keys: columns of the primary key or of a unique key of the model (see _unique_keys)
+        :param update_columns: columns updated on conflict, the modified columns of the entry (see dirty) besides
+                               the conflict keys and the primary key if None, none to keep the existing entry as is
+        :return: number of affected rows, with MySQL 1 if the entry was inserted (or left unchanged), 2 if updated
+        """
+        metadata = self._metadata()
+        conflict_keys = tuple(conflict_keys)
+        if update_columns is None:
+            update_columns = [column for column in metadata.columns if column in self._dirty and
+                              column not in conflict_keys and column not in metadata.primary_key]
+        update_columns = self._upsert_columns(conflict_keys, update_columns)
+
+        columns, data = self._insert_values()
+        query = get_backend().upsert_statement(metadata.table, columns, conflict_keys, update_columns)
+        rowcount = self._run(query, data, rowcount=True)
+        # the updated entry may be cached under another primary key than the one of this entry
+        discard_table(metadata.table)
+        self.mark_clean()
+        return rowcount
+
+    def _upsert_columns(self, conflict_keys, update_columns):
+        """
+        Validate the columns of an upsert and add the blind indexes of the updated encrypted columns
+        :param conflict_keys: tuple of columns
+        :param update_columns: list of columns
+        :return: tuple of the updated columns
+        """
+        metadata = self._metadata()
+        if frozenset(conflict_keys) not in metadata.unique_keys:
+            raise ValueError('Conflict keys are not a unique key of {0}: {1}'.format(metadata.table, conflict_keys))
+        if not metadata.column_set.issuperset(update_columns):
+            raise ValueError('Unknown column: {0}'.format(update_columns))
+        columns = list(update_columns)
+        for column in update_columns:
+            if column in metadata.blind_indexes and metadata.blind_indexes[column] not in columns:
+                columns.append(metadata.blind_indexes[column])
+        return tuple(columns)
+
+    def _group_rows(self, rows):
+        """
+        Complete rows with the model defaults and their blind indexes, then group the rows sharing the same set of
+        columns, encrypted column by column
+        :param rows: list of dict (column: value)
+        :return: dict {tuple of columns: list of (index of the row, dict of the values to send)}
+        """
+        blind_indexes = self._metadata().blind_indexes
+        groups = {}
+        for index, row in enumerate(rows):
+            values = {}
+            for column in self._columns:
+                value = row[column] if column in row else self._default(column)
+                if value or value == 0:
+                    values[column] = value
+            for column, index_column in blind_indexes.items():
+                if column in values:
+                    values[index_column] = generate_blind_index(values[column])
+            groups.setdefault(tuple(values.keys()), []).append((index, values))
+
+        for columns, group in groups.items():
+            # encrypt the whole group column by column before building the statements
+            for column in columns:
+                if column in self._encrypt_fields:
+                    for index, values in group:
+                        values[column] = self.fernet.encrypt(values[column].encode())
+        return groups
+
+    def insert_many(self, rows, chunk_size=500):
+        """
+        Insert several rows with multi-row INSERT statements.
+        Rows are completed with the model defaults, and rows sharing the same set of columns are inserted together,
+        chunk_size rows per statement. Use it inside transaction() to commit all the chunks at once.
+        :param rows: list of dict (column: value)
+        :param chunk_size: maximum number of rows per statement
+        :return: List of inserted entries (primary keys), in the order of the given rows
+        """
+        primary_keys = [None] * len(rows)
+        for columns, group in self._group_rows(rows).items():
+            for start in range(0, len(group), chunk_size):
+                chunk = group[start:start + chunk_size]
+                data = []
+                for index, values in chunk:
+                    data.extend(values[column] for column in columns)
+                first_rowid = self._run(insert_statement(self._table, columns, len(chunk)), data)
+
+                # InnoDB allocates consecutive auto increment values to the rows of a multi-row insert
+                for offset, (index, values) in enumerate(chunk):
+                    primary_keys[index] = {}
+                    for column in self._primary_key:
+                        if column in values:
+                            primary_keys[index][column] = rows[index].get(column, values[column])
+                        else:
+                            primary_keys[index][column] = first_rowid + offset
+        return primary_keys
+
+    def upsert_many(self, rows, conflict_keys, update_columns, chunk_size=500):
+        """
+        Bulk variant of upsert(): multi-row INSERT ... ON DUPLICATE KEY UPDATE statements, chunk_size rows per
+        statement, the rows being completed with the model defaults as in insert_many().
+        Use it inside transaction() to commit all the chunks at once.
+        :param rows: list of dict (column: value)
+        :param conflict_keys: columns of the primary key or of a unique key of the model (see _unique_keys)
+        :param update_columns: columns updated on conflict, the values of the conflicting row are written, empty to
+                               keep the existing entries as they are
+        :param chunk_size: maximum number of rows per statement
+        :return: number of affected rows, with MySQL 1 per inserted (or unchanged) entry and 2 per updated one
+        """
+        conflict_keys = tuple(conflict_keys)
+        update_columns = self._upsert_columns(conflict_keys, update_columns)
+        backend = get_backend()
+        rowcount = 0
+        for columns, group in self._group_rows(rows).items():
+            for start in range(0, len(group), chunk_size):
+                chunk = group[start:start + chunk_size]
+                data = []
+                for index, values in chunk:
+                    data.extend(values[column] for column in columns)
+                query = backend.upsert_statement(self._table, columns, conflict_keys, update_columns, len(chunk))
+                rowcount += self._run(query, data, rowcount=True)
+        discard_table(self._table)
+        return rowcount
 
     def update(self):
+        """
+        Write the modified columns of the entry (see dirty), nothing is sent if no column was modified
+        :return:
+        """
+        metadata = self._metadata()
+        self._set_blind_indexes([column for column in metadata.blind_indexes if column in self._dirty])
         columns = []
         data = []
-        for column in self._columns:
-            if column in self._encrypt_fields and self.get(column) is not None:
-                value = self.fernet.encrypt(self.get(column).encode()).decode()
-            else:
-                value = self.get(column)
-            columns.append('`{0}` = %s'.format(column))
+        for column in metadata.columns:
+            if column not in self._dirty:
+                continue
+            value = self.get(column)
+            if value is not None and column in metadata.encrypt_fields:
+                value = self.fernet.encrypt(value.encode()).decode()
+            columns.append(column)
             data.append(value)
 
-        where = []
-        for column in self._primary_key:
-            where.append('`{0}` = %s'.format(column))
+        if len(columns) == 0:
+            return
+
+        for column in metadata.primary_key:
             data.append(self.get(column))
 
-        query = 'UPDATE `%s` SET %s WHERE %s' % (self._table, ', '.join(columns), ' AND '.join(where))
-        self._run(query, data)
+        self._run(update_statement(metadata.table, tuple(columns), metadata.primary_key), data)
+        key = self._identity_key(self._data)
+        row = get_row(metadata.table, key) if key is not None else None
+        if row is not None:
+            for column in columns:
+                row[column] = self.get(column)
+        self.mark_clean()
+
+    def update_where(self, filter_object, values):
+        """
+        Update the given columns of all the entries matching the filter with a single statement
+        :param filter_object: Filter Object (instance of class filter.Filter), mandatory
+        :param values: dict (column: new value), encrypted columns are encrypted before being written
+        :return: number of matched entries
+        """
+        blind_indexes = self._metadata().blind_indexes
+        values = dict(values)
+        for column, index_column in blind_indexes.items():
+            if column in values:
+                values[index_column] = generate_blind_index(values[column]) if values[column] is not None else None
+        columns = []
+        data = []
+        for column, value in values.items():
+            if column not in self._columns:
+                raise ValueError('Unknown column: {0}'.format(column))
+            if column in self._encrypt_fields and value is not None:
+                value = self.fernet.encrypt(value.encode()).decode()
+            columns.append('`{0}` = %s'.format(column))
+            data.append(value)
+
+        filter_sql = ''
+        if filter_object and isinstance(filter_object, Filter):
+            filter_sql, filter_data = self._indexed_filter(filter_object).get()
+            data.extend(filter_data)
+        if not columns or not filter_sql:
+            raise ValueError('Values and filter are required')
+
+        query = 'UPDATE `%s` SET %s WHERE %s' % (self._table, ', '.join(columns), filter_sql)
+        rowcount = self._run(query, data, rowcount=True)
+        discard_table(self._table)
+        return rowcount
 
     def delete(self):
         where = []
@@ -147,22 +638,26 @@ class Abstract(object):
 
         query = 'DELETE FROM `%s` WHERE %s' % (self._table, ' AND '.join(where))
         self._run(query, data)
+        key = self._identity_key(self._data)
+        if key is not None:
+            discard_row(self._table, key)
 
     def delete_list(self, filter_object=None):
         filter_sql = ''
         data = []
         if filter_object and isinstance(filter_object, Filter):
-            filter_sql, data = filter_object.get()
+            filter_sql, data = self._indexed_filter(filter_object).get()
         query = 'DELETE FROM `%s`' % self._table
         if filter_sql:
             query = '{0} WHERE {1}'.format(query, filter_sql)
         self._run(query, data)
+        discard_table(self._table)
 
     def count(self, filter_object=None):
         filter_sql = ''
         data = []
         if filter_object and isinstance(filter_object, Filter):
-            filter_sql, data = filter_object.get()
+            filter_sql, data = self._indexed_filter(filter_object).get()
 
         query = "SELECT COUNT(*) as nb FROM %s" % self._table
         if filter_sql:
@@ -184,12 +679,13 @@ class Abstract(object):
         filter_sql = ''
         data = []
         if filter_object and isinstance(filter_object, Filter):
-            filter_sql, data = filter_object.get()
+            filter_sql, data = self._indexed_filter(filter_object).get()
 
         query = "UPDATE %s SET %s = %s + %d" % (self._table, column, column, number)
         if filter_sql:
             query = '{0} WHERE {1}'.format(query, filter_sql)
         self._run(query, data)
+        discard_table(self._table)
 
     def max(self, field, filter_object=None):
         """
@@ -201,7 +697,7 @@ class Abstract(object):
         filter_sql = ''
         data = []
         if filter_object and isinstance(filter_object, Filter):
-            filter_sql, data = filter_object.get()
+            filter_sql, data = self._indexed_filter(filter_object).get()
 
         query = 'SELECT MAX({0}) FROM {1}'.format(field, self._table)
         if filter_sql:
@@ -221,7 +717,7 @@ class Abstract(object):
         filter_sql = ''
         data = []
         if filter_object and isinstance(filter_object, Filter):
-            filter_sql, data = filter_object.get()
+            filter_sql, data = self._indexed_filter(filter_object).get()
 
         query = 'SELECT SUM({0}) as sum_score FROM {1}'.format(field, self._table)
         if filter_sql:
@@ -231,110 +727,327 @@ class Abstract(object):
             result = self._execute(query)
         return result.get('sum_score')
 
+    def aggregate(self, fields: dict, group_by=None, filter_object=None, order=None, asc='ASC'):
+        """
+        Compute aggregates in the database, optionally per group, instead of fetching the rows.
+        e.g. aggregate(fields={'total': ('SUM', 'nb_token'), 'nb': ('COUNT', '*')}, group_by=['user_uuid'])
+        :param fields: dict {alias: (function, column)} with function in SUM, COUNT, MIN, MAX, AVG
+        :param group_by: List of column names to group by (a single row for the whole table if None)
+        :param filter_object: Filter Object (instance of class filter.Filter)
+        :param order: alias or group_by column to order by
+        :param asc: order by 'ASC' or 'DESC'
+        :return: List of dict with the group_by columns and the aliases
+        """
+        metadata = self._metadata()
+        if not fields:
+            raise ValueError('No aggregate provided')
+        aggregates = []
+        for alias, (function, column) in fields.items():
+            function = function.upper()
+            if function not in AGGREGATE_FUNCTIONS:
+                raise ValueError('Unknown aggregate function: {0}'.format(function))
+            if column == '*':
+                if function != 'COUNT':
+                    raise ValueError('{0} cannot be applied to *'.format(function))
+            elif column not in metadata.column_set:
+                raise ValueError('Unknown column: {0}'.format(column))
+            elif column in metadata.encrypt_fields and function != 'COUNT':
+                raise ValueError('{0} cannot be applied to the encrypted column {1}'.format(function, column))
+            aggregates.append((alias, function, column))
+        group_by = tuple(group_by or ())
+        for column in group_by:
+            if column not in metadata.column_set or column in metadata.encrypt_fields:
+                raise ValueError('Invalid group by column: {0}'.format(column))
+        if order is not None and order not in fields and order not in group_by:
+            raise ValueError('Invalid order: {0}'.format(order))
+
+        filter_sql = ''
+        data = []
+        if filter_object and isinstance(filter_object, Filter):
+            filter_sql, data = self._indexed_filter(filter_object).get()
+
+        query = aggregate_statement(metadata.table, tuple(aggregates), group_by, filter_sql, order, asc)
+        return list(self._execute(query, data, True))
+
     def list(self, fields=None, filter_object=None, limit=0, order=None, asc='ASC', group_by=None, distinct=False,
-             random=False):
+             random=False, decrypt_all=False, offset=0):
         """
         List all or only the given fields of entries of the DB table.
         :param fields: List with column names or None (all the fields will be fetched)
         :param filter_object: Filter Object (instance of class filter.Filter)
         :param limit: maximum number of entries to be fetched (all if 0)
-        :param order: field to order by
+        :param order: column or list of columns to order by
         :param asc: order by 'ASC' or 'DESC'
-        :param group_by: field to group by
+        :param group_by: column or list of columns to group by
         :param distinct: select distinct fields values
         :param random: select nb random rows from the table (nb = limit)
+        :param decrypt_all: decrypt all the encrypted fields at once (in parallel for large lists) instead of lazily,
+                            for callers that read all of them
+        :param offset: number of entries skipped (with limit), prefer list_page() for deep pages
         :return: List of entries
         """
-        valid_fields = []
+        query, data, encrypt_fields = self._list_query(fields, filter_object, limit, order, asc, group_by, distinct,
+                                                       random, offset)
+        result = self._execute(query, data, True)
+        return self._decrypt_rows(result, encrypt_fields, decrypt_all)
+
+    def iter_list(self, fields=None, filter_object=None, limit=0, order=None, asc='ASC', chunk_size=500,
+                  decrypt_all=False):
+        """
+        Same as list() but the entries are streamed from the server (unbuffered cursor), chunk_size rows at a time,
+        so that memory does not grow with the size of the table.
+        The pooled connection is held until the generator is exhausted or closed.
+        :param fields: List with column names or None (all the fields will be fetched)
+        :param filter_object: Filter Object (instance of class filter.Filter)
+        :param limit: maximum number of entries to be fetched (all if 0)
+        :param order: field to order by
+        :param asc: order by 'ASC' or 'DESC'
+        :param chunk_size: number of rows fetched from the server at once
+        :param decrypt_all: decrypt all the encrypted fields of each chunk at once instead of lazily
+        :return: generator of entries
+        """
+        query, data, encrypt_fields = self._list_query(fields, filter_object, limit, order, asc)
+        with self.get_adapter(read=True) as adapter:
+            cursor = get_backend().cursor(adapter, stream=True)
+            try:
+                with timed_query(query, data):
+                    cursor.execute(query, tuple(data))
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in self._decrypt_rows(rows, encrypt_fields, decrypt_all):
+                        yield row
+            finally:
+                cursor.close()
+
+    def list_page(self, fields=None, filter_object=None, order=None, asc='ASC', page_size=50, after=None,
+                  decrypt_all=False):
+        """
+        Keyset pagination: return one page of entries sorted by order then by primary key and the cursor of the
+        next page. The page is read from an index range (WHERE sort key > last key) instead of skipping rows,
+        so the cost of a page does not depend on its position.
+        :param fields: List with column names or None (all the fields will be fetched)
+        :param filter_object: Filter Object (instance of class filter.Filter)
+        :param order: NOT NULL and not encrypted column to order by (primary key only if None)
+        :param asc: order by 'ASC' or 'DESC'
+        :param page_size: maximum number of entries of the page
+        :param after: cursor returned with the previous page (first page if None)
+        :param decrypt_all: decrypt all the encrypted fields at once instead of lazily
+        :return: List of entries, cursor of the next page (None on the last page)
+        """
+        metadata = self._metadata()
+        keys = tuple(column for column in metadata.primary_key if column != order)
+        if order is not None:
+            if order not in metadata.column_set or order in metadata.encrypt_fields:
+                raise ValueError('Invalid pagination order: {0}'.format(order))
+            keys = (order,) + keys
+        if asc not in ['ASC', 'DESC']:
+            raise ValueError('Invalid pagination direction: {0}'.format(asc))
         if not fields:
-            for field in self._columns:
-                valid_fields.append('`{0}`'.format(field))
+            valid_fields = metadata.columns
         else:
-            for field in fields:
-                if field in self._columns:
-                    valid_fields.append('`{0}`'.format(field))
+            valid_fields = tuple(field for field in fields if field in metadata.column_set)
+        selected_fields = valid_fields + tuple(key for key in keys if key not in valid_fields)
 
         filter_sql = ''
         data = []
         if filter_object and isinstance(filter_object, Filter):
-            filter_sql, data = filter_object.get()
+            filter_sql, data = self._indexed_filter(filter_object).get()
+        if after is not None:
+            values = decode_cursor(after)
+            if len(values) != len(keys):
+                raise ValueError('Invalid cursor: {0}'.format(after))
+            if filter_sql:
+                filter_sql = '({0}) AND ({1})'.format(filter_sql, keyset_condition(keys, asc))
+            else:
+                filter_sql = keyset_condition(keys, asc)
+            data = list(data) + keyset_data(values)
+
+        # list_statement() appends the direction after the last sort column
+        order_by = ', '.join(['`{0}` {1}'.format(key, asc) for key in keys[:-1]] + ['`{0}`'.format(keys[-1])])
+        query = list_statement(metadata.table, selected_fields, filter_sql, None, order_by, asc, page_size + 1)
+        result = list(self._execute(query, data, True))
+
+        next_cursor = None
+        if len(result) > page_size:
+            result = result[:page_size]
+            next_cursor = encode_cursor([result[-1].get(key) for key in keys])
+
+        for result_line in result:
+            for key in selected_fields[len(valid_fields):]:
+                del result_line[key]
+        encrypt_fields = [field for field in metadata.encrypt_fields if field in valid_fields]
+        return self._decrypt_rows(result, encrypt_fields, decrypt_all), next_cursor
+
+    def list_by(self, key, values, fields=None, conditions=None, order=None, asc='ASC', chunk_size=500):
+        """
+        Batch loader: fetch the entries related to several parents with one IN query per chunk of values instead of
+        one query per parent, and group them by key in a single pass.
+        :param key: column referencing the parent (e.g. user_uuid)
+        :param values: list of parent keys
+        :param fields: List with column names or None (all the fields will be fetched)
+        :param conditions: dict of additional equality conditions (Filter data)
+        :param order: field to order by
+        :param asc: order by 'ASC' or 'DESC'
+        :param chunk_size: maximum number of values per IN query
+        :return: dict {value: list of entries}, with an empty list for the values without entries
+        """
+        grouped = {value: [] for value in values}
+        if len(grouped) == 0:
+            return grouped
+        if key not in self._metadata().column_set:
+            raise ValueError('Unknown column: {0}'.format(key))
+        remove_key = fields is not None and len(fields) > 0 and key not in fields
+        if remove_key:
+            fields = list(fields) + [key]
+
+        values = list(grouped.keys())
+        for index in range(0, len(values), chunk_size):
+            filter_chunk = Filter(data=conditions)
+            filter_chunk.add(key, values[index:index + chunk_size], operator=OperatorType.IIN)
+            for entry in self.list(fields=fields, filter_object=filter_chunk, order=order, asc=asc):
+                if remove_key:
+                    grouped[entry.pop(key)].append(entry)
+                else:
+                    grouped[entry.get(key)].append(entry)
+        return grouped
 
-        if distinct:
-            query = 'SELECT DISTINCT({0}) FROM {1}'.format(', '.join(valid_fields), self._table)
+    def backfill_blind_index(self, column, batch_size=500):
+        """
+        Write the blind index of the entries whose index is missing (created before the index column), computed from
+        their decrypted value. Each batch is committed on its own and only fills NULL indexes, so that the job runs
+        on the live database and can be resumed after an interruption.
+        :param column: encrypted column listed in _blind_index_fields
+        :param batch_size: number of entries per batch
+        :return: number of updated entries
+        """
+        metadata = self._metadata()
+        if column not in metadata.blind_indexes:
+            raise ValueError('No blind index on column: {0}'.format(column))
+        index_column = metadata.blind_indexes[column]
+        filter_missing = Filter()
+        filter_missing.add(column, operator=OperatorType.INN)
+        filter_missing.add(index_column, operator=OperatorType.IN)
+        nb_updated = 0
+        cursor = None
+        while True:
+            entries, cursor = self.list_page(fields=list(metadata.primary_key) + [column], filter_object=filter_missing,
+                                             page_size=batch_size, after=cursor, decrypt_all=True)
+            with transaction():
+                for entry in entries:
+                    filter_entry = Filter(data={key: entry.get(key) for key in metadata.primary_key})
+                    filter_entry.add(index_column, operator=OperatorType.IN)
+                    nb_updated += self.update_where(filter_entry,
+                                                    {index_column: generate_blind_index(entry.get(column))})
+            self.log.info("{0}.{1} backfilled: {2}".format(metadata.table, index_column, nb_updated))
+            if cursor is None:
+                return nb_updated
+
+    def _list_query(self, fields=None, filter_object=None, limit=0, order=None, asc='ASC', group_by=None,
+                    distinct=False, random=False, offset=0):
+        """
+        Build the query of list() and iter_list(). The order and group by columns must be columns of the model.
+        :return: SQL query, data, encrypted fields to decrypt
+        """
+        metadata = self._metadata()
+        if not fields:
+            valid_fields = metadata.columns
         else:
-            query = 'SELECT {0} FROM {1}'.format(', '.join(valid_fields), self._table)
-        if filter_sql:
-            query = '{0} WHERE {1}'.format(query, filter_sql)
+            valid_fields = tuple(field for field in fields if field in metadata.column_set)
+
+        filter_sql = ''
+        data = []
+        if filter_object and isinstance(filter_object, Filter):
+            filter_sql, data = self._indexed_filter(filter_object).get()
+
+        if asc not in ['ASC', 'DESC']:
+            raise ValueError('Invalid order direction: {0}'.format(asc))
         if group_by is not None:
-            if isinstance(group_by, list):
-                group_by = ', '.join(group_by)
-            query = "{0} GROUP BY {1}".format(query, group_by)
+            group_by = quote(self._valid_columns(group_by))
         if order is not None:
-            if isinstance(order, list):
-                order = ', '.join(order)
-            query = "{0} ORDER BY {1} {2}".format(query, order, asc)
-        elif random is True:
-            query = "{0} ORDER BY RAND()".format(query)
-        if limit is not None and limit != 0:
-            query = '{0} LIMIT {1}'.format(query, limit)
-        result = self._execute(query, data, True)
+            order = quote(self._valid_columns(order))
+        query = list_statement(metadata.table, valid_fields, filter_sql, group_by, order, asc, limit, distinct, random,
+                               int(offset or 0))
+        encrypt_fields = [field for field in metadata.encrypt_fields if field in valid_fields]
+        return query, data, encrypt_fields
 
-        # Decrypt encrypted fields
-        if len(self._encrypt_fields) > 0:
-            for result_line in result:
-                for result_column, result_value in result_line.items():
-                    if result_column in self._encrypt_fields and result_value is not None:
-                        result_line[result_column] = self.fernet.decrypt(result_value.encode()).decode()
+    def _valid_columns(self, columns):
+        """
+        Check that the given order or group by columns are columns of the model
+        :param columns: column or list of columns
+        :return: tuple of columns
+        """
+        if isinstance(columns, str):
+            columns = [columns]
+        for column in columns:
+            if column not in self._metadata().column_set:
+                raise ValueError('Unknown column: {0}'.format(column))
+        return tuple(columns)
 
-        return list(result)
+    def _decrypt_rows(self, rows, encrypt_fields, decrypt_all=False):
+        """
+        Wrap the rows with encrypted columns so that they are only decrypted when read,
+        or decrypt them all at once with decrypt_rows() (process pool above APP_BULK_DECRYPT_THRESHOLD values)
+        :param rows: list of entries as stored in database
+        :param encrypt_fields: encrypted columns selected by the query
+        :param decrypt_all:
+        :return: List of entries
+        """
+        if len(encrypt_fields) == 0:
+            return list(rows)
+        if decrypt_all:
+            return decrypt_rows(list(rows), encrypt_fields, *get_cipher())
+        return [LazyRow(row, self.fernet, encrypt_fields) for row in rows]
 
-    def find(self, filter_object=None):
+    def find(self, filter_object=None, for_update=False):
         """
         Find all the entries matching with the specified filters and return their primary keys.
         :param filter_object: Filter Object (instance of class filter.Filter)
+        :param for_update: read from the primary and lock the entries until the end of the transaction()
         :return: List of entries (primary keys)
         """
         filter_sql = ''
         data = []
         if filter_object and isinstance(filter_object, Filter):
-            filter_sql, data = filter_object.get()
+            filter_sql, data = self._indexed_filter(filter_object).get()
 
-        fields = ['`{0}`'.format(field) for field in self._primary_key]
-        query = 'SELECT {0} FROM {1}'.format(', '.join(fields), self._table)
-        if filter_sql:
-            query = '{0} WHERE {1}'.format(query, filter_sql)
+        metadata = self._metadata()
+        query = list_statement(metadata.table, metadata.primary_key, filter_sql)
+        if for_update:
+            query = '{0} FOR UPDATE'.format(query)
 
-        result = self._execute(query, data, True)
-        # Decrypt encrypted fields
-        if len(self._encrypt_fields) > 0:
-            for result_line in result:
-                for result_column, result_value in result_line.items():
-                    if result_column in self._encrypt_fields and result_value is not None:
-                        result_line[result_column] = self.fernet.decrypt(result_value.encode()).decode()
-        return list(result)
-
-    def _execute(self, query, data=None, fetchall=False):
-        # renew adapter
-        self.get_adapter()
-        cursor = self._adapter.cursor()
-        if data is not None:
-            cursor.execute(query, tuple(data))
-        else:
-            cursor.execute(query)
+        result = self._execute(query, data, True, read=not for_update)
+        encrypt_fields = [field for field in metadata.encrypt_fields if field in metadata.primary_key]
+        return self._decrypt_rows(result, encrypt_fields)
+
+    def _execute(self, query, data=None, fetchall=False, read=True):
+        with self.get_adapter(read=read) as adapter:
+            cursor = get_backend().cursor(adapter)
+            with timed_query(query, data):
+                if data is not None:
+                    cursor.execute(query, tuple(data))
+                else:
+                    cursor.execute(query)
 
-        if fetchall:
-            return cursor.fetchall()
+                if fetchall:
+                    return cursor.fetchall()
 
-        return cursor.fetchone()
+                return cursor.fetchone()
 
-    def _run(self, query, data):
-        # renew adapter
-        self.get_adapter()
-        cursor = self._adapter.cursor()
-        cursor.execute(query, tuple(data))
-        last_rowid = cursor.lastrowid
-        self._adapter.commit()
-        return last_rowid
+    def _run(self, query, data, rowcount=False):
+        # the rest of the request reads its own writes
+        _read_routing.primary = True
+        with self.get_adapter() as adapter:
+            cursor = get_backend().cursor(adapter)
+            with timed_query(query, data):
+                cursor.execute(query, tuple(data))
+                last_rowid = cursor.lastrowid
+                if not in_transaction():
+                    adapter.commit()
+            if rowcount:
+                return cursor.rowcount
+            return last_rowid
 
     '''
     @staticmethod
@@ -5,31 +5,35 @@ from datetime import datetime, timedelta
 from os import environ as env
 from random import randrange
 
-from utils.orm.abstract import Abstract
+from utils.orm.abstract import Abstract, utc_now
+from utils.orm.email_index import EmailIndexed
 from utils.orm.filter import Filter
-from utils.security import generate_hash
+from utils.security import generate_password_hash
 from utils.email import check_email_format
 
 
-class AdminAccount(Abstract):
+class AdminAccount(EmailIndexed, Abstract):
     """
     AdminAccount class extends the base class <abstract> and provides object-like access to the admin DB table.
     """
-    def __init__(self, data=None, adapter=None):
-        Abstract.__init__(self, data, adapter)
-        self._table = 'admin'
-        self._columns = ['admin_uuid', 'firstname', 'lastname', 'email', 'email_hash', 'email_validated',
-                         'otp_token', 'otp_expiration', 'password', 'user_salt', 'last_login',
-                         'totp_url', 'totp_base32', 'totp_enabled',
-                         'creator_id', 'created_date', 'updated_date', 'deactivated', 'deactivated_date']
-        self._encrypt_fields = ['email', 'firstname', 'lastname', 'otp_token', 'totp_url', 'totp_base32']
-        self._primary_key = ['admin_uuid']
-        self._defaults = {
-            'created_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            'email_validated': 0,
-            'totp_enabled': 0,
-            'deactivated': 0
-        }
+    __slots__ = ()
+
+    _table = 'admin'
+    _columns = ['admin_uuid', 'firstname', 'lastname', 'email', 'email_hash', 'email_index', 'email_validated',
+                'otp_token', 'otp_expiration', 'password', 'user_salt', 'last_login',
+                'totp_url', 'totp_base32', 'totp_enabled',
+                'creator_id', 'created_date', 'updated_date', 'deactivated', 'deactivated_date']
+    _encrypt_fields = ['email', 'firstname', 'lastname', 'otp_token', 'totp_url', 'totp_base32']
+    _blind_index_fields = ['email']
+    _primary_key = ['admin_uuid']
+    _indexes = [('email_hash',)]
+    _unique_keys = [('email_index',)]
+    _defaults = {
+        'created_date': utc_now,
+        'email_validated': 0,
+        'totp_enabled': 0,
+        'deactivated': 0
+    }
 
     def create_account(self, creator_id: str, email_address: str, firstname: str, lastname: str):
         """
@@ -52,8 +56,7 @@ class AdminAccount(Abstract):
             return False, 400, "error_exist"
 
         password = str(uuid4())[24:]
-        hash_password, unique_salt = generate_hash(password + env['APP_PASSWORD_SALT'])
-        email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
+        hash_password, unique_salt = generate_password_hash(password + env['APP_PASSWORD_SALT'])
 
         user_uuid = str(uuid4())
         try:
@@ -63,9 +66,9 @@ class AdminAccount(Abstract):
                 'email': email_address,
                 'password': hash_password,
                 'user_salt': unique_salt,
-                'email_hash': email_address_hash,
                 'firstname': firstname,
-                'lastname': lastname
+                'lastname': lastname,
+                **self.email_lookup_values(email_address)
             })
             self.insert()
         except Exception as e:
@@ -100,17 +103,17 @@ class AdminAccount(Abstract):
             email_address = email_address.lower()
             if self.is_existing(email_address=email_address) is True:
                 return False, 400, "error_email_exists"
-            email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
             self.set('email', email_address)
-            self.set('email_hash', email_address_hash)
+            for column, value in self.email_lookup_values(email_address).items():
+                self.set(column, value)
             self.set('email_validated', 0)
             updated = True
 
         if old_password is not None and new_password is not None:
-            password_hash, password_salt = generate_hash(data_to_hash=old_password + env['APP_PASSWORD_SALT'],
-                                                         salt=self.get('user_salt'))
+            password_hash, password_salt = generate_password_hash(
+                data_to_hash=old_password + env['APP_PASSWORD_SALT'], salt=self.get('user_salt'))
             if self.get('password') == password_hash:
-                hash_password, unique_salt = generate_hash(new_password + env['APP_PASSWORD_SALT'])
+                hash_password, unique_salt = generate_password_hash(new_password + env['APP_PASSWORD_SALT'])
                 self.set('password', hash_password)
                 self.set('user_salt', unique_salt)
                 updated = True
@@ -157,7 +160,7 @@ class AdminAccount(Abstract):
         if status is False:
             return status, http_code, message
 
-        hash_password, unique_salt = generate_hash(new_password + env['APP_PASSWORD_SALT'])
+        hash_password, unique_salt = generate_password_hash(new_password + env['APP_PASSWORD_SALT'])
         self.set('password', hash_password)
         self.set('user_salt', unique_salt)
         self.set('updated_date', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
@@ -170,13 +173,7 @@ class AdminAccount(Abstract):
         :param email_address:
         :return:
         """
-        email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
-        filter_admin = Filter()
-        filter_admin.add('email_hash', email_address_hash)
-        admin_accounts = self.list(fields=['admin_uuid'], filter_object=filter_admin)
-        if len(admin_accounts) > 0:
-            return True
-        return False
+        return self.exists_by_email(email_address)
 
     def is_admin(self, user_uuid):
         """
@@ -200,8 +197,7 @@ class AdminAccount(Abstract):
             if check_email_format(email_address) is False:
                 return False, 400, "error_email_format"
 
-            email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
-            self.load({'email_hash': email_address_hash, 'deactivated': 0})
+            self.load_by_email(email_address, {'deactivated': 0})
         elif admin_uuid is not None:
             self.load({'admin_uuid': admin_uuid})
 
@@ -225,8 +221,7 @@ class AdminAccount(Abstract):
         if check_email_format(email_address) is False:
             return False, 400, "error_email_format"
 
-        email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
-        self.load({'email_hash': email_address_hash, 'deactivated': 0})
+        self.load_by_email(email_address, {'deactivated': 0})
         if self.get('admin_uuid') is not None and self.get('otp_token') == token:
             if self.get('otp_expiration') < str(datetime.utcnow()):
                 self.set('otp_token', None)
@@ -248,13 +243,12 @@ class AdminAccount(Abstract):
         :param password: password of the user
         :param token: 2fa token to verify (if given) : 2FA email or TOTP if enabled
         """
-        login_hash, email_salt = generate_hash(data_to_hash=login, salt=env['APP_DB_HASH_SALT'])
-        self.load({'email_hash': login_hash, 'deactivated': '0'})
+        self.load_by_email(login, {'deactivated': '0'})
         if self.get('admin_uuid') is None:
             return False, 401, "error_login"
 
-        password_hash, password_salt = generate_hash(data_to_hash=password + env['APP_PASSWORD_SALT'],
-                                                     salt=self.get('user_salt'))
+        password_hash, password_salt = generate_password_hash(data_to_hash=password + env['APP_PASSWORD_SALT'],
+                                                              salt=self.get('user_salt'))
         if self.get('password') == password_hash:
             if token is None:
                 if self.get('totp_enabled') == 1:
@@ -297,13 +291,15 @@ class AdminAccount(Abstract):
         :param admin_uuid:
         :return:
         """
-        self.load({'admin_uuid': admin_uuid})
-        if self.get('admin_uuid') is not None:
-            self.set('deactivated', 1)
-            self.set('deactivated_date', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
-            self.update()
-            return True, 200, "success_deactivated"
-        return False, 400, "error_not_exist"
+        filter_admin = Filter()
+        filter_admin.add('admin_uuid', admin_uuid)
+        nb_deactivated = self.update_where(filter_object=filter_admin, values={
+            'deactivated': 1,
+            'deactivated_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        })
+        if nb_deactivated == 0:
+            return False, 400, "error_not_exist"
+        return True, 200, "success_deactivated"
 
     def reactivate_admin(self, admin_uuid):
         """
@@ -311,10 +307,8 @@ class AdminAccount(Abstract):
         :param admin_uuid:
         :return:
         """
-        self.load({'admin_uuid': admin_uuid})
-        if self.get('admin_uuid') is not None:
-            self.set('deactivated', 0)
-            self.set('deactivated_date', None)
-            self.update()
-            return True, 200, "success_reactivated"
-        return False, 400, "error_not_exist"
+        filter_admin = Filter()
+        filter_admin.add('admin_uuid', admin_uuid)
+        if self.update_where(filter_object=filter_admin, values={'deactivated': 0, 'deactivated_date': None}) == 0:
+            return False, 400, "error_not_exist"
+        return True, 200, "success_reactivated"
@@ -0,0 +1,108 @@
+"""
+Database backends of the models.
+
+A backend lends the connections used by Abstract and transaction(). The SQL they run is generated by
+utils/orm/statements.py in the MySQL dialect (%s placeholders, backquoted identifiers), a backend whose database
+speaks another dialect translates it in its cursors (see utils/orm/sqlite.py).
+"""
+from pymysql.cursors import SSDictCursor
+
+from utils.orm.mysql import get_pool, get_read_pool
+from utils.orm.statements import upsert_statement
+
+_backend = None
+
+
+class Backend(object):
+    """
+    Interface of the backends
+    """
+    name = ''
+
+    def connection(self, read=False):
+        """
+        Borrow a connection, it is given back when the with block exits
+        :param read: the connection only reads (it may be a read replica)
+        :return: context manager yielding a DB-API connection
+        """
+        raise NotImplementedError
+
+    def begin(self, connection):
+        """
+        Start a transaction on a connection of the backend, ended by its commit() or rollback()
+        :param connection:
+        """
+        connection.begin()
+
+    def cursor(self, connection, stream=False):
+        """
+        Cursor of a connection of the backend, returning the rows as dict
+        :param connection:
+        :param stream: fetch the rows from the server as they are read instead of at once (unbuffered)
+        :return: DB-API cursor
+        """
+        raise NotImplementedError
+
+    def upsert_statement(self, table, columns, conflict_keys, update_columns, nb_rows=1):
+        """
+        Statement inserting rows or updating the existing rows they conflict with, the dialects differ too much to be
+        translated by the cursors
+        :param table:
+        :param columns: tuple of inserted columns
+        :param conflict_keys: tuple of the columns of the unique key the rows may conflict on
+        :param update_columns: tuple of the columns updated on conflict, empty to keep the existing rows as they are
+        :param nb_rows: number of rows of the VALUES clause
+        :return: SQL query
+        """
+        return upsert_statement(table, columns, update_columns, nb_rows)
+
+    def full_scans(self, cursor, statement):
+        """
+        Tables read entirely by the query plan of a statement of the ORM, its placeholders are bound to '0'
+        (see migrations.check_query_plans)
+        :param cursor: cursor of a connection of the backend
+        :param statement: SQL statement with %s placeholders
+        :return: list of tables
+        """
+        raise NotImplementedError
+
+
+class MySQLBackend(Backend):
+    """
+    MySQL through the connection pools of the process (primary and read replicas, see utils/orm/mysql.py)
+    """
+    name = 'mysql'
+
+    def connection(self, read=False):
+        if read:
+            return get_read_pool().connection()
+        return get_pool().connection()
+
+    def cursor(self, connection, stream=False):
+        if stream:
+            return connection.cursor(SSDictCursor)
+        return connection.cursor()
+
+    def full_scans(self, cursor, statement):
+        cursor.execute('EXPLAIN {0}'.format(statement), ['0'] * statement.count('%s'))
+        return [row.get('table') for row in cursor.fetchall() if row.get('type') == 'ALL']
+
+
+def get_backend():
+    """
+    Backend used by all the models, MySQL unless set_backend() was called
+    :return: Backend
+    """
+    global _backend
+    if _backend is None:
+        _backend = MySQLBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replace the backend of all the models, e.g. by a SQLiteBackend in the benchmarks
+    :param backend: Backend, None to go back to MySQL
+    """
+    global _backend
+    _backend = backend
@@ -1,7 +1,7 @@
 from uuid import uuid4
-from datetime import datetime
 
-from utils.orm.abstract import Abstract
+from utils.orm.abstract import Abstract, utc_now
+from utils.orm.filter import Filter, OperatorType
 
 
 class TokenOperation(Abstract):
@@ -9,18 +9,20 @@ class TokenOperation(Abstract):
     TokenOperation class extends the base class <abstract> and provides object-like access
     to the token_operation DB table.
     """
-    def __init__(self, data=None, adapter=None):
-        Abstract.__init__(self, data, adapter)
-        self._table = 'token_operation'
-        self._columns = ['token_operation_id', 'token_operation_uuid', 'sender_uuid', 'receiver_uuid', 'sender_address',
-                         'receiver_address', 'token', 'nb_token', 'tx_hash', 'created_date']
-        self._primary_key = ['token_operation_id']
-        self._defaults = {
-            'created_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        }
-        self.NATIVETOKEN = 'NATIVE'
-        self.EUROLFS = 'EUROLFS'
-        self.tokens = [self.NATIVETOKEN, self.EUROLFS]
+    __slots__ = ()
+
+    _table = 'token_operation'
+    _columns = ['token_operation_id', 'token_operation_uuid', 'sender_uuid', 'receiver_uuid', 'sender_address',
+                'receiver_address', 'token', 'nb_token', 'tx_hash', 'created_date']
+    _primary_key = ['token_operation_id']
+    _indexes = [('sender_uuid',), ('receiver_uuid',)]
+    _unique_keys = [('token_operation_uuid',)]
+    _defaults = {
+        'created_date': utc_now
+    }
+    NATIVETOKEN = 'NATIVE'
+    EUROLFS = 'EUROLFS'
+    tokens = [NATIVETOKEN, EUROLFS]
 
     def add_operation(self, receiver_uuid: str, sender_address: str, receiver_address: str, token: str, nb_token: float,
                       tx_hash: str = None, sender_uuid: str = None):
@@ -50,3 +52,46 @@ class TokenOperation(Abstract):
         })
         self.insert()
         return True, 200, "success_operation_saved"
+
+    def add_operations(self, operations: list):
+        """
+        Save several operations in db with a single statement
+        :param operations: list of dict with the add_operation parameters (receiver_uuid, sender_address,
+                           receiver_address, token, nb_token and optionally tx_hash, sender_uuid)
+        :return:
+        """
+        rows = []
+        for operation in operations:
+            if operation.get('token') not in self.tokens:
+                return False, 400, "error_token_unknown"
+            rows.append({
+                'token_operation_uuid': str(uuid4()),
+                'sender_uuid': operation.get('sender_uuid'),
+                'receiver_uuid': operation.get('receiver_uuid'),
+                'sender_address': operation.get('sender_address'),
+                'receiver_address': operation.get('receiver_address'),
+                'token': operation.get('token'),
+                'nb_token': operation.get('nb_token'),
+                'tx_hash': operation.get('tx_hash')
+            })
+        if len(rows) > 0:
+            self.insert_many(rows)
+        return True, 200, "success_operation_saved"
+
+    def count_operations(self, user_uuids: list):
+        """
+        Return the number of operations sent and received by the given users, counted by the database
+        :param user_uuids:
+        :return: dict {user_uuid: {'nb_sent': int, 'nb_received': int}}
+        """
+        counts = {user_uuid: {'nb_sent': 0, 'nb_received': 0} for user_uuid in user_uuids}
+        if len(counts) == 0:
+            return counts
+        for column, key in [('sender_uuid', 'nb_sent'), ('receiver_uuid', 'nb_received')]:
+            filter_operation = Filter()
+            filter_operation.add(column, list(counts.keys()), operator=OperatorType.IIN)
+            operations_counts = self.aggregate(fields={'nb': ('COUNT', '*')}, group_by=[column],
+                                               filter_object=filter_operation)
+            for operations_count in operations_counts:
+                counts[operations_count.get(column)][key] = operations_count.get('nb')
+        return counts
@@ -9,7 +9,8 @@ CREATE TABLE IF NOT EXISTS `admin` (
     `firstname` TEXT NOT NULL,
     `lastname` TEXT NOT NULL,
     `email` TEXT NOT NULL,
-    `email_hash` CHAR(128) NOT NULL,
+    `email_hash` CHAR(128) DEFAULT NULL,
+    `email_index` CHAR(67) UNIQUE DEFAULT NULL,
     `email_validated` INTEGER NOT NULL,
     `otp_token` TEXT DEFAULT NULL,
     `otp_expiration` CHAR(30) DEFAULT NULL,
@@ -24,7 +25,8 @@ CREATE TABLE IF NOT EXISTS `admin` (
     `updated_date` CHAR(30) DEFAULT NULL,
     `deactivated` INTEGER NOT NULL,
     `deactivated_date` CHAR(30) DEFAULT NULL,
-    PRIMARY KEY(`admin_uuid`)
+    PRIMARY KEY(`admin_uuid`),
+    INDEX(`email_hash`)
 );
 
 CREATE TABLE IF NOT EXISTS `user_account` (
@@ -33,12 +35,14 @@ CREATE TABLE IF NOT EXISTS `user_account` (
     `lastname` TEXT DEFAULT NULL,
     `birthdate` TEXT DEFAULT NULL,
     `email` TEXT NOT NULL,
-    `email_hash` CHAR(128) UNIQUE NOT NULL,
+    `email_hash` CHAR(128) UNIQUE DEFAULT NULL,
+    `email_index` CHAR(67) UNIQUE DEFAULT NULL,
     `email_validated` INTEGER NOT NULL,
     `selfie` CHAR(50) DEFAULT NULL,
     `otp_token` TEXT DEFAULT NULL,
     `otp_expiration` CHAR(30) DEFAULT NULL,
     `public_address` TEXT DEFAULT NULL,
+    `public_address_index` CHAR(67) DEFAULT NULL,
     `magiclink_issuer` CHAR(60) UNIQUE DEFAULT NULL,
     `kyc_session_id` CHAR(36) UNIQUE DEFAULT NULL,
     `kyc_status` CHAR(30) DEFAULT NULL,
@@ -49,7 +53,9 @@ CREATE TABLE IF NOT EXISTS `user_account` (
     `updated_date` CHAR(30) DEFAULT NULL,
     `deactivated` INTEGER NOT NULL,
     `deactivated_date` CHAR(30) DEFAULT NULL,
-    PRIMARY KEY(`user_uuid`)
+    PRIMARY KEY(`user_uuid`),
+    INDEX(`public_address_index`),
+    INDEX(`deactivated`, `created_date`)
 );
 
 CREATE TABLE IF NOT EXISTS `beneficiary` (
@@ -62,6 +68,7 @@ CREATE TABLE IF NOT EXISTS `beneficiary` (
     `deactivated` INTEGER NOT NULL,
     `deactivated_date` CHAR(30) DEFAULT NULL,
     PRIMARY KEY(`beneficiary_uuid`),
+    INDEX(`user_uuid`, `deactivated`, `created_date`),
     FOREIGN KEY(`user_uuid`) REFERENCES user_account(`user_uuid`),
     FOREIGN KEY(`beneficiary_user_uuid`) REFERENCES user_account(`user_uuid`)
 );
@@ -78,6 +85,7 @@ CREATE TABLE IF NOT EXISTS `token_claim` (
     `deactivated` INTEGER NOT NULL,
     `deactivated_date` CHAR(30) DEFAULT NULL,
     PRIMARY KEY(`token_claim_uuid`),
+    INDEX(`user_uuid`, `claimed`, `deactivated`),
     FOREIGN KEY(`user_uuid`) REFERENCES user_account(`user_uuid`)
 );
 
@@ -92,6 +100,8 @@ CREATE TABLE IF NOT EXISTS `user_purchase` (
     `tx_hash` TEXT DEFAULT NULL,
     `created_date` CHAR(30) NOT NULL,
     PRIMARY KEY(`user_purchase_uuid`),
+    INDEX(`user_uuid`, `created_date`),
+    INDEX(`created_date`),
     FOREIGN KEY(`user_uuid`) REFERENCES user_account(`user_uuid`)
 );
 
@@ -0,0 +1,120 @@
+"""
+Online migration of the account lookups from email_hash (PBKDF2) to email_index, the blind index of the encrypted
+email column (see Abstract._blind_index_fields).
+
+APP_EMAIL_INDEX_MODE selects the step of the migration:
+- dual (default): email_hash is still written, lookups read email_index then fall back to email_hash for the entries
+  not backfilled yet
+- index: once the backfill is over, only email_index is read, email_hash is reset to NULL
+
+Backfill the blind indexes of the existing entries with: python -m utils.orm.email_index [--batch-size 500]
+"""
+import argparse
+
+from utils import settings
+from utils.orm.filter import Filter
+from utils.security import generate_email_hash, generate_blind_index
+
+EMAIL_INDEX_MODES = ['dual', 'index']
+
+
+def email_index_mode():
+    """
+    Current step of the email_index migration
+    :return: APP_EMAIL_INDEX_MODE, 'dual' by default
+    """
+    mode = settings.get('APP_EMAIL_INDEX_MODE', 'dual')
+    if mode not in EMAIL_INDEX_MODES:
+        raise ValueError('Invalid APP_EMAIL_INDEX_MODE: {0}'.format(mode))
+    return mode
+
+
+class EmailIndexed(object):
+    """
+    Lookup of the accounts by email address, mixed into the models having the email_hash and email_index columns
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def email_lookup_values(email_address: str):
+        """
+        Values of the legacy lookup column to write for the given email address, email_index is written with email
+        :param email_address: address as it is looked up
+        :return: dict (column: value)
+        """
+        if email_index_mode() == 'dual':
+            return {'email_hash': generate_email_hash(email_address)}
+        return {'email_hash': None}
+
+    def load_by_email(self, email_address: str, conditions: dict = None):
+        """
+        Load the entry of the given email address. An entry only found by email_hash gets its email_index written.
+        :param email_address:
+        :param conditions: dict of additional equality conditions
+        :return: True if an entry was found
+        """
+        if self.load(dict(conditions or {}, email=email_address)):
+            return True
+        if email_index_mode() == 'dual':
+            if self.load(dict(conditions or {}, email_hash=generate_email_hash(email_address))):
+                self.set('email_index', generate_blind_index(email_address))
+                self.update()
+                return True
+        return False
+
+    def exists_by_email(self, email_address: str):
+        """
+        Verify if an entry of the given email address exists
+        :param email_address:
+        :return: boolean
+        """
+        filter_index = Filter()
+        filter_index.add('email', email_address)
+        if self.count(filter_object=filter_index) > 0:
+            return True
+        if email_index_mode() == 'dual':
+            filter_hash = Filter()
+            filter_hash.add('email_hash', generate_email_hash(email_address))
+            return self.count(filter_object=filter_hash) > 0
+        return False
+
+    def list_by_emails(self, email_addresses: list, fields: list):
+        """
+        Fetch the entries of several email addresses with one IN query per lookup column
+        :param email_addresses: list of addresses
+        :param fields: List with column names
+        :return: dict {email address: entry} of the addresses having an entry
+        """
+        found = {}
+        indexes = {generate_blind_index(email_address): email_address for email_address in email_addresses}
+        for email_index, entries in self.list_by('email_index', list(indexes.keys()), fields=fields).items():
+            if len(entries) > 0:
+                found[indexes[email_index]] = entries[0]
+
+        missing = [email_address for email_address in email_addresses if email_address not in found]
+        if email_index_mode() == 'dual' and len(missing) > 0:
+            hashes = {generate_email_hash(email_address): email_address for email_address in missing}
+            for email_hash, entries in self.list_by('email_hash', list(hashes.keys()), fields=fields).items():
+                if len(entries) > 0:
+                    found[hashes[email_hash]] = entries[0]
+        return found
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=500, help="number of entries per transaction")
+    args = parser.parse_args()
+
+    load_dotenv(dotenv_path="conf/lifise-api.env")
+    from utils.orm.admin import AdminAccount
+    from utils.orm.user import UserAccount
+    for model in [UserAccount, AdminAccount]:
+        for column in model._blind_index_fields:
+            nb_updated = model().backfill_blind_index(column, batch_size=args.batch_size)
+            print("{0}.{1}: {2} entries backfilled".format(model._table, column, nb_updated))
+
+
+if __name__ == '__main__':
+    main()
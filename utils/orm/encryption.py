@@ -0,0 +1,291 @@
+import sys
+
+from base64 import urlsafe_b64encode
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cryptography.fernet import Fernet
+from multiprocessing import get_context
+from os import environ as env, cpu_count, getpid, path
+from threading import Lock
+
+from utils import settings
+from utils.log import Logger
+
+_ciphers = {}
+_worker_fernet = None
+_decrypt_pool = None
+_decrypt_pool_lock = Lock()
+log = Logger()
+
+
+def get_cipher(secret=None):
+    """
+    Return the Fernet key and instance of the given secret, built once per process and shared by all the models
+    :param secret: APP_DB_KEY if None
+    :return: key, Fernet
+    """
+    if secret is None:
+        secret = env['APP_DB_KEY']
+    cipher = _ciphers.get(secret)
+    if cipher is None:
+        key = urlsafe_b64encode(secret.encode())
+        cipher = (key, Fernet(key=key))
+        _ciphers[secret] = cipher
+    return cipher
+
+
+class LazyRow(dict):
+    """
+    Entry whose encrypted columns are kept as Fernet tokens and only decrypted when they are read.
+
+    A decrypted value is memoized in the row. Reading a single column (row['email'], row.get('email')) decrypts only
+    that column, whereas iterating over the values (items(), values(), json serialization, ==) decrypts the
+    remaining ones. Keys can be iterated and tested without decrypting anything.
+    """
+    __slots__ = ('_fernet', '_encrypted')
+
+    def __init__(self, row=None, fernet=None, encrypt_fields=()):
+        """
+        :param row: dict of column values as stored in database
+        :param fernet: Fernet instance used to decrypt the values
+        :param encrypt_fields: encrypted columns of the row
+        """
+        dict.__init__(self)
+        self._fernet = fernet
+        self._encrypted = set()
+        if row:
+            self.load(row, encrypt_fields)
+
+    def load(self, row, encrypt_fields):
+        """
+        Set column values as stored in database, the encrypted ones are decrypted on first access
+        :param row: dict of column values
+        :param encrypt_fields: encrypted columns of the row
+        :return: self
+        """
+        for key, value in row.items():
+            dict.__setitem__(self, key, value)
+            if value is not None and key in encrypt_fields:
+                self._encrypted.add(key)
+            else:
+                self._encrypted.discard(key)
+        return self
+
+    def _decrypt(self, key):
+        if key in self._encrypted:
+            value = dict.__getitem__(self, key)
+            dict.__setitem__(self, key, self._fernet.decrypt(value.encode()).decode())
+            self._encrypted.discard(key)
+
+    def decrypt_all(self):
+        """
+        Decrypt all the remaining encrypted values
+        :return: self
+        """
+        for key in list(self._encrypted):
+            self._decrypt(key)
+        return self
+
+    def __getitem__(self, key):
+        self._decrypt(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        self._encrypted.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._encrypted.discard(key)
+        dict.__delitem__(self, key)
+
+    def __iter__(self):
+        # overriding __iter__ makes dict(row) and {**row} read the values through __getitem__
+        return dict.__iter__(self)
+
+    def __eq__(self, other):
+        self.decrypt_all()
+        if isinstance(other, LazyRow):
+            other.decrypt_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        return dict, (dict(self.items()),)
+
+    def __or__(self, other):
+        row = self.copy()
+        row.update(other)
+        return row
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def items(self):
+        self.decrypt_all()
+        return dict.items(self)
+
+    def values(self):
+        self.decrypt_all()
+        return dict.values(self)
+
+    def pop(self, key, *default):
+        self._decrypt(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self.decrypt_all()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        row = LazyRow(fernet=self._fernet)
+        dict.update(row, dict.items(self))
+        row._encrypted = set(self._encrypted)
+        return row
+
+
+def bulk_decrypt_threshold():
+    """
+    Number of ciphertexts from which a result set is decrypted by the process pool (see benchmarks/bulk_decrypt.py)
+    :return: APP_BULK_DECRYPT_THRESHOLD, 2000 by default
+    """
+    return settings.get('APP_BULK_DECRYPT_THRESHOLD', 2000, int)
+
+
+def bulk_decrypt_workers():
+    """
+    Number of worker processes of the decryption pool, 0 or 1 disables the pool
+    :return: APP_BULK_DECRYPT_WORKERS, min(4, number of CPUs) by default
+    """
+    return settings.get('APP_BULK_DECRYPT_WORKERS', min(4, cpu_count() or 1), int)
+
+
+def bulk_decrypt_python():
+    """
+    Python interpreter of the spawned workers. Inside uwsgi sys.executable is the uwsgi binary, which can't run them.
+    :return: APP_BULK_DECRYPT_PYTHON, the python of the environment of the process by default
+    """
+    python = settings.get('APP_BULK_DECRYPT_PYTHON')
+    if python is not None:
+        return python
+    if path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+    return path.join(sys.exec_prefix, 'bin', 'python3')
+
+
+def _init_decrypt_worker(key):
+    global _worker_fernet
+    _worker_fernet = Fernet(key)
+
+
+def _decrypt_batch(tokens):
+    return [_worker_fernet.decrypt(token.encode()).decode() for token in tokens]
+
+
+def get_decrypt_pool(key, workers=None):
+    """
+    Return the decryption process pool of the current process, started on first use.
+    Workers are spawned (not forked) with bulk_decrypt_python() so that they never inherit the database connections
+    of the uwsgi worker.
+    :param key: Fernet key
+    :param workers: number of worker processes
+    :return: ProcessPoolExecutor, None if the pool failed in this process (see disable_decrypt_pool)
+    """
+    global _decrypt_pool
+    with _decrypt_pool_lock:
+        if _decrypt_pool is not None and _decrypt_pool[0] != getpid():
+            _decrypt_pool = None
+        if _decrypt_pool is None:
+            context = get_context('spawn')
+            context.set_executable(bulk_decrypt_python())
+            executor = ProcessPoolExecutor(max_workers=workers or bulk_decrypt_workers(), mp_context=context,
+                                           initializer=_init_decrypt_worker, initargs=(key,))
+            _decrypt_pool = (getpid(), executor)
+        return _decrypt_pool[1]
+
+
+def disable_decrypt_pool(error):
+    """
+    Decrypt serially for the rest of the life of the current process once the pool failed, instead of starting a
+    new pool (and failing again) on each call
+    :param error: exception raised by the pool
+    """
+    global _decrypt_pool
+    log.error("Bulk decryption pool disabled in process {0}: {1!r}".format(getpid(), error))
+    with _decrypt_pool_lock:
+        if _decrypt_pool is not None and _decrypt_pool[1] is not None:
+            _decrypt_pool[1].shutdown(wait=False, cancel_futures=True)
+        _decrypt_pool = (getpid(), None)
+
+
+def bulk_decrypt(tokens, key, fernet=None, workers=None, threshold=None):
+    """
+    Decrypt a list of Fernet tokens, in batches spread over a process pool when the list is large enough.
+    Fernet does not release the GIL so threads would not run the decryptions in parallel.
+    :param tokens: list of tokens (str)
+    :param key: Fernet key
+    :param fernet: Fernet instance used below the threshold
+    :param workers: number of worker processes (bulk_decrypt_workers())
+    :param threshold: minimum number of tokens decrypted by the pool (bulk_decrypt_threshold())
+    :return: list of plaintexts in the same order
+    """
+    workers = workers or bulk_decrypt_workers()
+    threshold = threshold or bulk_decrypt_threshold()
+    if workers > 1 and len(tokens) >= threshold:
+        # a few batches per worker to balance the load without paying the IPC cost for each token
+        batch_size = -(-len(tokens) // (workers * 4))
+        batches = [tokens[index:index + batch_size] for index in range(0, len(tokens), batch_size)]
+        try:
+            pool = get_decrypt_pool(key, workers)
+            if pool is not None:
+                results = pool.map(_decrypt_batch, batches)
+                return [plaintext for batch in results for plaintext in batch]
+        except (BrokenProcessPool, OSError, RuntimeError) as e:
+            # the workers could not start (e.g. missing interpreter) or died
+            disable_decrypt_pool(e)
+
+    fernet = fernet or Fernet(key)
+    return [fernet.decrypt(token.encode()).decode() for token in tokens]
+
+
+def decrypt_rows(rows, encrypt_fields, key, fernet=None):
+    """
+    Decrypt in place all the encrypted columns of a result set with bulk_decrypt()
+    :param rows: list of entries as stored in database
+    :param encrypt_fields: encrypted columns of the entries
+    :param key: Fernet key
+    :param fernet: Fernet instance used for small result sets
+    :return: rows
+    """
+    positions = []
+    tokens = []
+    for row in rows:
+        for column in encrypt_fields:
+            value = row.get(column)
+            if value is not None:
+                positions.append((row, column))
+                tokens.append(value)
+    for (row, column), plaintext in zip(positions, bulk_decrypt(tokens, key, fernet)):
+        row[column] = plaintext
+    return rows
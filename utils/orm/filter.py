@@ -1,3 +1,11 @@
+import re
+
+from functools import lru_cache
+from pymysql.converters import escape_item
+
+FILTER_CACHE_SIZE = 512
+COLUMN_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
 
 class OperatorType:
     AND = 'AND'
@@ -13,6 +21,7 @@ class OperatorType:
     LIKE = 'LIKE'
     IIN = 'IIN'
     NIN = 'NIN'
+    BETWEEN = 'BETWEEN'
 
     _TYPE_MAPPING = {
         AND: 'AND',
@@ -27,7 +36,8 @@ class OperatorType:
         INN: 'IS NOT NULL',
         LIKE: 'LIKE',
         IIN: 'IN',
-        NIN: 'NOT IN'
+        NIN: 'NOT IN',
+        BETWEEN: 'BETWEEN'
     }
 
     @staticmethod
@@ -39,10 +49,48 @@ class OperatorType:
         return operator
 
 
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def compile_shape(shape):
+    """
+    SQL of a filter shape, compiled once per shape whatever the values are.
+    A shape is a tuple (operator, items) where an item is a nested shape or a condition (column, SQL operator,
+    number of values).
+    :param shape: Filter.shape()
+    :return: SQL condition with %s placeholders
+    """
+    operator, items = shape
+    conditions = []
+    for item in items:
+        if len(item) == 2:
+            sql = compile_shape(item)
+            if sql:
+                conditions.append('({0})'.format(sql))
+            continue
+
+        column, sql_operator, nb_values = item
+        if sql_operator == 'IS NULL' or sql_operator == 'IS NOT NULL':
+            conditions.append('`{0}` {1}'.format(column, sql_operator))
+        elif sql_operator == 'IN' or sql_operator == 'NOT IN':
+            if nb_values == 0:
+                # nothing is IN an empty list, everything is NOT IN it
+                conditions.append('1 = 0' if sql_operator == 'IN' else '1 = 1')
+            else:
+                conditions.append('`{0}` {1} ({2})'.format(column, sql_operator, ', '.join(['%s'] * nb_values)))
+        elif sql_operator == 'BETWEEN':
+            conditions.append('`{0}` BETWEEN %s AND %s'.format(column))
+        else:
+            conditions.append('`{0}` {1} %s'.format(column, sql_operator))
+    return ' {0} '.format(operator).join(conditions)
+
+
 class Filter(object):
     """
     Filter object used for advanced DB queries with multiple conditions.
 
+    A filter is a small condition tree: its conditions, and the nested filters added with add_group(), are joined
+    with its operator. The SQL is compiled once per shape (columns, operators, number of values) and the values
+    are always sent as query parameters.
+
     :operator: The OperatorType that will be used when joining query conditions
     :data: Load the data provided as dict; the default operator will
            be used for generating the conditions ( OperatorType.EQ ).
@@ -55,9 +103,10 @@ class Filter(object):
                be used for generating the conditions ( OperatorType.EQ ).
         """
 
-        self._unprocessed_data_values = []
-        self._data = []
+        self._items = []
         self._operator = OperatorType.get(operator)
+        if self._operator not in ['AND', 'OR']:
+            raise ValueError('Invalid join operator: {0}'.format(operator))
 
         if data:
             if not isinstance(data, dict):
@@ -69,9 +118,9 @@ class Filter(object):
     def data(self):
         """
         data getter
-        :return: list of sets or empty list
+        :return: list of conditions (column, SQL operator, value) and nested filters, or empty list
         """
-        return self._data
+        return self._items
 
     @data.setter
     def data(self, data):
@@ -81,84 +130,108 @@ class Filter(object):
                      [('key1', OperatorType, 'value1'),
                       ('key2', OperatorType, 'value2')]
         """
-        if not isinstance(data, list) or not isinstance(data, tuple):
+        if not isinstance(data, (list, tuple)):
             raise ValueError('Invalid set of data provided')
         for filter_set in data:
             if not isinstance(filter_set, tuple) or len(filter_set) != 3:
                 raise ValueError('Invalid filter data set: {0}'.format(filter_set))
-            self.add(*filter_set)
+            key, operator, value = filter_set
+            self.add(key, value, operator)
 
     @data.deleter
     def data(self):
         """
         Reinitialize data
         """
-        self._data = []
-        self._unprocessed_data_values = []
+        self._items = []
 
     def add(self, key, value=None, operator=OperatorType.EQ):
         """
         Sets a new condition to the filter
         Add the given condition (key, value, operator) to the filter
         :param key:
-        :param value:
+        :param value: list of values for IIN and NIN, [low, high] for BETWEEN, none for IN and INN
         :param operator: OperatorType
         """
-        if operator == OperatorType.IN or operator == OperatorType.INN:
-            if not key:
-                raise ValueError('Key cannot be empty')
-            try:
-                key = '`{0}`'.format(key)
-            except Exception as ex:
-                raise ValueError('Invalid key/value specified. Error : {0}'.format(str(ex)))
-            self._data.append((key, OperatorType.get(operator)))
-            return
+        if not key or not isinstance(key, str) or not COLUMN_PATTERN.match(key):
+            raise ValueError('Invalid key: {0}'.format(key))
 
-        if not key or not value:
-            raise ValueError('Key/Value cannot be empty')
+        sql_operator = OperatorType.get(operator)
+        if sql_operator == 'IS NULL' or sql_operator == 'IS NOT NULL':
+            self._items.append((key, sql_operator, None))
+            return
 
-        self._unprocessed_data_values.append(value)
-        if operator == OperatorType.IIN or operator == OperatorType.NIN:
-            if not key:
-                raise ValueError('Key cannot be empty')
-            if not isinstance(value, list):
+        if sql_operator == 'IN' or sql_operator == 'NOT IN':
+            if not isinstance(value, (list, tuple)):
                 raise ValueError('Value must be a list')
+            value = list(value)
+        elif sql_operator == 'BETWEEN':
+            if not isinstance(value, (list, tuple)) or len(value) != 2 or None in value:
+                raise ValueError('Value must be a list of two bounds')
+            value = list(value)
+        elif value is None or value == '' or isinstance(value, (list, tuple, dict)):
+            raise ValueError('Key/Value cannot be empty')
+        self._items.append((key, sql_operator, value))
 
-        try:
-            key = '`{0}`'.format(key)
-            if isinstance(value, list):
-                pass
-            elif isinstance(value, str):
-                value = "'{0}'".format(value)
-            else:
-                value = "{0}".format(value.encode('utf-8'))
-        except Exception as ex:
-            raise ValueError('Invalid key/value specified. Error : {0}'.format(str(ex)))
-        self._data.append((key, OperatorType.get(operator), value))
-
-    def _generate_sql(self, hide_data=False):
+    def add_group(self, filter_object):
         """
-        Generate filter SQL
-        :param hide_data: Set to False in case you want to send the data separately to the SQL Cursor
-        :return:
+        Add a nested group of conditions, e.g. a Filter(OperatorType.OR) inside an AND filter
+        :param filter_object: Filter
         """
+        if not isinstance(filter_object, Filter):
+            raise ValueError('Invalid filter group')
+        self._items.append(filter_object)
 
-        if not self._data:
-            return ''
-
-        conditions = []
-        for filter_set in self._data:
-            if filter_set[1] == 'IS NULL' or filter_set[1] == 'IS NOT NULL':
-                conditions.append(' '.join(filter_set))
-            elif hide_data:
-                filter_set_masked = (filter_set[0], filter_set[1], '%s')
-                conditions.append(' '.join(filter_set_masked))
+    def shape(self):
+        """
+        Structure of the filter without its values, key of the compiled SQL (see compile_shape())
+        :return: tuple
+        """
+        items = []
+        for item in self._items:
+            if isinstance(item, Filter):
+                items.append(item.shape())
+            elif isinstance(item[2], list):
+                items.append((item[0], item[1], len(item[2])))
             else:
-                conditions.append(' '.join(filter_set))
+                items.append((item[0], item[1], 0))
+        return self._operator, tuple(items)
 
-        operator = ' {0} '.format(OperatorType.get(self._operator))
-        sql = operator.join(conditions)
-        return sql
+    def values(self):
+        """
+        Query parameters of the filter, in the order of the placeholders of its SQL
+        :return: list
+        """
+        values = []
+        for item in self._items:
+            if isinstance(item, Filter):
+                values.extend(item.values())
+            elif isinstance(item[2], list):
+                values.extend(item[2])
+            elif item[2] is not None:
+                values.append(item[2])
+        return values
+
+    def rewrite(self, columns):
+        """
+        Copy of the filter where the equality conditions (=, !=, IN, NOT IN) on the given columns are made on other
+        columns with transformed values, e.g. on the blind index of an encrypted column
+        :param columns: dict {column: (new column, function applied to each value)}
+        :return: Filter
+        """
+        rewritten = Filter()
+        rewritten._operator = self._operator
+        for item in self._items:
+            if isinstance(item, Filter):
+                item = item.rewrite(columns)
+            elif item[0] in columns and item[1] in ['=', '!=', 'IN', 'NOT IN']:
+                new_column, function = columns[item[0]]
+                if isinstance(item[2], list):
+                    item = (new_column, item[1], [function(value) for value in item[2]])
+                else:
+                    item = (new_column, item[1], function(item[2]))
+            rewritten._items.append(item)
+        return rewritten
 
     def get(self, nested_data=False):
         """
@@ -167,7 +240,7 @@ class Filter(object):
         :param nested_data: Include or not data in the query
         :return: SQL Filter and data
         """
-        filter_sql = self._generate_sql(not nested_data)
+        filter_sql = compile_shape(self.shape())
         if nested_data:
-            return filter_sql, None
-        return filter_sql, self._unprocessed_data_values
+            return filter_sql % tuple(escape_item(value, 'utf8mb4') for value in self.values()), None
+        return filter_sql, self.values()
@@ -0,0 +1,70 @@
+"""
+Request-scoped identity map: the rows loaded by their primary key are kept on Flask's g until the end of the request,
+so that loading the same entry again (e.g. in user_required then in the route) does not query the database.
+
+The map is keyed by (table, primary key values). Abstract keeps it up to date with its own writes: update() merges
+the written columns, delete() and the statements writing several entries (update_where, delete_list, ...) drop the
+entries of the table, and a rolled back transaction() drops the whole map. Outside of a Flask application context
+(scripts, CLI) the map is disabled.
+"""
+from flask import g, has_app_context
+
+
+def _identity_map():
+    if not has_app_context():
+        return None
+    identity_map = g.get('_identity_map')
+    if identity_map is None:
+        identity_map = g._identity_map = {}
+    return identity_map
+
+
+def get_row(table, key):
+    """
+    Row of the entry of the given primary key, if it was loaded or written by the current request
+    :param table: table of the model
+    :param key: tuple of the primary key values
+    :return: LazyRow or None
+    """
+    identity_map = _identity_map()
+    if identity_map is None:
+        return None
+    return identity_map.get((table, key))
+
+
+def store_row(table, key, row):
+    """
+    Keep the row of an entry for the rest of the request
+    :param table: table of the model
+    :param key: tuple of the primary key values
+    :param row: LazyRow of all the columns of the entry, it must not be shared with a model instance
+    """
+    identity_map = _identity_map()
+    if identity_map is not None:
+        identity_map[(table, key)] = row
+
+
+def discard_row(table, key):
+    """
+    Forget the row of an entry
+    :param table: table of the model
+    :param key: tuple of the primary key values
+    """
+    identity_map = _identity_map()
+    if identity_map is not None:
+        identity_map.pop((table, key), None)
+
+
+def discard_table(table=None):
+    """
+    Forget the rows of a table, after a statement whose written entries are not known
+    :param table: table of the model, all the tables if None
+    """
+    identity_map = _identity_map()
+    if identity_map is None:
+        return
+    if table is None:
+        identity_map.clear()
+        return
+    for key in [key for key in identity_map if key[0] == table]:
+        del identity_map[key]
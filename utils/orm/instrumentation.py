@@ -0,0 +1,142 @@
+"""
+SQL instrumentation of the ORM: every statement run by Abstract is timed and counted per request and per query shape.
+
+The shape of a statement is its SQL with the literals replaced by ? and the lists of placeholders collapsed, so that
+the statements differing only by their values (or by the length of an IN list) are aggregated together.
+Statements slower than APP_SLOW_QUERY_MS are logged with the route of the request and their number of bound
+parameters; the values themselves are never logged.
+"""
+import re
+
+from contextlib import contextmanager
+from functools import lru_cache
+from os import getpid
+from threading import Lock, local
+from time import perf_counter
+
+from utils import settings
+from utils.log import Logger
+
+SHAPE_CACHE_SIZE = 1024
+MAX_SHAPES = 500
+_STRING_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER_PATTERN = re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?\b')
+_LIST_PATTERN = re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)')
+_SPACE_PATTERN = re.compile(r'\s+')
+
+_request = local()
+_shapes = {}
+_shapes_lock = Lock()
+log = Logger()
+
+
+def slow_query_threshold():
+    """
+    Duration from which a statement is logged
+    :return: APP_SLOW_QUERY_MS in milliseconds, 500 by default, 0 disables the log
+    """
+    return settings.get('APP_SLOW_QUERY_MS', 500, float)
+
+
+@lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def query_shape(query):
+    """
+    Normalize a statement into its shape, e.g. "SELECT ... WHERE `id` IN (%s, %s) LIMIT 10" gives
+    "SELECT ... WHERE `id` IN (?) LIMIT ?"
+    :param query: SQL statement
+    :return: string
+    """
+    shape = _STRING_PATTERN.sub('?', query)
+    shape = _NUMBER_PATTERN.sub('?', shape)
+    shape = shape.replace('%s', '?')
+    shape = _LIST_PATTERN.sub('(?)', shape)
+    return _SPACE_PATTERN.sub(' ', shape).strip()
+
+
+def start_request(route=None):
+    """
+    Called at the start of each request: reset the counters of the current thread
+    :param route: name of the route of the request, written in the slow query log
+    """
+    _request.route = route
+    _request.count = 0
+    _request.duration = 0.0
+
+
+def request_stats():
+    """
+    Statements run by the current request so far
+    :return: dict (count, duration in milliseconds)
+    """
+    return {'count': getattr(_request, 'count', 0), 'duration': round(getattr(_request, 'duration', 0.0), 3)}
+
+
+def record_query(query, nb_params, duration):
+    """
+    Account a statement to the current request and to its shape, and log it if it is slow
+    :param query: SQL statement
+    :param nb_params: number of bound parameters
+    :param duration: duration in milliseconds
+    """
+    _request.count = getattr(_request, 'count', 0) + 1
+    _request.duration = getattr(_request, 'duration', 0.0) + duration
+
+    shape = query_shape(query)
+    with _shapes_lock:
+        stats = _shapes.get(shape)
+        if stats is None:
+            if len(_shapes) >= MAX_SHAPES:
+                # the shapes are bounded, ad hoc statements must not grow the process memory
+                shape = '(other)'
+                stats = _shapes.get(shape)
+            if stats is None:
+                # the first statement of the shape is kept for its query plan (see migrations.check_query_plans)
+                stats = _shapes[shape] = [0, 0.0, 0.0, query]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+
+    threshold = slow_query_threshold()
+    if 0 < threshold <= duration:
+        log.warning("Slow query {0:.1f} ms on {1}, {2} parameters: {3}".format(
+            duration, getattr(_request, 'route', None), nb_params, shape))
+
+
+@contextmanager
+def timed_query(query, data=None):
+    """
+    Time the statement run in the with block and record it with record_query()
+    :param query: SQL statement
+    :param data: bound parameters
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record_query(query, len(data) if data is not None else 0, (perf_counter() - start) * 1000)
+
+
+def query_stats(limit=50):
+    """
+    Statements run by the current process since it started, aggregated by shape
+    :param limit: number of shapes returned, the ones with the highest total duration first, all if None
+    :return: dict
+    """
+    with _shapes_lock:
+        shapes = [(shape, stats[0], stats[1], stats[2], stats[3]) for shape, stats in _shapes.items()]
+    shapes.sort(key=lambda item: item[2], reverse=True)
+    return {
+        'pid': getpid(),
+        'nb_shapes': len(shapes),
+        'queries': [{'shape': shape, 'statement': statement, 'count': count, 'total_ms': round(total, 3),
+                     'max_ms': round(maximum, 3), 'avg_ms': round(total / count, 3)}
+                    for shape, count, total, maximum, statement in shapes[:limit]]
+    }
+
+
+def reset_query_stats():
+    """
+    Forget the statements aggregated by the current process
+    """
+    with _shapes_lock:
+        _shapes.clear()
@@ -0,0 +1,263 @@
+"""
+Schema management of the models.
+
+The tables are described by db_structure.sql and the secondary indexes their queries rely on are declared by the
+models (Abstract._indexes). apply() creates the missing tables, columns and indexes and is run at each deployment
+before the API restarts, as the models select all the columns of db_structure.sql: a column is added after the column
+preceding it in the file, a column whose nullability differs from the file is modified, an index is only added when
+no existing index (primary key, unique or foreign key ones included) starts with its columns.
+
+check_query_plans() runs EXPLAIN on the statements recorded by the instrumentation of the ORM and reports the ones
+reading a whole table. The tests run it on SQLite for the statements of the lookups of the routes
+(tests/test_query_plans.py), the check command runs it on MySQL for the statements recorded by a worker.
+
+Usage:
+    python -m utils.orm.migrations apply [--dry-run]    # --dry-run fails when the database is not up to date
+    python -m utils.orm.migrations check queries.json    # response of GET /api/v1/admin/debug/queries?limit=500
+"""
+import argparse
+import json
+import os
+import sys
+
+from utils.orm.backend import get_backend
+from utils.orm.instrumentation import query_stats
+from utils.orm.mysql import get_pool
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_structure.sql')
+INDEX_NAME_LENGTH = 64
+EXPLAINED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def get_models():
+    """
+    Models whose indexes are managed
+    :return: list of Abstract classes
+    """
+    from utils.orm.admin import AdminAccount
+    from utils.orm.blockchain import TokenOperation
+    from utils.orm.user import UserAccount, Beneficiary, TokenClaim, UserPurchase
+    return [AdminAccount, UserAccount, Beneficiary, TokenClaim, UserPurchase, TokenOperation]
+
+
+def table_statements(schema_file=SCHEMA_FILE):
+    """
+    CREATE TABLE statements of the schema file, in the order of the file (referenced tables first)
+    :param schema_file: path of the SQL file
+    :return: list of (table, statement)
+    """
+    with open(schema_file) as file:
+        content = '\n'.join(line for line in file.read().splitlines() if not line.strip().startswith('--'))
+    statements = []
+    for statement in content.split(';'):
+        statement = statement.strip()
+        if statement.upper().startswith('CREATE TABLE'):
+            table = statement.split('(', 1)[0].split()[-1].strip('`')
+            statements.append((table, statement))
+    return statements
+
+
+def table_columns(statement):
+    """
+    Column definitions of a CREATE TABLE statement of the schema file, one column per line
+    :param statement: CREATE TABLE statement
+    :return: list of (column, definition)
+    """
+    columns = []
+    for line in statement.split('(', 1)[1].splitlines():
+        line = line.strip().rstrip(',')
+        if line.startswith('`'):
+            columns.append((line.split('`')[1], line))
+    return columns
+
+
+def index_name(table, columns):
+    """
+    :param table:
+    :param columns: tuple of indexed columns
+    :return: name of the index created for the columns
+    """
+    return 'idx_{0}_{1}'.format(table, '_'.join(columns))[:INDEX_NAME_LENGTH]
+
+
+def existing_indexes(cursor, table):
+    """
+    Indexes of a table of the current database
+    :param cursor:
+    :param table:
+    :return: dict {index name: list of columns in index order}
+    """
+    cursor.execute('SELECT `INDEX_NAME` as name, `COLUMN_NAME` as col FROM information_schema.STATISTICS '
+                   'WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = %s ORDER BY `INDEX_NAME`, `SEQ_IN_INDEX`',
+                   (table,))
+    indexes = {}
+    for row in cursor.fetchall():
+        indexes.setdefault(row['name'], []).append(row['col'])
+    return indexes
+
+
+def is_covered(columns, indexes):
+    """
+    Verify if an index starting with the given columns exists
+    :param columns: tuple of columns
+    :param indexes: dict {index name: list of columns}
+    :return: boolean
+    """
+    return any(tuple(index[:len(columns)]) == tuple(columns) for index in indexes.values())
+
+
+def missing_tables(cursor, schema_file=SCHEMA_FILE):
+    """
+    Statements creating the tables of the schema file missing from the database
+    :param cursor:
+    :param schema_file: path of the SQL file describing the tables
+    :return: list of (table, CREATE TABLE statement)
+    """
+    cursor.execute('SELECT `TABLE_NAME` as name FROM information_schema.TABLES WHERE `TABLE_SCHEMA` = DATABASE()')
+    tables = set(row['name'] for row in cursor.fetchall())
+    return [(table, statement) for table, statement in table_statements(schema_file) if table not in tables]
+
+
+def is_nullable(definition):
+    """
+    :param definition: column definition of the schema file
+    :return: True if the column accepts NULL
+    """
+    return ' NOT NULL' not in definition.upper()
+
+
+def column_changes(cursor, schema_file=SCHEMA_FILE, skipped_tables=()):
+    """
+    Statements adding the columns of the schema file missing from the tables of the database, and modifying the columns
+    whose nullability differs from the schema file (e.g. email_hash made nullable for the email_index migration)
+    :param cursor:
+    :param schema_file: path of the SQL file describing the tables
+    :param skipped_tables: tables whose columns are not checked (e.g. not created yet)
+    :return: list of ALTER TABLE statements
+    """
+    cursor.execute('SELECT `TABLE_NAME` as name, `COLUMN_NAME` as col, `IS_NULLABLE` as nullable '
+                   'FROM information_schema.COLUMNS WHERE `TABLE_SCHEMA` = DATABASE()')
+    existing = {(row['name'], row['col']): row['nullable'] == 'YES' for row in cursor.fetchall()}
+    statements = []
+    for table, statement in table_statements(schema_file):
+        if table in skipped_tables:
+            continue
+        previous = None
+        for column, definition in table_columns(statement):
+            if (table, column) not in existing:
+                position = ' AFTER `{0}`'.format(previous) if previous is not None else ' FIRST'
+                statements.append('ALTER TABLE `{0}` ADD COLUMN {1}{2}'.format(table, definition, position))
+            elif existing[(table, column)] != is_nullable(definition):
+                # the UNIQUE key of the column already exists, MODIFY would add a second one
+                definition = ' '.join(word for word in definition.split(' ') if word.upper() != 'UNIQUE')
+                statements.append('ALTER TABLE `{0}` MODIFY {1}'.format(table, definition))
+            previous = column
+    return statements
+
+
+def missing_indexes(cursor, models=None, skipped_tables=()):
+    """
+    Statements creating the indexes declared by the models missing from the database
+    :param cursor:
+    :param models: list of models (get_models() if None)
+    :param skipped_tables: tables whose indexes are not checked (e.g. not created yet)
+    :return: list of ALTER TABLE statements
+    """
+    statements = []
+    for model in models or get_models():
+        metadata = model._meta
+        if metadata.table in skipped_tables:
+            continue
+        indexes = existing_indexes(cursor, metadata.table)
+        for columns in metadata.indexes:
+            if not is_covered(columns, indexes):
+                name = index_name(metadata.table, columns)
+                statements.append('ALTER TABLE `{0}` ADD INDEX `{1}` ({2})'.format(
+                    metadata.table, name, ', '.join('`{0}`'.format(column) for column in columns)))
+                indexes[name] = list(columns)
+    return statements
+
+
+def apply(dry_run=False, models=None, schema_file=SCHEMA_FILE):
+    """
+    Create the missing tables, then add the missing columns and align the nullability of the existing ones, then
+    create the missing indexes. Running it again does nothing.
+    With dry_run the indexes of the tables to create are not listed: they depend on their CREATE TABLE statement.
+    :param dry_run: only return the statements
+    :param models: list of models (get_models() if None)
+    :param schema_file: path of the SQL file describing the tables
+    :return: list of SQL statements (to be) run
+    """
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        tables = missing_tables(cursor, schema_file)
+        statements = [statement for table, statement in tables]
+        created = [table for table, statement in tables]
+        statements += column_changes(cursor, schema_file, skipped_tables=created)
+        if dry_run:
+            return statements + missing_indexes(cursor, models, skipped_tables=created)
+
+        # DDL statements are committed implicitly
+        for statement in statements:
+            cursor.execute(statement)
+        for statement in missing_indexes(cursor, models):
+            cursor.execute(statement)
+            statements.append(statement)
+    return statements
+
+
+def check_query_plans(statements=None):
+    """
+    Find the statements reading a whole table, with the query planner of the backend of the models. The statements
+    without WHERE clause (e.g. listing all the entries) and the ones that can't be explained (INSERT, COMMIT) are
+    ignored.
+    :param statements: list of SQL statements, the ones recorded by the current process (query_stats()) if None
+    :return: list of (statement, list of the tables read entirely)
+    """
+    if statements is None:
+        statements = [query['statement'] for query in query_stats(limit=None)['queries']]
+
+    backend = get_backend()
+    full_scans = []
+    with backend.connection() as connection:
+        cursor = backend.cursor(connection)
+        for statement in statements:
+            if not statement.lstrip().upper().startswith(EXPLAINED_STATEMENTS) or ' WHERE ' not in statement.upper():
+                continue
+            tables = backend.full_scans(cursor, statement)
+            if tables:
+                full_scans.append((statement, tables))
+    return full_scans
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_apply = subparsers.add_parser('apply', help="create the missing tables, columns and indexes")
+    parser_apply.add_argument('--dry-run', action='store_true',
+                              help="only print the statements, fail if there are some")
+    parser_check = subparsers.add_parser('check', help="EXPLAIN the statements and fail on full table scans")
+    parser_check.add_argument('queries', help="JSON file returned by GET /api/v1/admin/debug/queries")
+    args = parser.parse_args()
+
+    load_dotenv(dotenv_path="conf/lifise-api.env")
+    if args.command == 'apply':
+        statements = apply(dry_run=args.dry_run)
+        for statement in statements:
+            print("{0};".format(statement))
+        # a deployment checking the schema with --dry-run stops when it is not up to date
+        return 1 if args.dry_run and statements else 0
+
+    with open(args.queries) as file:
+        statements = [query['statement'] for query in json.load(file)['queries']]
+    full_scans = check_query_plans(statements)
+    for statement, tables in full_scans:
+        print("Full scan of {0}: {1}".format(', '.join(tables), statement))
+    print("{0} statements checked, {1} full table scans".format(len(statements), len(full_scans)))
+    return 1 if full_scans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
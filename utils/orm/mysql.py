@@ -1,11 +1,19 @@
+import os
 import pymysql
 import pymysql.cursors
 
-from threading import Thread
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Condition, Lock
+from time import monotonic
 from queue import Queue
 from os import environ as env
+from pymysql.constants import CLIENT
 
-__all__ = ['get_connection', 'get_user_connection', 'get_singleton_user_connection', 'reset_connection']
+from utils import settings
+
+__all__ = ['get_connection', 'get_user_connection', 'get_singleton_user_connection', 'reset_connection',
+           'get_pool', 'get_read_pool', 'get_replicas', 'ConnectionPool', 'Replica', 'PoolTimeoutError']
 
 
 class Adapter(Thread):
@@ -65,7 +73,339 @@ class Adapter(Thread):
         self.execute('--close--')
 
 
+class PoolTimeoutError(Exception):
+    """
+    Raised when no connection could be borrowed from the pool before the timeout.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of MySQL connections owned by a single process.
+
+    Connections are created lazily up to max_size, pinged before reuse when they have been idle for more than
+    ping_interval seconds and closed once idle for more than idle_timeout seconds.
+    Pooled connections run in autocommit mode so that a borrowed connection never carries an open snapshot
+    from a previous borrower, and report matched rows (FOUND_ROWS) as the rowcount of UPDATE statements.
+    """
+
+    def __init__(self, max_size: int = None, timeout: float = None, idle_timeout: float = None,
+                 ping_interval: float = None, host: str = None, port: int = None, connect_timeout: float = None):
+        """
+        :param max_size: maximum number of open connections (SQL_POOL_SIZE)
+        :param timeout: seconds to wait for a free connection before failing (SQL_POOL_TIMEOUT)
+        :param idle_timeout: seconds after which an idle connection is closed (SQL_POOL_IDLE_TIMEOUT)
+        :param ping_interval: seconds of inactivity after which a connection is checked before reuse
+                              (SQL_POOL_PING_INTERVAL)
+        :param host: MySQL server (SQL_HOST)
+        :param port: MySQL port (SQL_PORT)
+        :param connect_timeout: seconds to wait for a new connection (pymysql default if None)
+        """
+        self.max_size = max_size or settings.get('SQL_POOL_SIZE', 5, int)
+        self.timeout = timeout if timeout is not None else settings.get('SQL_POOL_TIMEOUT', 10, float)
+        self.idle_timeout = idle_timeout if idle_timeout is not None else \
+            settings.get('SQL_POOL_IDLE_TIMEOUT', 300, float)
+        self.ping_interval = ping_interval if ping_interval is not None else \
+            settings.get('SQL_POOL_PING_INTERVAL', 30, float)
+        self.host = host or env['SQL_HOST']
+        self.port = port or int(env['SQL_PORT'])
+        self.connect_timeout = connect_timeout
+        self.pid = os.getpid()
+
+        self._idle = deque()
+        self._size = 0
+        self._condition = Condition()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'pinged': 0,
+            'discarded': 0,
+            'evicted': 0,
+            'waits': 0,
+            'timeouts': 0
+        }
+
+    def _count(self, key):
+        with self._condition:
+            self._stats[key] += 1
+
+    def _connect(self):
+        options = {}
+        if self.connect_timeout is not None:
+            options['connect_timeout'] = self.connect_timeout
+        return pymysql.connect(user=env['SQL_USER'], password=env['SQL_PASSWORD'], host=self.host,
+                               database=env['SQL_DB_NAME'], cursorclass=pymysql.cursors.DictCursor,
+                               port=self.port, ssl_ca=env['SQL_SSL_CERT'], autocommit=True,
+                               client_flag=CLIENT.FOUND_ROWS, **options)
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self):
+        """
+        Close connections idle for too long (the caller must hold the pool lock).
+        Idle connections are stored oldest first, so eviction stops at the first recent one.
+        """
+        limit = monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < limit:
+            connection, released_at = self._idle.popleft()
+            self._size -= 1
+            self._stats['evicted'] += 1
+            self._close_quietly(connection)
+
+    def acquire(self):
+        """
+        Borrow a connection from the pool, opening a new one if the pool is not full.
+        :return: pymysql connection
+        """
+        deadline = monotonic() + self.timeout
+        connection = None
+        released_at = None
+        with self._condition:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    connection, released_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError("No MySQL connection available after {0}s".format(self.timeout))
+                self._stats['waits'] += 1
+                self._condition.wait(remaining)
+
+        if connection is not None:
+            if monotonic() - released_at < self.ping_interval:
+                self._count('reused')
+                return connection
+            try:
+                connection.ping(reconnect=True)
+                self._count('pinged')
+                return connection
+            except Exception:
+                self._count('discarded')
+                self._close_quietly(connection)
+
+        try:
+            connection = self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        self._count('created')
+        return connection
+
+    def release(self, connection, discard: bool = False):
+        """
+        Give a borrowed connection back to the pool
+        :param connection:
+        :param discard: close the connection instead of keeping it (broken connection)
+        """
+        with self._condition:
+            if discard or os.getpid() != self.pid:
+                self._size -= 1
+                self._stats['discarded'] += 1
+                self._close_quietly(connection)
+            else:
+                self._idle.append((connection, monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of the with block.
+        The connection is discarded if the driver reports it as broken.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            self.release(connection, discard=True)
+            raise
+        except BaseException:
+            try:
+                connection.rollback()
+            except Exception:
+                self.release(connection, discard=True)
+                raise
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self):
+        """
+        Close all idle connections, borrowed ones are closed when released.
+        """
+        with self._condition:
+            while self._idle:
+                connection, released_at = self._idle.popleft()
+                self._size -= 1
+                self._close_quietly(connection)
+            self.pid = None
+
+    def stats(self):
+        """
+        Pool metrics
+        :return: dict
+        """
+        with self._condition:
+            metrics = dict(self._stats)
+            metrics.update({
+                'host': self.host,
+                'pid': self.pid,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle)
+            })
+        return metrics
+
+
+class Replica(object):
+    """
+    Read replica of the primary database with its own connection pool.
+
+    The replication lag is checked at most every check_interval seconds, by the first read that needs it. A replica
+    lagging more than max_lag seconds, or whose lag can't be read (stopped replication, server down), is skipped.
+    """
+
+    def __init__(self, host: str, port: int = None, max_lag: float = None, check_interval: float = None):
+        """
+        :param host:
+        :param port: SQL_PORT if None
+        :param max_lag: maximum replication lag in seconds (SQL_REPLICA_MAX_LAG)
+        :param check_interval: seconds between two lag checks (SQL_REPLICA_CHECK_INTERVAL)
+        """
+        self.max_lag = max_lag if max_lag is not None else settings.get('SQL_REPLICA_MAX_LAG', 2, float)
+        self.check_interval = check_interval if check_interval is not None else \
+            settings.get('SQL_REPLICA_CHECK_INTERVAL', 5, float)
+        self.pool = ConnectionPool(host=host, port=port, connect_timeout=2)
+        self.lag = None
+        self.healthy = False
+        self.checked_at = None
+        self._lock = Lock()
+
+    def _read_lag(self):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                # MySQL >= 8.0.22, SHOW SLAVE STATUS before
+                cursor.execute('SHOW REPLICA STATUS')
+            except pymysql.err.ProgrammingError:
+                cursor.execute('SHOW SLAVE STATUS')
+            status = cursor.fetchone()
+        if not status:
+            return None
+        return status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+
+    def is_healthy(self):
+        """
+        Check the replication lag if the last check is too old
+        :return: True if the replica can serve reads
+        """
+        if self.checked_at is not None and monotonic() - self.checked_at < self.check_interval:
+            return self.healthy
+        # a single thread checks the replica, the others keep the last result
+        if not self._lock.acquire(blocking=False):
+            return self.healthy
+        try:
+            try:
+                self.lag = self._read_lag()
+            except Exception:
+                self.lag = None
+            self.healthy = self.lag is not None and self.lag <= self.max_lag
+            self.checked_at = monotonic()
+        finally:
+            self._lock.release()
+        return self.healthy
+
+    def stats(self):
+        """
+        Replica metrics
+        :return: dict
+        """
+        metrics = self.pool.stats()
+        metrics.update({'lag': self.lag, 'healthy': self.healthy})
+        return metrics
+
+
 force_reset_connection = False
+_pool = None
+_pool_lock = Lock()
+_replicas = None
+_next_replica = 0
+
+
+def get_pool():
+    """
+    Return the connection pool of the current process.
+    A new pool is created after a fork (uwsgi workers) so that sockets are never shared between processes.
+    """
+    global _pool, force_reset_connection
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid() and force_reset_connection is False:
+        return pool
+
+    with _pool_lock:
+        if _pool is not None and (_pool.pid != os.getpid() or force_reset_connection is True):
+            if _pool.pid == os.getpid():
+                _pool.close()
+            _pool = None
+            force_reset_connection = False
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def get_replicas():
+    """
+    Return the read replicas of the current process, listed in SQL_REPLICA_HOSTS (comma separated host[:port]).
+    :return: list of Replica, empty without replica
+    """
+    global _replicas
+    replicas = _replicas
+    if replicas is not None and replicas[0] == os.getpid():
+        return replicas[1]
+
+    with _pool_lock:
+        if _replicas is not None and _replicas[0] != os.getpid():
+            _replicas = None
+        if _replicas is None:
+            replicas = []
+            for address in settings.get('SQL_REPLICA_HOSTS', '').split(','):
+                address = address.strip()
+                if address:
+                    host, separator, port = address.partition(':')
+                    replicas.append(Replica(host=host, port=int(port) if port else None))
+            _replicas = (os.getpid(), replicas)
+        return _replicas[1]
+
+
+def get_read_pool():
+    """
+    Return the pool of a replica for the reads, replicas taking turns, or the primary pool when there is no
+    replica or none is in sync.
+    """
+    global _next_replica
+    replicas = get_replicas()
+    if len(replicas) > 0:
+        start = _next_replica
+        _next_replica = (start + 1) % len(replicas)
+        for index in range(len(replicas)):
+            replica = replicas[(start + index) % len(replicas)]
+            if replica.is_healthy():
+                return replica.pool
+    return get_pool()
 
 
 # used by wsgi multiprocess container
@@ -0,0 +1,197 @@
+"""
+SQLite backend of the models, to run the ORM without a MySQL server (benchmarks, load tests on a laptop):
+
+    backend = SQLiteBackend(':memory:')
+    backend.create_tables()
+    set_backend(backend)
+
+The statements generated in the MySQL dialect are translated by the cursors (placeholders, RAND(), FOR UPDATE), the
+upserts are generated with the SQLite conflict clause, and the tables are built from db_structure.sql with the indexes
+it declares and the ones declared by the models.
+"""
+import re
+import sqlite3
+
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import RLock
+
+from utils.orm.backend import Backend
+from utils.orm.migrations import SCHEMA_FILE, table_statements, index_name, is_covered, get_models
+from utils.orm.statements import STATEMENT_CACHE_SIZE, insert_statement, quote
+
+_INDEX_PATTERN = re.compile(r',\s*INDEX\s*\(([^)]*)\)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def sqlite_statement(query):
+    """
+    Translate a statement of the ORM into the SQLite dialect
+    :param query: SQL statement with %s placeholders
+    :return: SQL statement with ? placeholders
+    """
+    query = query.replace('%s', '?').replace('RAND()', 'RANDOM()')
+    if query.endswith(' FOR UPDATE'):
+        # a SQLite transaction locks the whole database
+        query = query[:-len(' FOR UPDATE')]
+    return query
+
+
+def sqlite_table(statement):
+    """
+    Translate a CREATE TABLE statement of db_structure.sql into the SQLite dialect
+    :param statement: CREATE TABLE statement
+    :return: CREATE TABLE statement, list of the tuples of columns of its secondary indexes
+    """
+    indexes = [tuple(column.strip(' `') for column in columns.split(','))
+               for columns in _INDEX_PATTERN.findall(statement)]
+    # an INTEGER PRIMARY KEY is already auto incremented by SQLite
+    statement = _INDEX_PATTERN.sub('', statement).replace(' AUTO_INCREMENT', '')
+    return statement, indexes
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def sqlite_upsert_statement(table, columns, conflict_keys, update_columns, nb_rows=1):
+    """
+    Same as statements.upsert_statement() with the SQLite conflict clause, conflict_keys must be a unique index
+    """
+    if update_columns:
+        action = 'DO UPDATE SET {0}'.format(', '.join('`{0}` = excluded.`{0}`'.format(column)
+                                                      for column in update_columns))
+    else:
+        action = 'DO NOTHING'
+    return '{0} ON CONFLICT({1}) {2}'.format(insert_statement(table, columns, nb_rows), quote(conflict_keys), action)
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor(object):
+    """
+    Cursor running the statements of the ORM on SQLite
+    """
+    __slots__ = ('_cursor', '_first_rowid')
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._first_rowid = None
+
+    def execute(self, query, args=None):
+        if args is None:
+            self._cursor.execute(sqlite_statement(query))
+        else:
+            # Fernet tokens are given as bytes, MySQL stores them as text
+            self._cursor.execute(sqlite_statement(query),
+                                 [value.decode() if isinstance(value, bytes) else value for value in args])
+        self._first_rowid = None
+        if query.startswith('INSERT') and ' ON CONFLICT' not in query and self._cursor.rowcount > 0:
+            # the rowids of the rows of an INSERT are consecutive, SQLite returns the last one
+            self._first_rowid = self._cursor.lastrowid - self._cursor.rowcount + 1
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self._cursor.arraysize)
+
+    @property
+    def lastrowid(self):
+        """
+        Rowid of the first row inserted by the last INSERT, as pymysql returns the first auto increment value of a
+        multi-row insert (see Abstract.insert_many)
+        """
+        if self._first_rowid is None:
+            return self._cursor.lastrowid
+        return self._first_rowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteBackend(Backend):
+    """
+    SQLite database (file or ':memory:') shared by the threads of the process through a single connection, the
+    connection is lent to one thread at a time.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:'):
+        """
+        :param path: database file, ':memory:' for a database living as long as the backend
+        """
+        self.path = path
+        # autocommit mode: the transactions are the ones opened by begin()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = _dict_factory
+        self._lock = RLock()
+
+    @contextmanager
+    def connection(self, read=False):
+        with self._lock:
+            yield self._connection
+
+    def begin(self, connection):
+        connection.execute('BEGIN')
+
+    def cursor(self, connection, stream=False):
+        # SQLite cursors always step through the rows as they are fetched
+        return SQLiteCursor(connection.cursor())
+
+    def upsert_statement(self, table, columns, conflict_keys, update_columns, nb_rows=1):
+        return sqlite_upsert_statement(table, columns, conflict_keys, update_columns, nb_rows)
+
+    def full_scans(self, cursor, statement):
+        # "SCAN <table>" without index ("SCAN TABLE <table>" before SQLite 3.36), SEARCH steps use an index
+        cursor.execute('EXPLAIN QUERY PLAN {0}'.format(statement), ['0'] * statement.count('%s'))
+        tables = []
+        for row in cursor.fetchall():
+            detail = row['detail'].split()
+            if detail[0] == 'SCAN' and 'USING' not in detail and detail[1] != 'CONSTANT':
+                tables.append(detail[2] if detail[1] == 'TABLE' else detail[1])
+        return tables
+
+    def create_tables(self, schema_file=SCHEMA_FILE, models=None):
+        """
+        Create the tables of the schema file and their indexes, the ones declared by the models (Abstract._indexes)
+        included. Existing tables and indexes are kept.
+        :param schema_file: path of the SQL file describing the tables
+        :param models: list of models (get_models() if None)
+        :return: list of the tables of the schema file
+        """
+        indexes = {}
+        tables = []
+        with self.connection() as connection:
+            for table, statement in table_statements(schema_file):
+                statement, table_indexes = sqlite_table(statement)
+                connection.execute(statement)
+                tables.append(table)
+                indexes[table] = table_indexes
+            for model in models or get_models():
+                indexes.setdefault(model._meta.table, []).extend(model._meta.indexes)
+            for table, table_indexes in indexes.items():
+                existing = self._indexes(connection, table)
+                for columns in table_indexes:
+                    if not is_covered(columns, existing):
+                        name = index_name(table, columns)
+                        connection.execute('CREATE INDEX `{0}` ON `{1}` ({2})'.format(
+                            name, table, ', '.join('`{0}`'.format(column) for column in columns)))
+                        existing[name] = list(columns)
+        return tables
+
+    @staticmethod
+    def _indexes(connection, table):
+        """
+        :return: dict {index name: list of columns in index order}, as migrations.existing_indexes()
+        """
+        return {index['name']: [column['name'] for column in connection.execute(
+                    'PRAGMA index_info(`{0}`)'.format(index['name'])).fetchall()]
+                for index in connection.execute('PRAGMA index_list(`{0}`)'.format(table)).fetchall()}
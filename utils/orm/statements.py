@@ -0,0 +1,194 @@
+from functools import lru_cache
+
+STATEMENT_CACHE_SIZE = 512
+
+
+class ModelMetadata(object):
+    """
+    Table description shared by all the instances of a model class.
+    """
+    __slots__ = ('table', 'columns', 'column_set', 'encrypt_fields', 'primary_key', 'blind_indexes', 'indexes',
+                 'unique_keys')
+
+    def __init__(self, table, columns, encrypt_fields, primary_key, blind_index_fields=(), indexes=(),
+                 unique_keys=()):
+        self.table = table
+        self.columns = tuple(columns)
+        self.column_set = frozenset(columns)
+        self.encrypt_fields = tuple(column for column in columns if column in encrypt_fields)
+        self.primary_key = tuple(primary_key)
+        # encrypted column: column of its blind index
+        self.blind_indexes = {}
+        for column in blind_index_fields:
+            index_column = '{0}_index'.format(column)
+            if column not in self.encrypt_fields or index_column not in self.column_set:
+                raise ValueError('Blind index of {0}.{1} requires the encrypted column and {2}'.format(
+                    table, column, index_column))
+            self.blind_indexes[column] = index_column
+        # secondary indexes, tuples of columns (see migrations)
+        self.indexes = tuple(tuple(index) for index in indexes)
+        for index in self.indexes:
+            if not index or not self.column_set.issuperset(index):
+                raise ValueError('Invalid index of {0}: {1}'.format(table, index))
+        # sets of columns identifying an entry, the primary key first (see Abstract.upsert)
+        self.unique_keys = (frozenset(self.primary_key),) + tuple(frozenset(key) for key in unique_keys)
+        for key in self.unique_keys[1:]:
+            if not key or not self.column_set.issuperset(key):
+                raise ValueError('Invalid unique key of {0}: {1}'.format(table, tuple(key)))
+
+
+def quote(columns):
+    return ', '.join('`{0}`'.format(column) for column in columns)
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def load_statement(table, columns, conditions, for_update=False):
+    """
+    :param table:
+    :param columns: tuple of selected columns
+    :param conditions: tuple of (column, is_null)
+    :param for_update: lock the selected row
+    :return: SQL query
+    """
+    where = []
+    for column, is_null in conditions:
+        if is_null:
+            where.append("`{0}` IS NULL".format(column))
+        else:
+            where.append("`{0}` = %s".format(column))
+    query = 'SELECT %s FROM %s WHERE %s' % (quote(columns), table, ' AND '.join(where))
+    if for_update:
+        query = '{0} FOR UPDATE'.format(query)
+    return query
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def insert_statement(table, columns, nb_rows=1):
+    """
+    :param table:
+    :param columns: tuple of inserted columns
+    :param nb_rows: number of rows of the VALUES clause
+    :return: SQL query
+    """
+    placeholders = '({0})'.format(', '.join(['%s'] * len(columns)))
+    return 'INSERT INTO `%s`(%s) VALUES%s' % (table, quote(columns), ', '.join([placeholders] * nb_rows))
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def upsert_statement(table, columns, update_columns, nb_rows=1):
+    """
+    :param table:
+    :param columns: tuple of inserted columns
+    :param update_columns: tuple of the columns set to the inserted value when the row conflicts with an existing one,
+                           empty to keep the existing row as is
+    :param nb_rows: number of rows of the VALUES clause
+    :return: SQL query
+    """
+    if update_columns:
+        assignments = ', '.join('`{0}` = VALUES(`{0}`)'.format(column) for column in update_columns)
+    else:
+        # no-op assignment: unlike INSERT IGNORE the other errors are still raised
+        assignments = '`{0}` = `{0}`'.format(columns[0])
+    return '{0} ON DUPLICATE KEY UPDATE {1}'.format(insert_statement(table, columns, nb_rows), assignments)
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def update_statement(table, columns, primary_key):
+    """
+    :param table:
+    :param columns: tuple of updated columns
+    :param primary_key: tuple of primary key columns
+    :return: SQL query
+    """
+    assignments = ', '.join('`{0}` = %s'.format(column) for column in columns)
+    where = ' AND '.join('`{0}` = %s'.format(column) for column in primary_key)
+    return 'UPDATE `%s` SET %s WHERE %s' % (table, assignments, where)
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def list_statement(table, fields, filter_sql='', group_by=None, order=None, asc='ASC', limit=0, distinct=False,
+                   random=False, offset=0):
+    """
+    :param table:
+    :param fields: tuple of selected columns
+    :param filter_sql: WHERE clause generated by the Filter (values replaced by placeholders)
+    :param group_by: group by clause
+    :param order: order by clause
+    :param asc: order by 'ASC' or 'DESC'
+    :param limit: maximum number of entries (all if 0)
+    :param distinct: select distinct fields values
+    :param random: random order
+    :param offset: number of entries skipped (with limit)
+    :return: SQL query
+    """
+    if distinct:
+        query = 'SELECT DISTINCT({0}) FROM {1}'.format(quote(fields), table)
+    else:
+        query = 'SELECT {0} FROM {1}'.format(quote(fields), table)
+    if filter_sql:
+        query = '{0} WHERE {1}'.format(query, filter_sql)
+    if group_by is not None:
+        query = "{0} GROUP BY {1}".format(query, group_by)
+    if order is not None:
+        query = "{0} ORDER BY {1} {2}".format(query, order, asc)
+    elif random is True:
+        query = "{0} ORDER BY RAND()".format(query)
+    if limit is not None and limit != 0:
+        query = '{0} LIMIT {1:d}'.format(query, int(limit))
+        if offset:
+            query = '{0} OFFSET {1:d}'.format(query, int(offset))
+    return query
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def keyset_condition(keys, asc='ASC'):
+    """
+    Condition selecting the rows sorted after a given sort key (keyset pagination).
+    The values are expected in the order given by keyset_data().
+    :param keys: tuple of sort columns, the last one must be unique (primary key)
+    :param asc: order by 'ASC' or 'DESC'
+    :return: SQL condition
+    """
+    operator = '<' if asc == 'DESC' else '>'
+    conditions = []
+    for index, key in enumerate(keys):
+        equals = ['`{0}` = %s'.format(column) for column in keys[:index]]
+        conditions.append('({0})'.format(' AND '.join(equals + ['`{0}` {1} %s'.format(key, operator)])))
+    return ' OR '.join(conditions)
+
+
+def keyset_data(values):
+    """
+    :param values: sort key of the last row of the previous page
+    :return: list of the values of the keyset_condition() placeholders
+    """
+    return [value for index in range(len(values)) for value in values[:index + 1]]
+
+
+AGGREGATE_FUNCTIONS = ['SUM', 'COUNT', 'MIN', 'MAX', 'AVG']
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def aggregate_statement(table, aggregates, group_by=(), filter_sql='', order=None, asc='ASC'):
+    """
+    :param table:
+    :param aggregates: tuple of (alias, function, column), column '*' only for COUNT
+    :param group_by: tuple of grouping columns
+    :param filter_sql: WHERE clause generated by the Filter (values replaced by placeholders)
+    :param order: alias or grouping column to order by
+    :param asc: order by 'ASC' or 'DESC'
+    :return: SQL query
+    """
+    selected = ['`{0}`'.format(column) for column in group_by]
+    for alias, function, column in aggregates:
+        if column != '*':
+            column = '`{0}`'.format(column)
+        selected.append('{0}({1}) AS `{2}`'.format(function, column, alias))
+    query = 'SELECT {0} FROM `{1}`'.format(', '.join(selected), table)
+    if filter_sql:
+        query = '{0} WHERE {1}'.format(query, filter_sql)
+    if len(group_by) > 0:
+        query = '{0} GROUP BY {1}'.format(query, quote(group_by))
+    if order is not None:
+        query = '{0} ORDER BY `{1}` {2}'.format(query, order, asc)
+    return query
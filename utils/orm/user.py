@@ -7,9 +7,9 @@ from random import randrange
 from random import choice
 from string import ascii_uppercase
 
-from utils.orm.abstract import Abstract
-from utils.orm.filter import Filter
-from utils.security import generate_hash
+from utils.orm.abstract import Abstract, transaction, utc_now
+from utils.orm.email_index import EmailIndexed
+from utils.orm.filter import Filter, OperatorType
 from utils.email import check_email_format
 from utils.scaleway import ObjectStorage
 from utils.provider import Provider
@@ -29,24 +29,27 @@ def user_directory(file_type, file_name):
     return "users/{0}/{1}".format(file_type, file_name)
 
 
-class UserAccount(Abstract):
+class UserAccount(EmailIndexed, Abstract):
     """
     UserAccount class extends the base class <abstract> and provides object-like access to the user DB table.
     """
-    def __init__(self, data=None, adapter=None):
-        Abstract.__init__(self, data, adapter)
-        self._table = 'user_account'
-        self._columns = ['user_uuid', 'firstname', 'lastname', 'birthdate', 'email', 'email_hash', 'email_validated',
-                         'selfie', 'otp_token', 'otp_expiration', 'public_address', 'magiclink_issuer',
-                         'kyc_session_id', 'kyc_status', 'kyc_status_date',
-                         'last_login', 'creator_id', 'created_date', 'updated_date', 'deactivated', 'deactivated_date']
-        self._encrypt_fields = ['email', 'firstname', 'lastname', 'birthdate', 'otp_token', 'public_address']
-        self._primary_key = ['user_uuid']
-        self._defaults = {
-            'created_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            'email_validated': 0,
-            'deactivated': 0
-        }
+    __slots__ = ()
+
+    _table = 'user_account'
+    _columns = ['user_uuid', 'firstname', 'lastname', 'birthdate', 'email', 'email_hash', 'email_index',
+                'email_validated', 'selfie', 'otp_token', 'otp_expiration', 'public_address', 'public_address_index',
+                'magiclink_issuer', 'kyc_session_id', 'kyc_status', 'kyc_status_date',
+                'last_login', 'creator_id', 'created_date', 'updated_date', 'deactivated', 'deactivated_date']
+    _encrypt_fields = ['email', 'firstname', 'lastname', 'birthdate', 'otp_token', 'public_address']
+    _blind_index_fields = ['email', 'public_address']
+    _primary_key = ['user_uuid']
+    _indexes = [('email_hash',), ('magiclink_issuer',), ('public_address_index',), ('deactivated', 'created_date')]
+    _unique_keys = [('email_hash',), ('email_index',), ('magiclink_issuer',), ('kyc_session_id',)]
+    _defaults = {
+        'created_date': utc_now,
+        'email_validated': 0,
+        'deactivated': 0
+    }
 
     def register(self, email_address: str, creator_id: str = None, firstname: str = None, lastname: str = None,
                  public_address: str = None, magiclink_issuer: str = None):
@@ -72,7 +75,6 @@ class UserAccount(Abstract):
             return False, 400, "error_exist", True
 
         user_uuid = str(uuid4())
-        email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
         otp_token = '{:06}'.format(randrange(1, 10 ** 6))
         validity_date = datetime.utcnow() + timedelta(seconds=int(env['APP_TOKEN_DELAY']))
         try:
@@ -80,13 +82,13 @@ class UserAccount(Abstract):
                 'creator_id': creator_id,
                 'user_uuid': user_uuid,
                 'email': email_address,
-                'email_hash': email_address_hash,
                 'firstname': firstname,
                 'lastname': lastname,
                 'otp_token': otp_token,
                 'otp_expiration': validity_date.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
                 'public_address': public_address,
-                'magiclink_issuer': magiclink_issuer
+                'magiclink_issuer': magiclink_issuer,
+                **self.email_lookup_values(email_address)
             })
             self.insert()
         except Exception as e:
@@ -95,6 +97,54 @@ class UserAccount(Abstract):
 
         return True, 200, "success_user_register", False
 
+    def register_many(self, email_addresses: list, creator_id: str = None):
+        """
+        Create user accounts for a list of email addresses with one lookup and bulk inserts
+        :param email_addresses:
+        :param creator_id:
+        :return: created accounts {email: user_uuid}, existing accounts {email: user_uuid}, emails not created
+        """
+        not_created = []
+        lookup_addresses = {}
+        for email_address in email_addresses:
+            if check_email_format(email_address) is False:
+                not_created.append(email_address)
+                continue
+            lookup_addresses[email_address] = email_address.lower()
+
+        existing_users = {}
+        if len(lookup_addresses) > 0:
+            users = self.list_by_emails(list(set(lookup_addresses.values())), fields=['user_uuid'])
+            for lookup_address, user in users.items():
+                existing_users[lookup_address] = user.get('user_uuid')
+
+        existed = {}
+        created = {}
+        rows = []
+        validity_date = datetime.utcnow() + timedelta(seconds=int(env['APP_TOKEN_DELAY']))
+        for email_address, lookup_address in lookup_addresses.items():
+            if lookup_address in existing_users:
+                existed[email_address] = existing_users[lookup_address]
+                continue
+            created[email_address] = str(uuid4())
+            existing_users[lookup_address] = created[email_address]
+            rows.append({
+                'creator_id': creator_id,
+                'user_uuid': created[email_address],
+                'email': email_address,
+                'otp_token': '{:06}'.format(randrange(1, 10 ** 6)),
+                'otp_expiration': validity_date.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                **self.email_lookup_values(email_address)
+            })
+
+        if len(rows) > 0:
+            try:
+                self.insert_many(rows)
+            except Exception as e:
+                self.log.error("User registration db error = {0}".format(e))
+                return {}, existed, not_created + list(created.keys())
+        return created, existed, not_created
+
     def decline(self, user_uuid):
         """
         Decline the creation of an account and remove user data
@@ -164,13 +214,7 @@ class UserAccount(Abstract):
         :return:
         """
         email_address = email_address.lower()
-        email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
-        filter_user = Filter()
-        filter_user.add('email_hash', email_address_hash)
-        user_accounts = self.list(fields=['user_uuid'], filter_object=filter_user)
-        if len(user_accounts) > 0:
-            return True
-        return False
+        return self.exists_by_email(email_address)
 
     def update_account(self, public_address: str = None, magiclink_issuer: str = None, firstname: str = None,
                        lastname: str = None, birthdate: str = None, selfie: str = None, selfie_extension: str = None):
@@ -240,14 +284,22 @@ class UserAccount(Abstract):
         :param user_uuid:
         :return:
         """
-        if user_uuid is not None:
-            self.load({'user_uuid': user_uuid})
-        if self.get('user_uuid') is not None:
-            self.set('deactivated', 1)
-            self.set('deactivated_date', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
-            self.update()
-            return True, 200, "success_deactivated"
-        return False, 400, "error_not_exist"
+        if user_uuid is None:
+            user_uuid = self.get('user_uuid')
+        if user_uuid is None:
+            return False, 400, "error_not_exist"
+
+        values = {
+            'deactivated': 1,
+            'deactivated_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        }
+        filter_user = Filter()
+        filter_user.add('user_uuid', user_uuid)
+        if self.update_where(filter_object=filter_user, values=values) == 0:
+            return False, 400, "error_not_exist"
+        if self.get('user_uuid') == user_uuid:
+            self.add_data(values).mark_clean(values.keys())
+        return True, 200, "success_deactivated"
 
     def reactivate_user(self, user_uuid: str):
         """
@@ -255,13 +307,11 @@ class UserAccount(Abstract):
         :param user_uuid:
         :return:
         """
-        self.load({'user_uuid': user_uuid})
-        if self.get('user_uuid') is not None:
-            self.set('deactivated', 0)
-            self.set('deactivated_date', None)
-            self.update()
-            return True, 200, "success_reactivated"
-        return False, 400, "error_not_exist"
+        filter_user = Filter()
+        filter_user.add('user_uuid', user_uuid)
+        if self.update_where(filter_object=filter_user, values={'deactivated': 0, 'deactivated_date': None}) == 0:
+            return False, 400, "error_not_exist"
+        return True, 200, "success_reactivated"
 
     def get_selfie(self, filename=None):
         """
@@ -294,12 +344,11 @@ class UserAccount(Abstract):
         :param public_address:
         :return:
         """
-        email_address = email_address.lower()
         if email_address is not None:
+            email_address = email_address.lower()
             if check_email_format(email_address) is False:
                 return False, 400, "error_email"
-            email_address_hash, email_salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
-            self.load({'email_hash': email_address_hash, 'deactivated': 0})
+            self.load_by_email(email_address, {'deactivated': 0})
         elif public_address is not None:
             self.load({'public_address': public_address, 'deactivated': 0})
         else:
@@ -342,17 +391,18 @@ class Beneficiary(Abstract):
     """
     Beneficiary class extends the base class <abstract> and provides object-like access to the beneficiary DB table.
     """
-    def __init__(self, data=None, adapter=None):
-        Abstract.__init__(self, data, adapter)
-        self._table = 'beneficiary'
-        self._columns = ['beneficiary_uuid', 'user_uuid', 'beneficiary_user_uuid', 'public_address', 'email',
-                         'created_date', 'deactivated', 'deactivated_date']
-        self._encrypt_fields = ['email']
-        self._primary_key = ['beneficiary_uuid']
-        self._defaults = {
-            'created_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            'deactivated': 0
-        }
+    __slots__ = ()
+
+    _table = 'beneficiary'
+    _columns = ['beneficiary_uuid', 'user_uuid', 'beneficiary_user_uuid', 'public_address', 'email',
+                'created_date', 'deactivated', 'deactivated_date']
+    _encrypt_fields = ['email']
+    _primary_key = ['beneficiary_uuid']
+    _indexes = [('user_uuid', 'deactivated', 'created_date'), ('beneficiary_user_uuid',)]
+    _defaults = {
+        'created_date': utc_now,
+        'deactivated': 0
+    }
 
     def add_new(self, user_uuid: str, beneficiary_user_uuid: str = None, public_address: str = None, email: str = None):
         """
@@ -390,18 +440,28 @@ class Beneficiary(Abstract):
         self.insert()
         return True, 200, "success_beneficiary_added"
 
-    def get_beneficiaries(self, user_uuid: str):
+    def get_beneficiaries(self, user_uuid: str, page_size: int = None, cursor: str = None):
         """
         Return the beneficiaries of the given user
         :param user_uuid:
+        :param page_size: number of beneficiaries per page (all if None)
+        :param cursor: next_cursor of the previous page
         :return:
         """
         filter_beneficiaries = Filter()
         filter_beneficiaries.add('deactivated', '0')
         filter_beneficiaries.add('user_uuid', user_uuid)
-        beneficiaries_list = self.list(fields=['beneficiary_uuid', 'beneficiary_user_uuid', 'public_address', 'email',
-                                               'created_date'],
-                                       filter_object=filter_beneficiaries)
+        fields = ['beneficiary_uuid', 'beneficiary_user_uuid', 'public_address', 'email', 'created_date']
+        next_cursor = None
+        if page_size is None:
+            beneficiaries_list = self.list(fields=fields, filter_object=filter_beneficiaries)
+        else:
+            try:
+                beneficiaries_list, next_cursor = self.list_page(fields=fields, filter_object=filter_beneficiaries,
+                                                                 order='created_date', page_size=page_size,
+                                                                 after=cursor)
+            except ValueError:
+                return False, 400, "error_invalid_pagination", [], None
         user_beneficiaries = []
         for beneficiary in beneficiaries_list:
             user_beneficiaries.append({
@@ -411,7 +471,7 @@ class Beneficiary(Abstract):
                 'email': beneficiary.get('email'),
                 'public_address': beneficiary.get('public_address')
             })
-        return True, 200, "success_beneficiary_retrieved", user_beneficiaries
+        return True, 200, "success_beneficiary_retrieved", user_beneficiaries, next_cursor
 
     def remove(self, user_uuid: str, beneficiary_uuid: str):
         """
@@ -420,13 +480,16 @@ class Beneficiary(Abstract):
         :param beneficiary_uuid:
         :return:
         """
-        self.load({'user_uuid': user_uuid, 'beneficiary_uuid': beneficiary_uuid, 'deactivated': 0})
-        if self.get('beneficiary_uuid') is None:
+        filter_beneficiary = Filter()
+        filter_beneficiary.add('user_uuid', user_uuid)
+        filter_beneficiary.add('beneficiary_uuid', beneficiary_uuid)
+        filter_beneficiary.add('deactivated', '0')
+        nb_removed = self.update_where(filter_object=filter_beneficiary, values={
+            'deactivated': 1,
+            'deactivated_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        })
+        if nb_removed == 0:
             return False, 400, "error_not_exist"
-
-        self.set('deactivated', 1)
-        self.set('deactivated_date', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
-        self.update()
         return True, 200, "success_removed"
 
 
@@ -434,17 +497,18 @@ class TokenClaim(Abstract):
     """
     TokenClaim class extends the base class <abstract> and provides object-like access to the token_claim DB table.
     """
-    def __init__(self, data=None, adapter=None):
-        Abstract.__init__(self, data, adapter)
-        self._table = 'token_claim'
-        self._columns = ['token_claim_uuid', 'user_uuid', 'nb_token', 'tx_hash',
-                         'creator_id', 'created_date', 'claimed', 'claimed_date', 'deactivated', 'deactivated_date']
-        self._primary_key = ['token_claim_uuid']
-        self._defaults = {
-            'created_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            'deactivated': 0,
-            'claimed': 0
-        }
+    __slots__ = ()
+
+    _table = 'token_claim'
+    _columns = ['token_claim_uuid', 'user_uuid', 'nb_token', 'tx_hash',
+                'creator_id', 'created_date', 'claimed', 'claimed_date', 'deactivated', 'deactivated_date']
+    _primary_key = ['token_claim_uuid']
+    _indexes = [('user_uuid', 'claimed', 'deactivated')]
+    _defaults = {
+        'created_date': utc_now,
+        'deactivated': 0,
+        'claimed': 0
+    }
 
     def create(self, creator_uuid: str, user_uuid: str, nb_token: float):
         """
@@ -463,6 +527,26 @@ class TokenClaim(Abstract):
         self.insert()
         return True
 
+    def create_many(self, creator_uuid: str, user_uuids: list, nb_token: float):
+        """
+        Create the same token claim for each of the given users
+        :param creator_uuid:
+        :param user_uuids:
+        :param nb_token:
+        :return:
+        """
+        rows = []
+        for user_uuid in user_uuids:
+            rows.append({
+                'token_claim_uuid': str(uuid4()),
+                'creator_id': creator_uuid,
+                'user_uuid': user_uuid,
+                'nb_token': nb_token
+            })
+        if len(rows) > 0:
+            self.insert_many(rows)
+        return True
+
     def deactivate(self, user_uuid: str = None, token_claim_uuid: str = None):
         """
         Deactivate a given token claim or all token claims of the given user
@@ -470,13 +554,16 @@ class TokenClaim(Abstract):
         :param token_claim_uuid:
         :return:
         """
+        values = {
+            'deactivated': 1,
+            'deactivated_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        }
         if token_claim_uuid is not None:
-            self.load({'token_claim_uuid': token_claim_uuid, 'claimed': 0})
-            if self.get('token_claim_uuid') is None:
+            filter_claim = Filter()
+            filter_claim.add('token_claim_uuid', token_claim_uuid)
+            filter_claim.add('claimed', '0')
+            if self.update_where(filter_object=filter_claim, values=values) == 0:
                 return False, 400, "error_not_exist"
-            self.set('deactivated', 1)
-            self.set('deactivated_date', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
-            self.update()
             return True, 200, "success_deactivated"
 
         if user_uuid is not None:
@@ -484,9 +571,7 @@ class TokenClaim(Abstract):
             filter_claim.add('user_uuid', user_uuid)
             filter_claim.add('claimed', '0')
             filter_claim.add('deactivated', '0')
-            active_token_claims = self.list(fields=['token_claim_uuid'], filter_object=filter_claim)
-            for token_claim in active_token_claims:
-                self.deactivate(token_claim_uuid=token_claim.get('token_claim_uuid'))
+            self.update_where(filter_object=filter_claim, values=values)
             return True, 200, "success_deactivated"
 
         return False, 400, "error_bad_request"
@@ -498,18 +583,26 @@ class TokenClaim(Abstract):
         :param claimed: False = return claimable tokens, True = return already claimed tokens
         :return:
         """
-        filter_claim = Filter()
-        filter_claim.add('user_uuid', user_uuid)
-        filter_claim.add('deactivated', '0')
-        if claimed is True:
-            filter_claim.add('claimed', '1')
-        else:
-            filter_claim.add('claimed', '0')
-        claims = self.list(fields=['token_claim_uuid', 'nb_token', 'tx_hash', 'created_date', 'claimed_date'],
-                           filter_object=filter_claim)
-        total_claim = sum(claim.get('nb_token') for claim in claims)
-        total_claim = float('{:.2f}'.format(total_claim))
-        return claims, total_claim
+        return self.get_token_claims_for_users(user_uuids=[user_uuid], claimed=claimed).get(user_uuid)
+
+    def get_token_claims_for_users(self, user_uuids: list, claimed: bool = False):
+        """
+        Return claimable tokens for all the given users with a single query (prefetch of a list of users)
+        :param user_uuids:
+        :param claimed: False = return claimable tokens, True = return already claimed tokens
+        :return: dict {user_uuid: (claims, total_claim)}
+        """
+        conditions = {
+            'deactivated': '0',
+            'claimed': '1' if claimed is True else '0'
+        }
+        users_claims = self.list_by('user_uuid', user_uuids, conditions=conditions,
+                                    fields=['token_claim_uuid', 'nb_token', 'tx_hash', 'created_date', 'claimed_date'])
+        token_claims = {}
+        for user_uuid, claims in users_claims.items():
+            total_claim = sum(claim.get('nb_token') for claim in claims)
+            token_claims[user_uuid] = (claims, float('{:.2f}'.format(total_claim)))
+        return token_claims
 
     def claim(self, user_uuid: str, user_address: str, claim_list: list):
         """
@@ -520,39 +613,65 @@ class TokenClaim(Abstract):
         :return:
         """
         transactions = {}
-        for claim_uuid in claim_list:
-            self.load({'token_claim_uuid': claim_uuid, 'user_uuid': user_uuid})
-            if self.get('nb_token') is None or self.get('claimed') == 1:
-                continue
-
-            nb_token = float(self.get('nb_token'))
-            transactions[claim_uuid] = {
-                'receiver': user_address,
-                'nb_token': nb_token
-            }
+        claims = {}
+        # the claims are flagged and committed before the tokens are sent, a second claim can't send them again
+        with transaction():
+            for claim_uuid in claim_list:
+                token_claim = TokenClaim()
+                found = token_claim.load({'token_claim_uuid': claim_uuid, 'user_uuid': user_uuid}, for_update=True)
+                if found is False or token_claim.get('nb_token') is None or str(token_claim.get('claimed')) == '1':
+                    continue
+
+                token_claim.set('claimed', '1')
+                token_claim.set('claimed_date', utc_now())
+                token_claim.update()
+                claims[claim_uuid] = token_claim
+                transactions[claim_uuid] = {
+                    'receiver': user_address,
+                    'nb_token': float(token_claim.get('nb_token'))
+                }
 
         if len(transactions) == 0:
             return False, 404, "error_bad_request", None
 
         provider = Provider()
-        status, http_code, message, tx_hash = provider.send_batch_tx(transactions=transactions)
+        try:
+            status, http_code, message, tx_hash = provider.send_batch_tx(transactions=transactions)
+        except Exception as e:
+            # e.g. the RPC node is unreachable: handled as a failed send so that the claims are reopened
+            self.log.error("Claim of {0} failed, tokens not sent, error = {1}".format(list(claims.keys()), e))
+            status, http_code, message, tx_hash = False, 503, "error_wait_retry", None
+        if status is False:
+            tx_hash = {}
+
+        # the tokens are sent: each write below commits on its own and can't reopen a claim sent
+        for claim_uuid, token_claim in claims.items():
+            operation_hash = tx_hash.get(claim_uuid)
+            if operation_hash is None:
+                # no token was sent, the claim can be claimed again
+                token_claim.set('claimed', '0')
+                token_claim.set('claimed_date', None)
+            else:
+                token_claim.set('tx_hash', operation_hash)
+            token_claim.update()
         if status is False:
             return False, http_code, message, None
 
-        current_date = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        token_operation = TokenOperation()
+        operations = []
         for claim_uuid, operation_hash in tx_hash.items():
-            if operation_hash is not None:
-                self.load({'token_claim_uuid': claim_uuid, 'user_uuid': user_uuid})
-                self.set('tx_hash', operation_hash)
-                self.set('claimed', '1')
-                self.set('claimed_date', current_date)
-                self.update()
-            token_operation = TokenOperation()
-            status_op, http_code_op, message_op = token_operation.add_operation(
-                receiver_uuid=user_uuid, sender_address=env['ADMIN_WALLET_PUBLIC_KEY'],
-                receiver_address=user_address, token=token_operation.EUROLFS,
-                nb_token=transactions[claim_uuid].get('nb_token'), tx_hash=operation_hash)
+            if operation_hash is None:
+                continue
+            operations.append({
+                'receiver_uuid': user_uuid,
+                'sender_address': env['ADMIN_WALLET_PUBLIC_KEY'],
+                'receiver_address': user_address,
+                'token': token_operation.EUROLFS,
+                'nb_token': transactions[claim_uuid].get('nb_token'),
+                'tx_hash': operation_hash
+            })
             transactions[claim_uuid]['tx_hash'] = operation_hash
+        status_op, http_code_op, message_op = token_operation.add_operations(operations=operations)
         return True, 200, "success_operation", transactions
 
 
@@ -560,15 +679,16 @@ class UserPurchase(Abstract):
     """
     UserPurchase class extends the base class <abstract> and provides object-like access to the user_purchase DB table.
     """
-    def __init__(self, data=None, adapter=None):
-        Abstract.__init__(self, data, adapter)
-        self._table = 'user_purchase'
-        self._columns = ['user_purchase_uuid', 'user_uuid', 'nb_token', 'total_price_eur', 'reference',
-                         'amount_received', 'payment_date', 'tx_hash', 'created_date']
-        self._primary_key = ['user_purchase_uuid']
-        self._defaults = {
-            'created_date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-        }
+    __slots__ = ()
+
+    _table = 'user_purchase'
+    _columns = ['user_purchase_uuid', 'user_uuid', 'nb_token', 'total_price_eur', 'reference',
+                'amount_received', 'payment_date', 'tx_hash', 'created_date']
+    _primary_key = ['user_purchase_uuid']
+    _indexes = [('user_uuid', 'created_date'), ('created_date',)]
+    _defaults = {
+        'created_date': utc_now
+    }
 
     def add_order(self, user_uuid: str, nb_token: float):
         """
@@ -590,11 +710,40 @@ class UserPurchase(Abstract):
         self.insert()
         return True, 200, "success_saved"
 
-    def confirm_payment(self, amount_received: float, tx_hash: str):
+    def get_purchases_totals(self, user_uuids: list):
+        """
+        Return the number of orders and the ordered / paid amounts of the given users, computed by the database
+        :param user_uuids:
+        :return: dict {user_uuid: {'nb_orders': int, 'nb_token': float, 'total_price_eur': float,
+                                   'amount_received': float}}
+        """
+        totals = {}
+        for user_uuid in user_uuids:
+            totals[user_uuid] = {'nb_orders': 0, 'nb_token': 0.0, 'total_price_eur': 0.0, 'amount_received': 0.0}
+        if len(totals) == 0:
+            return totals
+        filter_purchase = Filter()
+        filter_purchase.add('user_uuid', list(totals.keys()), operator=OperatorType.IIN)
+        purchases_totals = self.aggregate(fields={
+            'nb_orders': ('COUNT', '*'),
+            'nb_token': ('SUM', 'nb_token'),
+            'total_price_eur': ('SUM', 'total_price_eur'),
+            'amount_received': ('SUM', 'amount_received')
+        }, group_by=['user_uuid'], filter_object=filter_purchase)
+        for purchases_total in purchases_totals:
+            totals[purchases_total.get('user_uuid')] = {
+                'nb_orders': purchases_total.get('nb_orders'),
+                'nb_token': float('{:.2f}'.format(purchases_total.get('nb_token') or 0)),
+                'total_price_eur': float('{:.2f}'.format(purchases_total.get('total_price_eur') or 0)),
+                'amount_received': float('{:.2f}'.format(purchases_total.get('amount_received') or 0))
+            }
+        return totals
+
+    def confirm_payment(self, amount_received: float, tx_hash: str = None):
         """
         Confirm a payment
         :param amount_received:
-        :param tx_hash:
+        :param tx_hash: hash of the transaction sending the tokens, None if they are not sent yet (see set_tx_hash)
         :return:
         """
         if self.get('user_purchase_uuid') is None:
@@ -605,3 +754,30 @@ class UserPurchase(Abstract):
         self.set('payment_date', datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
         self.update()
         return True, 200, "success_saved"
+
+    def set_tx_hash(self, tx_hash: str):
+        """
+        Store the hash of the transaction sending the tokens of a confirmed payment
+        :param tx_hash:
+        :return:
+        """
+        if self.get('user_purchase_uuid') is None:
+            return False, 400, "error_unknown_order"
+
+        self.set('tx_hash', tx_hash)
+        self.update()
+        return True, 200, "success_saved"
+
+    def cancel_payment(self):
+        """
+        Reopen a payment confirmed by confirm_payment() whose tokens could not be sent
+        :return:
+        """
+        if self.get('user_purchase_uuid') is None:
+            return False, 400, "error_unknown_order"
+
+        self.set('amount_received', None)
+        self.set('tx_hash', None)
+        self.set('payment_date', None)
+        self.update()
+        return True, 200, "success_saved"
@@ -1,7 +1,37 @@
-from hashlib import pbkdf2_hmac
+import hmac
+
+from collections import OrderedDict
+from hashlib import pbkdf2_hmac, sha256
 from cryptography.fernet import Fernet
+from os import environ as env
+from threading import Lock
+from time import perf_counter
 from uuid import uuid4
 
+from utils import settings
+from utils.log import Logger
+from utils.redis_db import Redis
+
+# version of APP_BLIND_INDEX_KEY, prefix of the stored indexes
+BLIND_INDEX_VERSION = 'v1'
+
+_email_hashes = OrderedDict()
+_email_hashes_lock = Lock()
+_email_hashes_redis = None
+
+_password_lock = Lock()
+_password_stats = {'hashed': 0, 'rejected': 0, 'duration_total': 0.0, 'duration_max': 0.0, 'queue_last': 0,
+                   'queue_max': 0}
+
+log = Logger()
+
+
+class PasswordHashOverloaded(Exception):
+    """
+    Raised when too many requests wait for a worker to hash a password, answered by a 503 so that the client retries
+    later
+    """
+
 
 def generate_hash(data_to_hash, salt=None):
     """
@@ -15,6 +45,131 @@ def generate_hash(data_to_hash, salt=None):
     return pbkdf2_hmac('sha512', password=data_to_hash.encode(), salt=salt.encode(), iterations=37540).hex(), salt
 
 
+def _listen_queue():
+    """
+    Number of requests waiting for a worker in the listen queue of the uwsgi socket, 0 outside uwsgi
+    """
+    try:
+        import uwsgi
+    except ImportError:
+        return 0
+    return uwsgi.listen_queue()
+
+
+def generate_password_hash(data_to_hash, salt=None):
+    """
+    generate_hash() of a password, computed by the request worker. When more than APP_PASSWORD_HASH_QUEUE requests
+    wait in the listen queue of uwsgi, PasswordHashOverloaded is raised at once: the requests needing a PBKDF2 are
+    shed first, answered by a 503, so that the cheap ones queued behind them are still served.
+    :param data_to_hash:
+    :param salt:
+    :return: hash, salt
+    """
+    queue = _listen_queue()
+    overloaded = queue > settings.get('APP_PASSWORD_HASH_QUEUE', 10, int)
+    with _password_lock:
+        _password_stats['queue_last'] = queue
+        _password_stats['queue_max'] = max(_password_stats['queue_max'], queue)
+        if overloaded:
+            _password_stats['rejected'] += 1
+    if overloaded:
+        raise PasswordHashOverloaded()
+
+    start = perf_counter()
+    result = generate_hash(data_to_hash, salt)
+    duration = perf_counter() - start
+    with _password_lock:
+        _password_stats['hashed'] += 1
+        _password_stats['duration_total'] += duration
+        _password_stats['duration_max'] = max(_password_stats['duration_max'], duration)
+    return result
+
+
+def password_hash_stats():
+    """
+    Metrics of the password hashing of the process since its start
+    :return: dict with the number of hashes computed and rejected, the average and maximum duration (seconds) of
+             a hash, and the last and maximum number of requests seen waiting in the listen queue before a hash
+    """
+    with _password_lock:
+        stats = dict(_password_stats)
+    stats['duration_avg'] = stats['duration_total'] / stats['hashed'] if stats['hashed'] > 0 else 0.0
+    del stats['duration_total']
+    return stats
+
+
+def _email_hash_key(email_address):
+    """
+    Cache key of an email address: HMAC keyed by APP_DB_KEY so that the caches never hold the address in clear
+    and that their content cannot be matched against a list of addresses without the key.
+    The salt is part of the message, changing APP_DB_HASH_SALT invalidates the cached hashes.
+    """
+    message = '{0}:{1}'.format(env['APP_DB_HASH_SALT'], email_address).encode()
+    return hmac.new(key=env['APP_DB_KEY'].encode(), msg=message, digestmod=sha256).hexdigest()
+
+
+def _email_hash_redis():
+    # Redis db of the shared email hash cache, disabled if not set
+    global _email_hashes_redis
+    redis_db = settings.get('APP_EMAIL_HASH_REDIS_DB', cast=int)
+    if redis_db is None:
+        return None
+    if _email_hashes_redis is None:
+        _email_hashes_redis = Redis(db=redis_db).get_connection() or None
+    return _email_hashes_redis
+
+
+def generate_email_hash(email_address):
+    """
+    Hash of an email address with the fixed APP_DB_HASH_SALT, as stored in the email_hash columns.
+    The hash is deterministic so it is cached in process (LRU of APP_EMAIL_HASH_CACHE_SIZE entries) and, if
+    APP_EMAIL_HASH_REDIS_DB is set, in Redis for all the processes, to compute PBKDF2 only once per address.
+    :param email_address:
+    :return: hash
+    """
+    key = _email_hash_key(email_address)
+    with _email_hashes_lock:
+        email_hash = _email_hashes.get(key)
+        if email_hash is not None:
+            _email_hashes.move_to_end(key)
+            return email_hash
+
+    redis_db = _email_hash_redis()
+    if redis_db is not None:
+        try:
+            email_hash = redis_db.get('email_hash:{0}'.format(key))
+        except Exception:
+            email_hash = None
+    if email_hash is None:
+        email_hash, salt = generate_hash(data_to_hash=email_address, salt=env['APP_DB_HASH_SALT'])
+        if redis_db is not None:
+            try:
+                redis_db.set('email_hash:{0}'.format(key), email_hash,
+                             ex=settings.get('APP_EMAIL_HASH_REDIS_TTL', 30 * 24 * 3600, int))
+            except Exception:
+                pass
+
+    cache_size = settings.get('APP_EMAIL_HASH_CACHE_SIZE', 4096, int)
+    with _email_hashes_lock:
+        _email_hashes[key] = email_hash
+        _email_hashes.move_to_end(key)
+        while len(_email_hashes) > cache_size:
+            _email_hashes.popitem(last=False)
+    return email_hash
+
+
+def generate_blind_index(value):
+    """
+    Blind index of an encrypted value, as stored in the <column>_index columns (e.g. email_index): HMAC-SHA256 keyed
+    by the APP_BLIND_INDEX_KEY pepper, which is never stored in the database, prefixed by the key version.
+    A lookup index needs no key stretching, so the PBKDF2 of generate_hash() is left to the passwords.
+    :param value:
+    :return: index
+    """
+    digest = hmac.new(key=env['APP_BLIND_INDEX_KEY'].encode(), msg=value.encode(), digestmod=sha256)
+    return '{0}${1}'.format(BLIND_INDEX_VERSION, digest.hexdigest())
+
+
 def encrypt(data_to_encrypt, encryption_key):
     """
     Encrypt data with the given key
@@ -0,0 +1,21 @@
+"""
+Optional settings of conf/lifise-api.env.
+
+app.py loads the env file after importing the modules, so a module must not read a setting at import time: the
+settings with a default value are read through get() when they are used.
+"""
+from os import environ as env
+
+
+def get(key, default=None, cast=str):
+    """
+    Return the value of a setting
+    :param key: name of the environment variable
+    :param default: value returned when the variable is not set or empty
+    :param cast: type of the value, e.g. int or float
+    :return: value
+    """
+    value = env.get(key)
+    if value is None or value == '':
+        return default
+    return cast(value)